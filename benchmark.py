@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+
+import numpy as np
+
+from chipvis.cells import read_pin_directions
+from chipvis.gds import read_placement
+from chipvis.metrics import Metrics
+from chipvis.modes import ALL_MODES, BRIGHTNESS_MODES, compute_modes
+from chipvis.netlist import process_design, run_yosys, startswithany, yosys_version
+from chipvis.output import GifWriter, Quantizer
+from chipvis.parallel import render_frames
+from chipvis.render import FrameRenderer, frame_palette, rasterize_layout
+from chipvis.synthetic import SyntheticDesign
+from chipvis.vcd import open_vcd, read_header, sample_vcd
+from chipvis.verilog import read_netlist
+
+parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
+                                 description="Times each stage of the visualizer on synthetic designs of different sizes\n"
+                                             "(generated on the fly, no PDK or simulator needed), and compares the results\n"
+                                             "with previous runs to catch regressions")
+
+parser.add_argument("--cells", help="Comma-separated list of real cell counts (default: 1000)",
+                    action="store", default="1000")
+
+parser.add_argument("--cycles", help="Comma-separated list of cycle counts (default: 1000)",
+                    action="store", default="1000")
+
+parser.add_argument("--preset", help="Use a predefined set of sizes instead of --cells/--cycles:\n"
+                                     "small (1k cells x 1k cycles), medium (50k cells x 10k cycles),\n"
+                                     "large (500k cells x 1k and 100k cycles), scaling (1k-500k cells x 1k-1M cycles)",
+                    action="store", choices=["small", "medium", "large", "scaling"], default=None)
+
+parser.add_argument("--toggle_rate", help="Probability of each net toggling on each cycle (default: 0.1)",
+                    action="store", type=float, default=0.1)
+
+parser.add_argument("--extra_nets", help="Number of nets in the netlist/VCD which are not driven by any cell, per 1000 cells (default: 10)",
+                    action="store", type=int, default=10)
+
+parser.add_argument("--frames", help="Number of frames to draw for the rendering stage (default: 100)",
+                    action="store", type=int, default=100)
+
+parser.add_argument("--mode", help="Comma-separated list of modes to compute and draw (default: 0,1,2,3,4,5)",
+                    action="store", default="0,1,2,3,4,5")
+
+parser.add_argument("--jobs", help="Number of worker processes for drawing frames (default: 1)",
+                    action="store", type=int, default=1)
+
+parser.add_argument("--yosys", help="Also time parsing the netlist with yosys (if installed)",
+                    action="store_true")
+
+parser.add_argument("--seed", help="Random seed for the generated designs (default: 0)",
+                    action="store", type=int, default=0)
+
+parser.add_argument("--work_dir", help="Directory for the generated designs, which are reused across runs (default: bench_build)",
+                    action="store", default="bench_build")
+
+parser.add_argument("--results", help="File which results are appended to, one JSON object per line\n"
+                                      "(default: <work_dir>/results.jsonl)",
+                    action="store", default="")
+
+parser.add_argument("--threshold", help="Slowdown relative to the best previous result which is reported as a regression (default: 1.25)",
+                    action="store", type=float, default=1.25)
+
+parser.add_argument("--min_time", help="Stages faster than this (in seconds) are never reported as regressions, as they are mostly noise (default: 0.05)",
+                    action="store", type=float, default=0.05)
+
+args = parser.parse_args()
+
+PRESETS = {
+    "small": [(1000, 1000)],
+    "medium": [(50000, 10000)],
+    "large": [(500000, 1000), (500000, 100000)],
+    "scaling": [(1000, 1000), (1000, 100000), (1000, 1000000), (50000, 1000), (50000, 100000), (500000, 1000), (500000, 10000)],
+}
+
+if args.preset is not None:
+    CONFIGS = PRESETS[args.preset]
+else:
+    CONFIGS = [(int(c), int(n)) for c in args.cells.split(",") for n in args.cycles.split(",")]
+
+MODES = sorted(set(int(x.strip()) for x in args.mode.split(",")))
+assert set(MODES) - set(ALL_MODES) == set()
+
+WORK_DIR = args.work_dir
+RESULTS = args.results if len(args.results) > 0 else os.path.join(WORK_DIR, "results.jsonl")
+
+FILLER_PREFIXES = ["FILLER_"]
+PHY_PREFIXES = ["clkbuf_", "PHY_", "ANTENNA_"]
+IGNORE_PORTS = ["VPWR", "VGND", "VPB", "VNB"]
+SCALE = 3
+POSTSCALE = 1.2
+
+os.makedirs(WORK_DIR, exist_ok=True)
+
+
+def git_commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.stdout.strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def generate(cells, cycles):
+    # Generated inputs are kept in the work directory and reused if they already exist
+    name = f"synth_{cells}c_{cycles}n_{args.toggle_rate}t_{args.extra_nets}x_{args.seed}s"
+    paths = {x: os.path.join(WORK_DIR, f"{name}.{x}") for x in ["v", "gds", "vcd", "cells.v"]}
+
+    if all(os.path.isfile(x) for x in paths.values()):
+        return paths, None
+
+    metrics = Metrics()
+    with metrics.stage("generate"):
+        design = SyntheticDesign(cells, extra_nets=args.extra_nets * cells // 1000, seed=args.seed)
+        design.write_netlist(paths["v"] + ".tmp")
+        design.write_cell_models(paths["cells.v"] + ".tmp")
+        design.write_gds(paths["gds"] + ".tmp")
+        design.write_vcd(paths["vcd"] + ".tmp", cycles, toggle_rate=args.toggle_rate, seed=args.seed)
+
+    for x in paths.values():
+        os.replace(x + ".tmp", x)
+
+    return paths, metrics.stages[0]
+
+
+def run(cells, cycles, paths):
+    metrics = Metrics()
+
+    with metrics.stage("netlist") as m:
+        design = read_netlist(paths["v"], read_pin_directions(paths["cells.v"]))
+        netlist = process_design(design, IGNORE_PORTS, FILLER_PREFIXES, PHY_PREFIXES)
+        m["items"], m["unit"] = len(netlist.real_cells), "cells"
+    del design
+
+    if args.yosys and yosys_version() is not None:
+        with metrics.stage("netlist_yosys") as m:
+            design = run_yosys(paths["cells.v"], paths["v"], WORK_DIR)
+            process_design(design, IGNORE_PORTS, FILLER_PREFIXES, PHY_PREFIXES)
+            m["items"], m["unit"] = len(netlist.real_cells), "cells"
+        del design
+
+    with metrics.stage("vcd_header") as m:
+        with open_vcd(paths["vcd"]) as f:
+            header = read_header(f)
+        m["items"], m["unit"] = len(header.signals), "signals"
+
+    prefix = "tb.uut."
+    signals = {x[len(prefix):].replace("\\", ""): x for x in header.signals if x.startswith(prefix)}
+    nets = sorted(set(signals.keys()).intersection(netlist.output_nets))
+
+    with metrics.stage("trace") as m:
+        trace = sample_vcd(paths["vcd"], [signals[x] for x in nets], clk="tb.uut.clk", rst="tb.uut.rst",
+                           label="tb.status[255:0]")
+        m["items"], m["unit"] = os.path.getsize(paths["vcd"]) / 2**20, "MB"
+
+    values = trace.values
+    label_ids = trace.label_ids
+    label_names = trace.label_names
+    net_columns = {net: i for i, net in enumerate(nets)}
+    del trace
+
+    with metrics.stage("placement") as m:
+        placement = read_placement(paths["gds"])
+        m["items"], m["unit"] = len(placement.names), "cells"
+
+    cells_list = placement.cells()
+    filler_cells = [x for x in cells_list if startswithany(x[0], FILLER_PREFIXES)]
+    phy_cells = [x for x in cells_list if startswithany(x[0], PHY_PREFIXES)]
+    real_cells = [x for x in cells_list if not startswithany(x[0], FILLER_PREFIXES + PHY_PREFIXES)]
+
+    with metrics.stage("layout") as m:
+        raster = rasterize_layout(real_cells, filler_cells, phy_cells, placement.bbox[2], placement.bbox[3], SCALE,
+                                  postscale=POSTSCALE)
+        m["items"], m["unit"] = len(real_cells), "cells"
+
+    columns = []
+    for name, _, _ in real_cells:
+        out = netlist.cell_to_output_nets[name]
+        columns.append(net_columns.get(out[0], -1) if len(out) > 0 else -1)
+    columns = np.array(columns, dtype=np.int64)
+
+    mode_data = {}
+    for mode in MODES:
+        with metrics.stage(f"mode_{mode}") as m:
+            mode_data.update(compute_modes(values, [mode], exp_grow=1.2, exp_decay=0.8, lin_grow=0.15, lin_decay=0.15))
+            m["items"], m["unit"] = values.size, "cell-cycles"
+
+    renderer = FrameRenderer(raster, columns, blur=7)
+    renderer.set_text(1.0, 30, 2)
+
+    frames = min(args.frames, len(label_ids))
+    with metrics.stage("render") as m:
+        quantizer = Quantizer(frame_palette())
+        datasets = [(mode_data[mode][:frames], mode in BRIGHTNESS_MODES) for mode in MODES]
+        writers = [GifWriter(os.path.join(WORK_DIR, f"bench_{mode}.gif"), quantizer, fps=8) for mode in MODES]
+
+        for out in render_frames(renderer, datasets, label_ids[:frames], label_names, jobs=args.jobs):
+            for gif, frame in zip(writers, out):
+                gif.add(frame)
+
+        for gif in writers:
+            gif.close()
+        m["items"], m["unit"] = frames * len(MODES), "frames"
+
+    return metrics
+
+
+def compare(result, previous):
+    # Compare each stage with the best previous result of the same configuration
+    same = [x for x in previous if x["config"] == result["config"]]
+    if len(same) == 0:
+        print("No previous results for this configuration")
+        return
+
+    regressions = []
+    print(f"{'Stage':<20} {'Wall (s)':>10} {'Best (s)':>10} {'Ratio':>8}")
+    for stage in result["stages"]:
+        best = [s["wall_s"] for x in same for s in x["stages"] if s["stage"] == stage["stage"]]
+        if len(best) == 0:
+            continue
+
+        ratio = stage["wall_s"] / max(min(best), 1e-9)
+        flag = "  SLOWER" if ratio > args.threshold and stage["wall_s"] > args.min_time else ""
+        print(f"{stage['stage']:<20} {stage['wall_s']:>10.3f} {min(best):>10.3f} {ratio:>8.2f}{flag}")
+        if flag:
+            regressions.append(stage["stage"])
+
+    if len(regressions) > 0:
+        print(f"Possible regressions in: {', '.join(regressions)}")
+
+
+previous = []
+if os.path.isfile(RESULTS):
+    with open(RESULTS) as f:
+        previous = [json.loads(x) for x in f if x.strip()]
+
+for cells, cycles in CONFIGS:
+    print(f"=== {cells} cells x {cycles} cycles (toggle rate {args.toggle_rate}) ===")
+
+    print("Generating design...")
+    paths, gen = generate(cells, cycles)
+    if gen is not None:
+        print(f"Generated in {gen['wall_s']:.1f}s")
+
+    metrics = run(cells, cycles, paths)
+    print(metrics.report())
+    print()
+
+    result = {
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {"cells": cells, "cycles": cycles, "toggle_rate": args.toggle_rate, "extra_nets": args.extra_nets,
+                   "frames": args.frames, "modes": MODES, "jobs": args.jobs, "seed": args.seed},
+        "vcd_mb": os.path.getsize(paths["vcd"]) / 2**20,
+        "gds_mb": os.path.getsize(paths["gds"]) / 2**20,
+        "stages": metrics.stages,
+    }
+
+    compare(result, previous)
+    print()
+
+    with open(RESULTS, "a") as f:
+        f.write(json.dumps(result) + "\n")
+
+print(f"Results appended to {RESULTS}")
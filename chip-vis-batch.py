@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import shutil
+import sys
+from time import perf_counter
+
+from tqdm import tqdm
+
+from chipvis.batch import BatchDesign, read_manifest, run_batch
+from chipvis.cache import make_key
+from chipvis.gds import load_placement
+from chipvis.modes import ALL_MODES
+from chipvis.netlist import NETLIST_READERS, load_netlist, startswithany
+from chipvis.output import OUTPUT_FORMATS, VIDEO_CODECS
+from chipvis.render import load_layout
+
+parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
+                                 description="Visualize many simulations of one design, such as the tests of a regression suite.\n"
+                                             "The netlist, GDS and layout are loaded once, and the traces are drawn by a pool of workers")
+
+parser.add_argument("--cell_models", help="Path to verilog models (or a .lib/.lef) of the standard cells, used for pin directions\n"
+                                          "(optional with the native netlist reader, required with yosys)",
+                    action="store", default="")
+
+parser.add_argument("--gl_netlist", help="Path to gate-level netlist used for simulation",
+                    action="store", required=True)
+
+parser.add_argument("--gds", help="Path to post-layout GDS of the chip/block to visualize",
+                    action="store", required=True)
+
+parser.add_argument("--manifest", help="Traces to visualize, in JSON Lines format (one object per trace), for example:\n"
+                                       "{\"vcd\": \"test1.vcd\", \"name\": \"test1\", \"start_status\": \"Calc\", \"end_cycle\": 1000}\n"
+                                       "Each entry can set vcd (relative to the manifest), name (for the output files, default:\n"
+                                       "the VCD file name), prefix, status_var, clk, rst, start_status, end_status, start_cycle\n"
+                                       "and end_cycle. Options which an entry does not set come from the command line",
+                    action="store", required=True)
+
+parser.add_argument("--out_dir", help="Directory to write the output of each trace to, as <name>_<mode>.<format> (default: batch)",
+                    action="store", default="batch")
+
+parser.add_argument("--format", help="Output format of every trace (default: gif)",
+                    action="store", choices=[x[1:] for x in OUTPUT_FORMATS], default="gif")
+
+parser.add_argument("--results", help="File which the result of each trace is written to, one JSON object per line\n"
+                                      "(default: <out_dir>/results.jsonl)",
+                    action="store", default="")
+
+parser.add_argument("--prefix", help="Default signal-name prefix in the VCDs, including trailing dot (should be <tb name>.<uut name>.)",
+                    action="store", default=None)
+
+parser.add_argument("--status_var", help="Default status-string signal (should be <tb name>.status)",
+                    action="store", default=None)
+
+parser.add_argument("--rst", help="Default reset signal (inside the uut)",
+                    action="store", default=None)
+
+parser.add_argument("--clk", help="Default clock signal (inside the uut)",
+                    action="store", default=None)
+
+parser.add_argument("--start_status", help="Default status string to wait for before starting visualization (optional)",
+                    action="store", default=None)
+
+parser.add_argument("--end_status", help="Default status string at which to stop visualization (optional)",
+                    action="store", default=None)
+
+parser.add_argument("--start_cycle", help="Default number of cycles after the start status to skip (default: 0)",
+                    action="store", type=int, default=None)
+
+parser.add_argument("--end_cycle", help="Default cycle (counted from the start status) at which to stop visualization (optional)",
+                    action="store", type=int, default=None)
+
+parser.add_argument("--mode", help="Comma-separated list of modes to visualize (default: 0,1,2,3,4,5). Modes 6 (toggles)\n"
+                                  "and 7 (glitches) count every change of each net within each cycle, not only at clock edges",
+                    action="store", default="0,1,2,3,4,5")
+
+parser.add_argument("--cycles_per_frame", help="Number of clock cycles shown in each frame (default: 1)",
+                    action="store", type=int, default=1)
+
+parser.add_argument("--ignore_ports", help="Comma-separated list of ports in standard cells to ignore (default: VPWR,VGND,VPB,VNB - should not need to be changed)",
+                    action="store", default="VPWR,VGND,VPB,VNB")
+
+parser.add_argument("--scale", help="Integer factor to scale cells by when making frames (default: 3)",
+                    action="store", type=int, default=3)
+
+parser.add_argument("--fps", help="Frames per second for the resulting GIFs or videos (default: 8)",
+                    action="store", type=int, default=8)
+
+parser.add_argument("--downscale", help="Factor to downscale the final frames (default: 1.0)",
+                    action="store", type=float, default=1.0)
+
+parser.add_argument("--blur", help="Integer factor to blur the frames by (improves look-and-feel of output, default: 7)",
+                    action="store", type=int, default=7)
+
+parser.add_argument("--font_thickness", help="Font thickness for status text in frames (default: 2.2)",
+                    action="store", type=float, default=2.2)
+
+parser.add_argument("--exp_grow", help="Exponential growth factor for mode 4 (default: 1.2)",
+                    action="store", type=float, default=1.2)
+
+parser.add_argument("--exp_decay", help="Exponential decay factor for modes 3 and 4 (default: 0.8)",
+                    action="store", type=float, default=0.8)
+
+parser.add_argument("--lin_grow", help="Linear growth factor for mode 5 (default: 0.15)",
+                    action="store", type=float, default=0.15)
+
+parser.add_argument("--lin_decay", help="Linear decay factor for mode 5 (default: 0.15)",
+                    action="store", type=float, default=0.15)
+
+parser.add_argument("--max_toggles", help="Number of toggles (or glitches) in one frame shown at full brightness by modes 6 and 7\n"
+                                      "(default: the most of any net in any frame of each trace)",
+                    action="store", type=int, default=None)
+
+parser.add_argument("--filler_prefixes", help="Comma-separated list of prefixes for filler-cells to ignore in visualization (default: FILLER_)",
+                    action="store", default="FILLER_")
+
+parser.add_argument("--phy_prefixes", help="Comma-separated list of prefixes for physical cells to ignore in visualization (default: clkbuf_,PHY_,ANTENNA_)",
+                    action="store", default="clkbuf_,PHY_,ANTENNA_")
+
+parser.add_argument("--netlist_reader", help="How to parse the gate-level netlist: native (built-in reader, default) or yosys",
+                    action="store", choices=NETLIST_READERS, default="native")
+
+parser.add_argument("--jobs", help="Number of traces to draw at once, each in its own worker process (default: 1).\n"
+                                   "Each worker holds one trace at a time, so this also bounds the memory used",
+                    action="store", type=int, default=1)
+
+parser.add_argument("--build_dir", help="Directory to store temporary build products and cached results in (defaults to current directory)",
+                    action="store", default="")
+
+parser.add_argument("--out_of_core", help="Keep the sampled trace and the data of each mode in memory-mapped files in the build directory\n"
+                                          "instead of in memory, and compute the modes in blocks of cycles, so that traces larger than\n"
+                                          "the memory can be visualized (needs about (1 + 8 x modes) bytes of disk per net and cycle)",
+                    action="store_true")
+
+if len(sys.argv) < 2:
+    parser.print_help()
+    sys.exit(1)
+
+args = parser.parse_args()
+
+MODES = sorted(set(int(x.strip()) for x in args.mode.split(",")))
+assert len(MODES) > 0
+assert set(MODES) - set(ALL_MODES) == set()
+
+EXT = "." + args.format
+if EXT in VIDEO_CODECS and shutil.which("ffmpeg") is None:
+    print(f"ffmpeg is needed for {EXT} output, but was not found")
+    sys.exit(1)
+
+FILLER_PREFIXES = [x.strip() for x in args.filler_prefixes.split(",")]
+PHY_PREFIXES = [x.strip() for x in args.phy_prefixes.split(",")]
+IGNORE_PORTS = [x.strip() for x in args.ignore_ports.split(",")]
+
+SCALE = int(args.scale)
+POSTSCALE = float(args.downscale)
+BLUR = max(int(args.blur), 3)
+if BLUR % 2 == 0:
+    BLUR += 1
+
+JOBS = int(args.jobs)
+BUILD_DIR = args.build_dir
+OUT_DIR = args.out_dir
+RESULTS = args.results if len(args.results) > 0 else os.path.join(OUT_DIR, "results.jsonl")
+
+assert SCALE > 1
+assert args.fps > 0
+assert POSTSCALE > 0.0
+assert JOBS > 0
+assert args.cycles_per_frame > 0
+assert args.max_toggles is None or args.max_toggles > 0
+
+DEFAULTS = {"prefix": args.prefix, "status_var": args.status_var, "clk": args.clk, "rst": args.rst,
+            "start_status": args.start_status, "end_status": args.end_status,
+            "start_cycle": args.start_cycle, "end_cycle": args.end_cycle}
+
+entries = read_manifest(args.manifest, DEFAULTS)
+print(f"{len(entries)} traces in {args.manifest}")
+if len(entries) == 0:
+    sys.exit(0)
+
+os.makedirs(OUT_DIR, exist_ok=True)
+
+###########################################
+# Load design
+###########################################
+
+start = perf_counter()
+
+print(f"Loading netlist ({args.netlist_reader} reader)...")
+netlist, cached = load_netlist(args.cell_models, args.gl_netlist, BUILD_DIR, IGNORE_PORTS, FILLER_PREFIXES, PHY_PREFIXES,
+                               reader=args.netlist_reader)
+if cached:
+    print("Using cached netlist (cell models, netlist and reader are unchanged)")
+
+print("Reading GDS placement...")
+placement, cached = load_placement(args.gds, BUILD_DIR)
+if cached:
+    print("Using cached placement (GDS is unchanged)")
+
+bbox = placement.bbox.tolist()
+assert bbox[0] == 0
+assert bbox[1] == 0
+
+cells = placement.cells()
+filler_cells = [x for x in cells if startswithany(x[0], FILLER_PREFIXES)]
+phy_cells = [x for x in cells if startswithany(x[0], PHY_PREFIXES)]
+real_cells = [x for x in cells if not startswithany(x[0], FILLER_PREFIXES + PHY_PREFIXES)]
+
+print("Rasterizing layout")
+raster, cached = load_layout(real_cells, filler_cells, phy_cells, bbox[2], bbox[3], SCALE, BUILD_DIR,
+                             make_key(placement.key, FILLER_PREFIXES, PHY_PREFIXES), postscale=POSTSCALE)
+if cached:
+    print("Using cached layout raster (GDS, cell prefixes, scale and downscale are unchanged)")
+
+cell_nets = [netlist.cell_to_output_nets[name][0] if len(netlist.cell_to_output_nets[name]) > 0 else ""
+             for name, _, _ in real_cells]
+design = BatchDesign(raster, cell_nets, set(netlist.output_nets))
+del netlist, placement, cells
+
+print(f"Design loaded in {perf_counter() - start:.1f}s: {len(real_cells)} cells, "
+      f"{raster.ids.shape[1]}x{raster.ids.shape[0]} pixels")
+print()
+
+###########################################
+# Draw traces
+###########################################
+
+config = {
+    "modes": MODES,
+    "mode_params": {"exp_grow": abs(args.exp_grow), "exp_decay": abs(args.exp_decay),
+                    "lin_grow": abs(args.lin_grow), "lin_decay": abs(args.lin_decay), "max_toggles": args.max_toggles},
+    "cycles_per_frame": int(args.cycles_per_frame),
+    "blur": BLUR,
+    "font_thickness": float(args.font_thickness),
+    "fps": int(args.fps),
+    "ext": EXT,
+    "out_dir": OUT_DIR,
+    "build_dir": BUILD_DIR,
+    "out_of_core": args.out_of_core,
+}
+
+print(f"Drawing {len(entries)} traces for modes {MODES} with {JOBS} workers...")
+start = perf_counter()
+failed = []
+
+with open(RESULTS, "w") as f:
+    for result in tqdm(run_batch(entries, design, config, jobs=JOBS), total=len(entries)):
+        f.write(json.dumps(result) + "\n")
+        f.flush()
+
+        if "error" in result:
+            failed.append(result)
+            tqdm.write(f"FAILED {result['name']}: {result['error']}")
+
+wall = perf_counter() - start
+print(f"Drew {len(entries) - len(failed)} of {len(entries)} traces in {wall:.1f}s ({len(entries) / wall:.2f} traces/s)")
+print(f"Written {RESULTS}")
+
+if len(failed) > 0:
+    print(f"{len(failed)} traces failed: {', '.join(x['name'] for x in failed)}")
+    sys.exit(1)
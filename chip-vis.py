@@ -1,36 +1,53 @@
 #!/usr/bin/env python3
-import json
-import gdspy
 import numpy as np
 import cv2
-import imageio
-from vcdvcd import VCDVCD
 from tqdm import tqdm
-import string
 import os
 import sys
-from time import sleep
-import copy
+import json
+import shutil
+from time import perf_counter, process_time, sleep
 import argparse
 
+from chipvis.cache import cache_path, make_key
+from chipvis.diff import DIFF_ALIGN, DIFF_BLOCK, activity_diff_blocks, align_cycles, aligned_labels, write_diff_csv
+from chipvis.gds import load_placement
+from chipvis.metrics import Metrics
+from chipvis.modes import (ALL_MODES, BRIGHTNESS_MODES, KEYFRAME_INTERVAL, TOGGLE_MODES, ModeKeyframes, frame_rows,
+                           load_modes)
+from chipvis.netlist import NETLIST_READERS, load_netlist, startswithany
+from chipvis.output import OUTPUT_FORMATS, VIDEO_CODECS, Quantizer, open_writer
+from chipvis.parallel import draw_tiles, render_frames
+from chipvis.render import SIGNED, FrameRenderer, fit_text, frame_palette, load_layout, viewport_pixels
+from chipvis.server import FRAME_CACHE_MB, FrameServer
+from chipvis.store import FileArray
+from chipvis.summary import activity_summary, write_summary_csv
+from chipvis.tiles import TilePyramid
+from chipvis.vcd import Window, load_trace, open_vcd, read_header
+
 parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
 
-parser.add_argument("--cell_models", help="Path to verilog models of SKY130 standard cells",
-                    action="store", required=True)
+parser.add_argument("--cell_models", help="Path to verilog models (or a .lib/.lef) of the standard cells, used for pin directions\n"
+                                          "(optional with the native netlist reader, required with yosys)",
+                    action="store", default="")
 
 parser.add_argument("--gl_netlist", help="Path to gate-level netlist used for simulation",
                     action="store", required=True)
 
-parser.add_argument("--vcd", help="Path to VCD file from simulation (see docs for format)",
+parser.add_argument("--vcd", help="Path to VCD file from simulation (see docs for format). Compressed VCDs\n"
+                                 "(.vcd.gz, .vcd.zst) are decompressed while they are read, and FST files (.fst) are also supported",
                     action="store", required=True)
 
 parser.add_argument("--gds", help="Path to post-layout GDS of the chip/block to visualize",
                     action="store", required=True)
 
-parser.add_argument("--outfile", help="Filename for the output GIF (default: vis.gif)",
+parser.add_argument("--outfile", help="Filename for the output (default: vis.gif). The format is chosen by the extension:\n"
+                                     ".gif, .mp4/.webm (video, encoded by ffmpeg), .png (one indexed PNG per frame,\n"
+                                     "named <name>_<frame>.png) or .npy (all RGB frames in one array)",
                     action="store", default="vis.gif")
 
-parser.add_argument("--mode", help="Comma-separated list of modes to visualize (default: 0,1,2,3,4,5)",
+parser.add_argument("--mode", help="Comma-separated list of modes to visualize (default: 0,1,2,3,4,5). Modes 6 (toggles)\n"
+                                  "and 7 (glitches) count every change of each net within each cycle, not only at clock edges",
                     action="store", default="0,1,2,3,4,5")
 
 parser.add_argument("--prefix", help="Signal-name prefix in VCD, including trailing dot (should be <tb name>.<uut name>.)",
@@ -48,18 +65,78 @@ parser.add_argument("--clk", help="Clock signal (inside the uut)",
 parser.add_argument("--start_status", help="Status string to wait for before starting visualization (optional)",
                     action="store", default="")
 
+parser.add_argument("--end_status", help="Status string at which to stop visualization (optional, the first cycle with this status is not included)",
+                    action="store", default="")
+
+parser.add_argument("--start_cycle", help="Number of cycles after the start status to skip before starting visualization (default: 0)",
+                    action="store", type=int, default=0)
+
+parser.add_argument("--end_cycle", help="Cycle (counted from the start status, like --start_cycle) at which to stop visualization (optional)",
+                    action="store", type=int, default=None)
+
+parser.add_argument("--cycles_per_frame", help="Number of clock cycles shown in each frame (default: 1). Mode 2 shows the cells whose output\n"
+                                               "changed on any of them, the other modes show the state at the last of them",
+                    action="store", type=int, default=1)
+
 parser.add_argument("--ignore_ports", help="Comma-separated list of ports in standard cells to ignore (default: VPWR,VGND,VPB,VNB - should not need to be changed)",
                     action="store", default="VPWR,VGND,VPB,VNB")
 
 parser.add_argument("--scale", help="Integer factor to scale cells by when making frames (default: 3)",
                     action="store", type=int, default=3)
 
-parser.add_argument("--fps", help="Frames per second for the resulting gif (one frame = one clock cycle, default: 8)",
+parser.add_argument("--fps", help="Frames per second for the resulting GIF or video (one frame = one clock cycle, default: 8)",
                     action="store", type=int, default=8)
 
 parser.add_argument("--downscale", help="Factor to downscale the final frames (default: 1.0)",
                     action="store", type=float, default=1.0)
 
+parser.add_argument("--viewport", help="Region of the layout to visualize, as x0,y0,x1,y1 in GDS units (microns, default: the whole layout)",
+                    action="store", default="")
+
+parser.add_argument("--tiles", help="Also write a pyramid of tiles (one GIF per mode, zoom level and tile) into this directory,\n"
+                                    "as <mode>/<level>/<x>/<y>.gif, only for the tiles within --viewport (optional)",
+                    action="store", default="")
+
+parser.add_argument("--tile_levels", help="Number of zoom levels of the tile pyramid, each at half the resolution of the next\n"
+                                          "(the last is drawn at --scale, default: 3)",
+                    action="store", type=int, default=3)
+
+parser.add_argument("--tile_level", help="Only write the tiles of this zoom level of the tile pyramid, counting from 0 for the\n"
+                                         "smallest (default: all levels)",
+                    action="store", type=int, default=None)
+
+parser.add_argument("--summary", help="Instead of drawing frames, summarize the activity of each cell over all visualized cycles:\n"
+                                      "write a heatmap of the number of toggles on the layout to <outfile name>_summary.png\n"
+                                      "and a table of the toggle count, duty cycle, longest idle run and toggles during each\n"
+                                      "status of every cell to <outfile name>_summary.csv",
+                    action="store_true")
+
+parser.add_argument("--diff_vcd", help="Instead of drawing the modes, compare the simulation in --vcd (a) with the one in this VCD (b),\n"
+                                       "on the same netlist and GDS: write an animation of the difference in activity of each cell\n"
+                                       "(more toggles in b in red, fewer in blue) to <outfile name>_diff.<ext> and a table of the cells\n"
+                                       "whose toggle rate changed most to <outfile name>_diff.csv (optional)",
+                    action="store", default="")
+
+parser.add_argument("--diff_align", help="How to pair up the cycles of the two simulations with --diff_vcd: cycle (the n-th cycles\n"
+                                         "after the start status, default) or status (each run of a status with the same run in the\n"
+                                         "other simulation, so phases which take longer in one do not shift the rest)",
+                    action="store", choices=DIFF_ALIGN, default="cycle")
+
+parser.add_argument("--diff_window", help="Number of (aligned) cycles over which the activity of each cell is counted in each frame\n"
+                                          "of the --diff_vcd animation (default: 16)",
+                    action="store", type=int, default=16)
+
+parser.add_argument("--serve", help="Instead of drawing all frames, serve single frames on demand on this port of localhost\n"
+                                    "(http://127.0.0.1:<port>/ is a simple viewer, frames are at /frame/<mode>/<cycle>.png)",
+                    action="store", type=int, default=None)
+
+parser.add_argument("--keyframe_interval", help="Number of cycles between the stored states of modes 3, 4 and 5 with --serve\n"
+                                                "(default: 256). Smaller intervals draw frames faster but use more memory",
+                    action="store", type=int, default=KEYFRAME_INTERVAL)
+
+parser.add_argument("--cache_mb", help="Size of the cache of drawn frames with --serve, in MB (default: 256)",
+                    action="store", type=float, default=FRAME_CACHE_MB)
+
 parser.add_argument("--blur", help="Integer factor to blur the frames by (improves look-and-feel of output, default: 7)",
                     action="store", type=int, default=7)
 
@@ -78,15 +155,44 @@ parser.add_argument("--lin_grow", help="Linear growth factor for mode 5 (default
 parser.add_argument("--lin_decay", help="Linear decay factor for mode 5 (default: 0.15)",
                     action="store", type=float, default=0.15)
 
+parser.add_argument("--max_toggles", help="Number of toggles (or glitches) in one frame shown at full brightness by modes 6 and 7\n"
+                                      "(default: the most of any net in any frame)",
+                    action="store", type=int, default=None)
+
 parser.add_argument("--filler_prefixes", help="Comma-separated list of prefixes for filler-cells to ignore in visualization (default: FILLER_)",
                     action="store", default="FILLER_")
 
 parser.add_argument("--phy_prefixes", help="Comma-separated list of prefixes for physical cells to ignore in visualization (default: clkbuf_,PHY_,ANTENNA_)",
                     action="store", default="clkbuf_,PHY_,ANTENNA_")
 
-parser.add_argument("--build_dir", help="Directory to store temporary build products in (defaults to current directory)",
+parser.add_argument("--netlist_reader", help="How to parse the gate-level netlist: native (built-in reader, default) or yosys",
+                    action="store", choices=NETLIST_READERS, default="native")
+
+parser.add_argument("--jobs", help="Number of worker processes to use for drawing frames (default: 1)",
+                    action="store", type=int, default=1)
+
+parser.add_argument("--build_dir", help="Directory to store temporary build products and cached results in (defaults to current directory)",
+                    action="store", default="")
+
+parser.add_argument("--out_of_core", help="Keep the sampled trace and the data of each mode (and of --diff_vcd) in memory-mapped files in\n"
+                                          "the build directory instead of in memory, and compute them in blocks of cycles, so that\n"
+                                          "traces larger than the memory can be visualized (needs about (1 + 8 x modes) bytes of disk\n"
+                                          "per net and cycle)",
+                    action="store_true")
+
+parser.add_argument("--profile", help="Print the wall time, CPU time, peak memory and throughput of each stage at the end of the run",
+                    action="store_true")
+
+parser.add_argument("--metrics_json", help="Write the per-stage timing, memory and throughput report to this file as JSON (optional)",
                     action="store", default="")
 
+parser.add_argument("--cprofile", help="Run this stage under cProfile and dump the stats to <build_dir>/<stage>.prof (optional, one of:\n"
+                                       "netlist, vcd_header, trace, diff_trace, placement, layout, text_scale, summary, diff, keyframes,\n"
+                                       "modes, render, tiles)",
+                    action="store", choices=["netlist", "vcd_header", "trace", "diff_trace", "placement", "layout", "text_scale", "summary",
+                                             "diff", "keyframes", "modes", "render", "tiles"],
+                    default=None)
+
 if len(sys.argv) < 2:
     parser.print_help()
     sys.exit(1)
@@ -95,6 +201,7 @@ args = parser.parse_args()
 
 CELL_MODELS = args.cell_models
 GL_NETLIST = args.gl_netlist
+NETLIST_READER = args.netlist_reader
 VCD_FILE = args.vcd
 GDS_FILE = args.gds
 
@@ -107,6 +214,10 @@ RST = args.rst
 CLK = args.clk
 
 START_LABEL = args.start_status
+END_LABEL = args.end_status
+START_CYCLE = args.start_cycle
+END_CYCLE = args.end_cycle
+CYCLES_PER_FRAME = int(args.cycles_per_frame)
 
 IGNORE_PORTS = args.ignore_ports
 
@@ -116,6 +227,18 @@ POSTSCALE = float(args.downscale)
 
 BLUR = int(args.blur)
 
+VIEWPORT = args.viewport
+TILES_DIR = args.tiles
+TILE_LEVELS = int(args.tile_levels)
+TILE_LEVEL = args.tile_level
+SUMMARY = args.summary
+DIFF_VCD = args.diff_vcd
+DIFF_ALIGN_BY = args.diff_align
+DIFF_WINDOW = int(args.diff_window)
+SERVE_PORT = args.serve
+KEYFRAME_INTERVAL = int(args.keyframe_interval)
+CACHE_MB = float(args.cache_mb)
+
 FONT_THICKNESS = float(args.font_thickness)
 
 EXP_GROW = float(args.exp_grow)
@@ -124,10 +247,19 @@ EXP_DECAY = float(args.exp_decay)
 LIN_GROW = float(args.lin_grow)
 LIN_DECAY = float(args.lin_decay)
 
+MAX_TOGGLES = args.max_toggles
+
 FILLER_PREFIXES = args.filler_prefixes
 PHY_PREFIXES = args.phy_prefixes
 
 BUILD_DIR = args.build_dir
+OUT_OF_CORE = args.out_of_core
+
+JOBS = int(args.jobs)
+
+PROFILE = args.profile
+METRICS_JSON = args.metrics_json
+CPROFILE_STAGE = args.cprofile
 
 ###########################################
 # Verify config
@@ -138,28 +270,51 @@ EXP_DECAY = abs(EXP_DECAY)
 LIN_GROW = abs(LIN_GROW)
 LIN_DECAY = abs(LIN_DECAY)
 
-C_MODE_DIRECT = 0
-C_MODE_DIRECT_FILTER = 1
-C_MODE_CHANGED = 2
-C_MODE_EXP_TIME = 3
-C_MODE_EXP_HEATMAP = 4
-C_MODE_LIN_HEATMAP = 5
-ALL_MODES = [C_MODE_DIRECT, C_MODE_DIRECT_FILTER, C_MODE_CHANGED,
-             C_MODE_EXP_TIME, C_MODE_EXP_HEATMAP, C_MODE_LIN_HEATMAP]
-
 MODES = [int(x.strip()) for x in MODE.split(",")]
 assert set(MODES) - set(ALL_MODES) == set()
 MODES = sorted(list(set(MODES)))
 
 OUTFILE_PREFIX, EXT = os.path.splitext(OUTFILE)
 
-if not EXT.lower() == ".gif":
-    print("Output filename must end with .gif extension")
+if EXT.lower() not in OUTPUT_FORMATS:
+    print(f"Output filename must end with one of the extensions {', '.join(OUTPUT_FORMATS)}")
+    sys.exit(1)
+
+if EXT.lower() in VIDEO_CODECS and shutil.which("ffmpeg") is None:
+    print(f"ffmpeg is needed for {EXT} output, but was not found")
     sys.exit(1)
 
 assert len(MODES) > 0
 
 MULTI_OUT = len(MODES) > 1
+COUNT_TOGGLES = any(x in TOGGLE_MODES for x in MODES)
+
+# The sampled trace and the mode data take 1 and 8 bytes per net and cycle, so they are only kept in a
+# build directory which was asked for (the mode data with --out_of_core also needs one)
+CACHE_TRACE = len(BUILD_DIR) > 0
+CACHE_MODES = len(BUILD_DIR) > 0 or OUT_OF_CORE
+
+SUMMARY_PNG = OUTFILE_PREFIX + "_summary.png"
+SUMMARY_CSV = OUTFILE_PREFIX + "_summary.csv"
+
+if SUMMARY and len(TILES_DIR) > 0:
+    print("--tiles cannot be used with --summary")
+    sys.exit(1)
+
+SERVE = SERVE_PORT is not None
+if SERVE and (SUMMARY or len(TILES_DIR) > 0):
+    print("--serve cannot be used with --summary or --tiles")
+    sys.exit(1)
+
+DIFF = len(DIFF_VCD) > 0
+if DIFF and (SUMMARY or SERVE or len(TILES_DIR) > 0):
+    print("--diff_vcd cannot be used with --summary, --serve or --tiles")
+    sys.exit(1)
+
+DIFF_OUTFILE = OUTFILE_PREFIX + "_diff" + EXT
+DIFF_CSV = OUTFILE_PREFIX + "_diff.csv"
+
+DRAW_FRAMES = not SUMMARY and not SERVE and not DIFF
 
 FILLER_PREFIXES = [x.strip() for x in FILLER_PREFIXES.split(",")]
 PHY_PREFIXES = [x.strip() for x in PHY_PREFIXES.split(",")]
@@ -167,6 +322,22 @@ PHY_PREFIXES = [x.strip() for x in PHY_PREFIXES.split(",")]
 assert SCALE > 1
 assert FPS > 0
 assert POSTSCALE > 0.0
+assert JOBS > 0
+assert START_CYCLE >= 0
+assert END_CYCLE is None or END_CYCLE > START_CYCLE
+assert CYCLES_PER_FRAME > 0
+assert TILE_LEVELS > 0
+assert TILE_LEVEL is None or 0 <= TILE_LEVEL < TILE_LEVELS, "--tile_level must be below --tile_levels"
+assert KEYFRAME_INTERVAL > 0
+assert MAX_TOGGLES is None or MAX_TOGGLES > 0
+assert CACHE_MB > 0
+assert DIFF_WINDOW > 0
+
+if len(VIEWPORT) > 0:
+    VIEWPORT = [float(x.strip()) for x in VIEWPORT.split(",")]
+    assert len(VIEWPORT) == 4, "Viewport must be given as x0,y0,x1,y1"
+else:
+    VIEWPORT = None
 
 if BLUR < 3:
     BLUR = 3
@@ -176,39 +347,26 @@ if BLUR % 2 == 0:
 
 IGNORE_PORTS = [x.strip() for x in IGNORE_PORTS.split(",")]
 
+CPROFILE_PATH = os.path.join(BUILD_DIR, f"{CPROFILE_STAGE}.prof") if CPROFILE_STAGE is not None else None
+metrics = Metrics(profile_stage=CPROFILE_STAGE, profile_path=CPROFILE_PATH)
+
 ###########################################
 # Parse netlist
 ###########################################
 
-print("Parsing netlist using yosys (slow)...")
-
-# TODO this line may need to be changed if on windows
-design_json = os.path.join(BUILD_DIR, "design.json")
-yosys_log = os.path.join(BUILD_DIR, "yosys.log")
-os.system(f'yosys -p "read_verilog -sv {CELL_MODELS} {GL_NETLIST} ; write_json {design_json};" > {yosys_log}')
+print(f"Loading netlist ({NETLIST_READER} reader)...")
+metrics.start("netlist")
+netlist, cached = load_netlist(CELL_MODELS, GL_NETLIST, BUILD_DIR, IGNORE_PORTS, FILLER_PREFIXES, PHY_PREFIXES,
+                               reader=NETLIST_READER)
+if cached:
+    print("Using cached netlist (cell models, netlist and reader are unchanged)")
+metrics.finish(items=len(netlist.real_cells), unit="cells", cached=cached)
 
-print("Reading design")
-with open(design_json) as f:
-    design = json.load(f)
+print(f"Version: {netlist.creator}")
+print(f"Design module: {netlist.design_name}")
 
-print(f"Version: {design['creator']}")
-
-modules = design["modules"]
-modules_sky130 = {k: v for k, v in modules.items() if k.startswith("sky130_")}
-modules_design = {k: v for k, v in modules.items() if not k.startswith("sky130_")}
-
-print(f"Design modules: {list(modules_design.keys())}")
-assert len(modules_design.keys()) == 1
-DESIGN_NAME = list(modules_design.keys())[0]
-top = modules_design[DESIGN_NAME]
-
-top_ports = {}
-for name, data in top["ports"].items():
-    if name in IGNORE_PORTS:
-        continue
-
-    for i, bit in enumerate(data["bits"]):
-        top_ports[f"{name}"] = (data["direction"], bit)
+top_ports = netlist.top_ports
+top_nets = netlist.top_nets
 
 print()
 if len(top_ports) > 20:
@@ -218,14 +376,6 @@ else:
 
 print()
 
-top_nets = {}
-for name, data in top["netnames"].items():
-    if name in IGNORE_PORTS:
-        continue
-
-    for i, bit in enumerate(data["bits"]):
-        top_nets[f"{name}"] = bit
-
 if len(top_nets) > 20:
     print(f"Top nets: {str(sorted(top_nets.keys())[:20])[:-1]}, ...")
 else:
@@ -233,167 +383,139 @@ else:
 
 print()
 
-def startswithany(string, prefixes):
-    return any(string.startswith(x) for x in prefixes)
-
-phy_cells = {}
-real_cells = {}
-
-for name, data in top["cells"].items():
-    if startswithany(name, FILLER_PREFIXES + PHY_PREFIXES):
-        assert len(data["port_directions"]) == len(data["connections"])
-        #assert name.startswith("clkbuf_") or name.startswith("ANTENNA_") or len(set(data["connections"].keys()) - set(IGNORE_PORTS)) == 0
-        phy_cells[name] = data["type"]
-
-    else:
-        inputs = []
-        outputs = []
-
-        assert set(data["connections"].keys()) == set(data["port_directions"].keys())
-
-        for pin, net in data["connections"].items():
-            if pin in IGNORE_PORTS:
-                continue
-
-            assert len(net) == 1
-            assert data["port_directions"][pin] in ["input", "output"]
-
-            if data["port_directions"][pin] == "input":
-                inputs.append((pin, net[0]))
-            else:
-                outputs.append((pin, net[0]))
-
-
-        real_cells[name] = (data["type"], inputs, outputs)
-
-print(f"Phys cell types: {set(phy_cells.values())}")
+print(f"Phys cell types: {set(netlist.phy_cells.values())}")
 print()
-print(f"Real cell types: {set(x[0] for x in real_cells.values())}")
+print(f"Real cell types: {set(x[0] for x in netlist.real_cells.values())}")
 print()
 
-print("Matching nets to cells...")
-top_nets_inv = {}
-
-for k, v in top_nets.items():
-    if v not in top_nets_inv:
-        top_nets_inv[v] = []
-    top_nets_inv[v].append(k)
-
-cell_to_output_nets = {}
-
-for name, (cell_name, inputs, outputs) in real_cells.items():
-    out_net_nums = [x[1] for x in outputs]
-    cell_to_output_nets[name] = sum((top_nets_inv.get(x, []) for x in out_net_nums), [])
-
-output_nets = set().union(*cell_to_output_nets.values())
-
-cell_to_output_nets_inv = {}
-
-for k, vv in cell_to_output_nets.items():
-    for v in vv:
-        if v not in cell_to_output_nets_inv:
-            cell_to_output_nets_inv[v] = []
-        cell_to_output_nets_inv[v].append(k)
-
-assert all(len(cell_to_output_nets_inv[net]) == 1 for net in output_nets)
-output_net_to_cell = {net: cell_to_output_nets_inv[net][0] for net in output_nets}
+cell_to_output_nets = netlist.cell_to_output_nets
+output_nets = netlist.output_nets
+output_net_to_cell = netlist.output_net_to_cell
 
 ###########################################
 # Parse VCD
 ###########################################
 
-def int4(x):
-    return {"0": 0, "1": 1, "x": 0, "z": 0}[x.lower()]
+print("Reading VCD header")
+metrics.start("vcd_header")
+with open_vcd(VCD_FILE) as f:
+    vcd_header = read_header(f)
+metrics.finish(items=len(vcd_header.signals), unit="signals")
 
-print("Loading VCD (slow)...")
-vcd = VCDVCD(VCD_FILE)
-print("VCD loaded")
-
-assert all(x.startswith(PREFIX) or x.startswith(LABEL) for x in vcd.signals)
-label_signal = [x for x in vcd.signals if x.startswith(LABEL)]
+assert all(x.startswith(PREFIX) or x.startswith(LABEL) for x in vcd_header.signals)
+label_signal = [x for x in vcd_header.signals if x.startswith(LABEL)]
 assert len(label_signal) == 1
 label_signal = label_signal[0]
 
-signals = [x[len(PREFIX):] for x in vcd.signals]
+signals = [x[len(PREFIX):] for x in vcd_header.signals]
 signals_name_map = {x.replace("\\", ""): x for x in signals}
 signals_keep = list(signals_name_map.keys())
 
-print("Searching for reset")
-if len(RST) < 1:
-    start_time = 0
-else:
-    start_time, start_rst = vcd[RST].tv[-1]
-    assert start_rst == "0"
-
-print(f"Start time = {start_time}")
-
-print("Extracting clock-edge signals from VCD")
-clk_ticks = []
-last = -1
-for time, val in vcd[CLK].tv:
-    val = int(val)
-
-    if time < start_time:
-        continue
-
-    if val == 1:
-        if last != -1:
-            clk_ticks.append((last, time))
-        last = time
-
-signals_of_interest = list(set(signals_keep).intersection(output_nets))
+signals_of_interest = sorted(set(signals_keep).intersection(output_nets))
 print(f"Found {len(signals_of_interest)} matching nets out of {len(signals_keep)} internal signals / {len(output_nets)} total nets")
 print(f"{len(output_nets) - len(signals_of_interest)} unmatched nets (unless this number is large, it should be ignorable)")
 
-values_over_time = []
+print("Sampling clock-edge signals from VCD (slow unless a cached trace is found)...")
+metrics.start("trace")
+window = Window(START_LABEL, START_CYCLE, END_CYCLE, END_LABEL)
+trace, cached = load_trace(VCD_FILE, [PREFIX+signals_name_map[x] for x in signals_of_interest], CLK, BUILD_DIR,
+                           rst=RST, label=label_signal, window=window, out_of_core=OUT_OF_CORE, count_toggles=COUNT_TOGGLES,
+                           cache=CACHE_TRACE)
+if cached:
+    print("Using cached trace (VCD and sampled signals are unchanged)")
+metrics.finish(items=len(signals_of_interest), unit="nets", cached=cached, cycles=len(trace.values),
+               vcd_mb=os.path.getsize(VCD_FILE) / 2**20)
 
-print()
-print("Statuses:")
-last = ""
-for start, end in clk_ticks:
-    dat = {}
-    for signal in signals_of_interest:
-        dat[signal] = int4(vcd[PREFIX+signals_name_map[signal]][end-1])
+print(f"Start time = {trace.start_time}")
 
-    x = vcd[label_signal][end-1]
-    x = hex(int(x, 2))[2:]
-    if x == "0":
-        x = "00"
-    dat["M_LABEL"] = "".join(a if a in string.printable else " " for a in bytes.fromhex(x).decode())
+label_names = trace.label_names
 
-    if dat["M_LABEL"] != last:
-        last = dat["M_LABEL"]
-        print("  " + dat["M_LABEL"])
-
-    values_over_time.append(dat)
+print()
+print("Statuses:")
+for label in label_names:
+    print("  " + label)
 
 print()
 print()
-print(f"Number of clock cycles after reset: {len(values_over_time)}")
-first_ind = [i for i, x in enumerate(values_over_time) if START_LABEL in x["M_LABEL"]]
-if len(first_ind) == 0:
-    print("ERROR: STATUS VARIABLE NEVER MATCHES EXPECTED STARTING STATUS")
-    assert len(first_ind) > 0
-first_ind = first_ind[0]
-
-values_over_time = values_over_time[first_ind:]
-print(f"Number of clock cycles after start-label: {len(values_over_time)}")
+print(f"Number of clock cycles after reset: {trace.reset_cycles}")
+if len(trace.values) == 0:
+    if trace.start_cycle < 0:
+        print("ERROR: STATUS VARIABLE NEVER MATCHES EXPECTED STARTING STATUS")
+    else:
+        print("ERROR: NO CLOCK CYCLES WITHIN THE SELECTED WINDOW")
+    assert len(trace.values) > 0
+
+# Sampled values (cycles x nets, one column per entry of signals_of_interest) and status label of each cycle
+values = trace.values
+toggles = trace.toggles
+label_ids = trace.label_ids
+net_columns = {net: i for i, net in enumerate(signals_of_interest)}
+values_key = trace.key
+first_cycle = trace.first_cycle
+print(f"Number of clock cycles visualized: {len(values)} (cycles {first_cycle} to {first_cycle + len(values) - 1} after reset)")
+del trace
+
+cycle_label_ids = label_ids
+if CYCLES_PER_FRAME > 1:
+    # Each frame is labelled with the status of the last cycle it covers
+    label_ids = label_ids[frame_rows(len(values), CYCLES_PER_FRAME)]
+    print(f"Number of frames: {len(label_ids)} ({CYCLES_PER_FRAME} cycles per frame)")
 print()
 
+if DIFF:
+    # The second simulation is sampled on the same nets (and window), so it shares the netlist, layout and cell columns
+    print(f"Reading VCD header of {DIFF_VCD}")
+    with open_vcd(DIFF_VCD) as f:
+        diff_header = read_header(f)
+
+    diff_signals = [PREFIX+signals_name_map[x] for x in signals_of_interest]
+    diff_label_signal = [x for x in diff_header.signals if x.startswith(LABEL)]
+    missing = [x for x in diff_signals if x not in diff_header.ids]
+    if len(diff_label_signal) != 1 or len(missing) > 0:
+        print(f"ERROR: {DIFF_VCD} DOES NOT HAVE THE STATUS VARIABLE AND ALL NETS OF {VCD_FILE} ({len(missing)} NETS MISSING)")
+        sys.exit(1)
+
+    print(f"Sampling clock-edge signals from {DIFF_VCD}...")
+    metrics.start("diff_trace")
+    diff_trace, cached = load_trace(DIFF_VCD, diff_signals, CLK, BUILD_DIR, rst=RST, label=diff_label_signal[0], window=window,
+                                    out_of_core=OUT_OF_CORE, cache=CACHE_TRACE)
+    if cached:
+        print("Using cached trace (VCD and sampled signals are unchanged)")
+    metrics.finish(items=len(signals_of_interest), unit="nets", cached=cached, cycles=len(diff_trace.values),
+                   vcd_mb=os.path.getsize(DIFF_VCD) / 2**20)
+
+    if len(diff_trace.values) == 0:
+        print("ERROR: NO CLOCK CYCLES OF THE SECOND SIMULATION WITHIN THE SELECTED WINDOW")
+        sys.exit(1)
+
+    diff_index_a, diff_index_b = align_cycles(cycle_label_ids, label_names, diff_trace.label_ids, diff_trace.label_names,
+                                              DIFF_ALIGN_BY)
+    diff_label_ids, diff_label_names = aligned_labels(diff_index_a, diff_index_b, cycle_label_ids, label_names,
+                                                      diff_trace.label_ids, diff_trace.label_names)
+    diff_rows = frame_rows(len(diff_index_a), CYCLES_PER_FRAME)
+    diff_label_ids = diff_label_ids[diff_rows]
+
+    print(f"Number of clock cycles of the second simulation: {len(diff_trace.values)}")
+    print(f"Number of aligned cycles ({DIFF_ALIGN_BY} alignment): {len(diff_index_a)}, "
+          f"{int((diff_index_a < 0).sum())} only in {VCD_FILE} and {int((diff_index_b < 0).sum())} only in {DIFF_VCD}")
+    print()
+
 ###########################################
 # Parse GDS
 ###########################################
 
-print("Reading GDS (slow)...")
-gds = gdspy.GdsLibrary(infile=GDS_FILE)
-top_cell = gds.top_level()[0]
-print("Parsed GDS")
+print("Reading GDS placement...")
+metrics.start("placement")
+placement, cached = load_placement(GDS_FILE, BUILD_DIR)
+if cached:
+    print("Using cached placement (GDS is unchanged)")
+metrics.finish(items=len(placement.names), unit="cells", cached=cached, gds_mb=os.path.getsize(GDS_FILE) / 2**20)
+print(f"Top cell: {placement.top_cell}")
 
-bbox = list(top_cell.get_bounding_box().flatten())
+bbox = placement.bbox.tolist()
 print(f"Top-cell bounding box = {bbox}")
-assert set().union(*[x.properties.keys() for x in top_cell.references]) == {98}
 
-cells = [(x.properties[98], x.ref_cell.name, list(x.get_bounding_box().flatten())) for x in top_cell.references]
+cells = placement.cells()
 
 filler_cells = [(name, cell_type, bbox) for name, cell_type, bbox in cells if startswithany(name, FILLER_PREFIXES)]
 phy_cells = [(name, cell_type, bbox) for name, cell_type, bbox in cells if startswithany(name, PHY_PREFIXES)]
@@ -415,198 +537,261 @@ assert bbox[1] == 0
 WIDTH = bbox[2]
 HEIGHT = bbox[3]
 
-FONT = cv2.FONT_HERSHEY_SIMPLEX
-font_thickness = 4
-
-def interpolate_colors(c1, c2, percentage):
-    return (c1[0] + (c2[0] - c1[0]) * percentage,
-            c1[1] + (c2[1] - c1[1]) * percentage,
-            c1[2] + (c2[2] - c1[2]) * percentage)
-
-
-top_x0 = min(x0 for name, cell_type, (x0, y0, x1, y1) in real_cells + filler_cells + phy_cells)
-top_x1 = max(x1 for name, cell_type, (x0, y0, x1, y1) in real_cells + filler_cells + phy_cells)
-top_y0 = min(y0 for name, cell_type, (x0, y0, x1, y1) in real_cells + filler_cells + phy_cells)
-top_y1 = max(y1 for name, cell_type, (x0, y0, x1, y1) in real_cells + filler_cells + phy_cells)
-
+# Column in the sampled values of the net driven by each real cell (-1 if it is not in the VCD)
 warn = set()
-def draw_frame(frame_data, brightness=False, blur=7, postscale=POSTSCALE, textscale_=None, textheight_=None):
-    global textscale, textheight
-    if textscale_ is None:
-        textscale_ = textscale
-
-    if textheight_ is None:
-        textheight_ = textheight
-
-    assert set().union(*[cell_to_output_nets[a[0]] for a in real_cells]) >= set(frame_data.keys() - {"M_LABEL"})
-
-    width_scaled = int(SCALE * WIDTH + 1)
-    height_scaled = int(SCALE * HEIGHT + 1)
-
-    img = np.zeros((height_scaled, width_scaled, 3), dtype=np.uint8)
-
-    extra_cells = [(filler_cells, (0x17, 0x3f, 0x5f)),
-                   (phy_cells, (0x17, 0x3f, 0x5f))]
-
-    on_color = (0xed, 0x55, 0x3b)
-    off_color = (0x40, 0x40, 0x40)
+real_cell_columns = []
+for name, cell_type, _ in real_cells:
+    out = cell_to_output_nets[name]
+    if len(out) == 0:
+        real_cell_columns.append(-1)
+    elif out[0] not in net_columns:
+        warn.add(out[0])
+        real_cell_columns.append(-1)
+    else:
+        real_cell_columns.append(net_columns[out[0]])
 
-    img[int(SCALE * top_y0):int(SCALE * top_y1), int(SCALE * top_x0):int(SCALE * top_x1)] = (0xd, 0x14, 0x18)
+real_cell_columns = np.array(real_cell_columns, dtype=np.int64)
 
-    for name, cell_type, (x0, y0, x1, y1) in real_cells:
-        x0, y0, x1, y1 = int(SCALE * x0), int(SCALE * y0), int(SCALE * x1), int(SCALE * y1)
+assert set().union(*[cell_to_output_nets[a[0]] for a in real_cells]) >= set(net_columns.keys())
 
-        assert x0 >= 0 and x1 < img.shape[1]
-        assert y0 >= 0 and y1 < img.shape[0]
+viewport = None
+if VIEWPORT is not None:
+    viewport = viewport_pixels(VIEWPORT, WIDTH, HEIGHT, SCALE, POSTSCALE)
+    if viewport[0] >= viewport[1] or viewport[2] >= viewport[3]:
+        print("ERROR: VIEWPORT IS OUTSIDE OF THE LAYOUT")
+        sys.exit(1)
 
+print("Rasterizing layout")
+metrics.start("layout")
+raster, cached = load_layout(real_cells, filler_cells, phy_cells, WIDTH, HEIGHT, SCALE, BUILD_DIR,
+                             make_key(placement.key, FILLER_PREFIXES, PHY_PREFIXES), postscale=POSTSCALE, viewport=viewport)
+if cached:
+    print("Using cached layout raster (GDS, cell prefixes, scale, downscale and viewport are unchanged)")
+metrics.finish(items=len(real_cells), unit="cells", cached=cached, pixels=raster.ids.size)
+print(f"Drawing {raster.ids.shape[1]}x{raster.ids.shape[0]} pixels, {len(raster.cells)} cells")
+renderer = FrameRenderer(raster, real_cell_columns, blur=BLUR)
 
-        out = cell_to_output_nets[name]
-        if len(out) == 0:
-            out = 0
-        elif out[0] not in frame_data:
-            warn.add(out[0])
-            out = 0
-        else:
-            out = frame_data[out[0]]
-            #if not out: continue
+# Calculate font size
+metrics.start("text_scale")
+img_width = renderer.draw(values[0], label_names[label_ids[0]]).shape[1]
+print(f"Image width: {img_width}")
 
-        if brightness:
-            c = interpolate_colors(off_color, on_color, out)
-        else:
-            c = on_color if out else off_color
+texts = set([label_names[i] for i in np.unique(label_ids)] + ["------------"])
+text_width_desired = img_width - 20
 
-        img[(img.shape[0]-y1-1):(img.shape[0]-y0-1), x0:x1] = c
+print("Calculating text scale")
+textscale, textheight, font_thickness = fit_text(texts, text_width_desired, FONT_THICKNESS)
 
-    blur_kernel = np.ones((blur, blur), np.float32) / (blur*blur)
-    zeros = (img == (0, 0, 0))
-    img = cv2.GaussianBlur(img, (blur, blur), 0)
-    img[zeros] = 0
+print(f"Text scale: {'{:.2f}'.format(textscale)}")
+print(f"Max text height: {textheight}")
 
-    img = cv2.resize(img, None, fx=postscale, fy=postscale)
-    img_padded = np.zeros((img.shape[0] + int(1.3*textheight_), img.shape[1], img.shape[2]), dtype=img.dtype)
-    img_padded[:img.shape[0], :, :] = img
-    img_padded[img.shape[0]:, :, :] = img[-1, -1, :]
+renderer.set_text(textscale, textheight, font_thickness)
+metrics.finish()
 
-    tmp = np.mean(img_padded, axis=2)
-    first_nonzero = tmp.any(1).argmax() + 4
-    last_nonzero = (~tmp[first_nonzero:].any(1)).argmax() + first_nonzero
+###########################################
+# Activity summary
+###########################################
 
-    lab = frame_data["M_LABEL"]
-    if len(lab) < 2:
-        lab = lab + " "
-    cv2.putText(img_padded, lab, (10, last_nonzero + textheight_), FONT,
-                textscale_, (255, 255, 255), font_thickness, cv2.LINE_AA) 
+if SUMMARY:
+    print("Computing activity summary...")
+    metrics.start("summary")
+    summary = activity_summary(values, cycle_label_ids, len(label_names))
 
-    return img_padded
+    cell_nets = [cell_to_output_nets[name][0] if len(cell_to_output_nets[name]) > 0 else "" for name, _, _ in real_cells]
+    write_summary_csv(SUMMARY_CSV, summary, real_cells, real_cell_columns, cell_nets, label_names)
 
-# Calculate font size
-textscale = 1.0
-textheight = 50
+    # Heatmap of the number of toggles of each cell, relative to the most active one
+    # Its label is fitted on its own, so it does not shrink the text of the frames
+    max_toggles = max(int(summary.toggles.max(initial=0)), 1)
+    summary_label = f"Toggles per cell over {len(values)} cycles"
+    renderer.set_text(*fit_text([summary_label], text_width_desired, FONT_THICKNESS))
+    heatmap = renderer.draw(summary.toggles / max_toggles, summary_label, brightness=True)
+    renderer.set_text(textscale, textheight, font_thickness)
+    cv2.imwrite(SUMMARY_PNG, cv2.cvtColor(heatmap, cv2.COLOR_RGB2BGR))
+    metrics.finish(items=len(values), unit="cycles")
 
-img_width = draw_frame(values_over_time[0]).shape[1]
-print(f"Image width: {img_width}")
+    print(f"Most toggles of one cell: {int(summary.toggles.max(initial=0))} in {len(values)} cycles")
+    print(f"Written {SUMMARY_PNG}")
+    print(f"Written {SUMMARY_CSV}")
 
-texts = set([x["M_LABEL"] for x in values_over_time] + ["------------"])
-text_width_desired = img_width - 20
+###########################################
+# Compare simulations
+###########################################
 
-# TODO this could be cleaner
-print("Calculating text scale")
-tw = max(cv2.getTextSize(x, FONT, textscale, font_thickness)[0][0] for x in texts)
-while tw > text_width_desired or (text_width_desired - tw) > 8:
-    textscale -= 0.0001 * (tw - text_width_desired)
-    font_thickness = int(FONT_THICKNESS * textscale)
+if DIFF:
+    print(f"Computing activity differences over windows of {DIFF_WINDOW} cycles...")
+    metrics.start("diff")
+
+    # Computed in blocks of cycles, and with --out_of_core kept in a memory-mapped file
+    shape = (len(diff_rows), values.shape[1])
+    if OUT_OF_CORE:
+        diff_file = FileArray(cache_path(BUILD_DIR, "diff", make_key("diff", values_key, diff_trace.key, DIFF_ALIGN_BY,
+                                                                     DIFF_WINDOW, CYCLES_PER_FRAME), "npy"),
+                              shape, np.float64)
+        diff_data = diff_file.data
+    else:
+        diff_data = np.empty(shape, dtype=np.float64)
+
+    diff_scale = 1 / DIFF_WINDOW
+    for first, data in activity_diff_blocks(values, diff_trace.values, diff_index_a, diff_index_b, DIFF_WINDOW,
+                                            diff_rows):
+        diff_data[first:first+len(data)] = data
+        diff_scale = max(diff_scale, float(np.abs(data).max(initial=0)))
+
+    # The largest difference of any cell in any frame is drawn at full color
+    block_rows = max(DIFF_BLOCK // max(shape[1], 1), 1)
+    for start in range(0, len(diff_data), block_rows):
+        diff_data[start:start+block_rows] /= diff_scale
+    if OUT_OF_CORE:
+        diff_data = diff_file.finish()
+
+    cell_nets = [cell_to_output_nets[name][0] if len(cell_to_output_nets[name]) > 0 else "" for name, _, _ in real_cells]
+    write_diff_csv(DIFF_CSV, activity_summary(values, cycle_label_ids, len(label_names)),
+                   activity_summary(diff_trace.values, diff_trace.label_ids, len(diff_trace.label_names)),
+                   real_cells, real_cell_columns, cell_nets)
+    metrics.finish(items=len(diff_index_a), unit="cycles")
+
+    print("Generating difference frames (very slow)...")
+    metrics.start("render")
+    # The "<status a> | <status b>" labels are fitted on their own, so they do not shrink the text of the frames
+    renderer.set_text(*fit_text(set([diff_label_names[i] for i in np.unique(diff_label_ids)] + ["------------"]),
+                                text_width_desired, FONT_THICKNESS))
+    writer = open_writer(DIFF_OUTFILE, Quantizer(frame_palette(signed=True)), FPS)
+    for frames in tqdm(render_frames(renderer, [(diff_data, SIGNED)], diff_label_ids, diff_label_names, jobs=JOBS),
+                       total=len(diff_label_ids)):
+        writer.add(frames[0])
+    writer.close()
+    renderer.set_text(textscale, textheight, font_thickness)
+    metrics.finish(items=len(diff_label_ids), unit="frames", jobs=JOBS)
+
+    print(f"Largest difference in activity of one cell: {diff_scale:.3g} toggles per cycle (drawn at full color)")
+    if len(writer.paths) == 1:
+        print(f"Written {writer.paths[0]}")
+    else:
+        print(f"Written {len(writer.paths)} files {writer.paths[0]} to {writer.paths[-1]}")
+    print(f"Written {DIFF_CSV}")
 
-    tw = max(cv2.getTextSize(x, FONT, textscale, font_thickness)[0][0] for x in texts)
-textheight = max(h+b for (w, h), b in [cv2.getTextSize(x, FONT, textscale, font_thickness) for x in texts])
+###########################################
+# Serve frames
+###########################################
 
-print(f"Text scale: {'{:.2f}'.format(textscale)}")
-print(f"Max text height: {textheight}")
+if SERVE:
+    print(f"Computing keyframes for modes {MODES} (every {KEYFRAME_INTERVAL} cycles)...")
+    metrics.start("keyframes")
+    keyframes = ModeKeyframes(values, MODES, EXP_GROW, EXP_DECAY, LIN_GROW, LIN_DECAY,
+                              cycles_per_frame=CYCLES_PER_FRAME, toggles=toggles, max_toggles=MAX_TOGGLES,
+                              interval=KEYFRAME_INTERVAL)
+    metrics.finish(items=len(values), unit="cycles", modes=MODES, keyframe_mb=keyframes.nbytes() / 2**20)
+
+    server = FrameServer(renderer, keyframes, label_ids, label_names, cycles_per_frame=CYCLES_PER_FRAME,
+                         first_cycle=first_cycle, cache_bytes=int(CACHE_MB * 2**20))
+    print(f"Serving frames at http://127.0.0.1:{SERVE_PORT}/ (press Ctrl-C to stop)")
+    try:
+        server.serve(SERVE_PORT)
+    except KeyboardInterrupt:
+        print()
+
+    info = server.info()["cache"]
+    print(f"Drew {info['misses']} frames, {info['hits']} requests were served from the cache")
 
 ###########################################
 # Process Signals
 ###########################################
 
-print("Filtering signals...")
-no_change = set([x for x in values_over_time[0].keys() if all(a[x] for a in values_over_time)])
-mode_0_data = values_over_time[:]
-mode_1_data = [{k: 0 if (k in no_change and k != "M_LABEL") else v for k, v in x.items()} for x in values_over_time]
-
-print("Finding edges in signals...")
-last = values_over_time[0]
-mode_2_data = [{x: 0 if x != "M_LABEL" else last[x] for x in last.keys()}]
-mode_3_data = [{x: 0 if x != "M_LABEL" else last[x] for x in last.keys()}]
-mode_4_data = [{x: 0.0 if x != "M_LABEL" else last[x] for x in last.keys()}]
-mode_5_data = [{x: 0.0 if x != "M_LABEL" else last[x] for x in last.keys()}]
-
-for i, x in list(enumerate(values_over_time[1:])):
-    changed = {}
-    for k, v in x.items():
-        if k == "M_LABEL":
-            changed[k] = v
-        else:
-            changed[k] = (v != last[k])
-    last = x
-
-    mode_3_brightness = copy.deepcopy(mode_3_data[-1])
-    for k in mode_3_brightness:
-        if k == "M_LABEL":
-            mode_3_brightness[k] = changed[k]
-        elif changed[k]:
-            mode_3_brightness[k] = 1.0
-        else:
-            mode_3_brightness[k] = mode_3_brightness[k] * EXP_DECAY
-
-    mode_4_brightness = copy.deepcopy(mode_4_data[-1])
-    for k in mode_4_brightness:
-        if k == "M_LABEL":
-            mode_4_brightness[k] = changed[k]
-        elif changed[k]:
-            mode_4_brightness[k] = min((mode_4_brightness[k] + 0.5) * EXP_GROW, 1.5) - 0.5
-        else:
-            mode_4_brightness[k] = max((mode_4_brightness[k] + 0.5) * EXP_DECAY, 0.5) - 0.5
-
-    mode_5_brightness = copy.deepcopy(mode_5_data[-1])
-    for k in mode_5_brightness:
-        if k == "M_LABEL":
-            mode_5_brightness[k] = changed[k]
-        elif changed[k]:
-            mode_5_brightness[k] = min((mode_5_brightness[k] + 0.5) + LIN_GROW, 1.5) - 0.5
-        else:
-            mode_5_brightness[k] = max((mode_5_brightness[k] + 0.5) - LIN_DECAY, 0.5) - 0.5
-
-    assert changed.keys() == x.keys()
-
-    mode_2_data.append(changed)
-    mode_3_data.append(mode_3_brightness)
-    mode_4_data.append(mode_4_brightness)
-    mode_5_data.append(mode_5_brightness)
+if DRAW_FRAMES or len(TILES_DIR) > 0:
+    print(f"Computing data for modes {MODES}...")
+    metrics.start("modes")
+    mode_data, cached = load_modes(values, MODES, BUILD_DIR, values_key if CACHE_MODES else None, cycles_per_frame=CYCLES_PER_FRAME,
+                                   out_of_core=OUT_OF_CORE, toggles=toggles, exp_grow=EXP_GROW, exp_decay=EXP_DECAY,
+                                   lin_grow=LIN_GROW, lin_decay=LIN_DECAY, max_toggles=MAX_TOGGLES)
+    if len(cached) > 0:
+        print(f"Using cached data for modes {cached}")
+    metrics.finish(items=len(values), unit="cycles", modes=MODES, cached=cached)
 
 ###########################################
 # Draw frames
 ###########################################
 
-warn = set()
+if DRAW_FRAMES:
+    quantizer = Quantizer(frame_palette())
 
-for mode in MODES:
-    frames = []
-    print(f"Generating frames for mode {mode} (very slow)...")
+    # All modes are drawn in a single pass over the cycles, each feeding its own output
+    print(f"Generating frames for modes {MODES} (very slow)...")
     sleep(0.4)
 
-    br = mode in [C_MODE_EXP_TIME, C_MODE_EXP_HEATMAP, C_MODE_LIN_HEATMAP]
-    dat = {
-        C_MODE_DIRECT: mode_0_data,
-        C_MODE_DIRECT_FILTER: mode_1_data,
-        C_MODE_CHANGED: mode_2_data,
-        C_MODE_EXP_TIME: mode_3_data,
-        C_MODE_EXP_HEATMAP: mode_4_data,
-        C_MODE_LIN_HEATMAP: mode_5_data
-    }[mode]
+    metrics.start("render")
+    filenames = [OUTFILE_PREFIX + "_" + str(mode) + EXT if MULTI_OUT else OUTFILE for mode in MODES]
+    datasets = [(mode_data[mode], mode in BRIGHTNESS_MODES) for mode in MODES]
+    writers = [open_writer(filename, quantizer, FPS) for filename in filenames]
+
+    # Encoding happens in between drawing, so it is timed separately (and included in the render stage)
+    encode_wall = 0.0
+    encode_cpu = 0.0
+
+    for frames in tqdm(render_frames(renderer, datasets, label_ids, label_names, jobs=JOBS), total=len(label_ids)):
+        wall, cpu = perf_counter(), process_time()
+        for writer, frame in zip(writers, frames):
+            writer.add(frame)
+        encode_wall += perf_counter() - wall
+        encode_cpu += process_time() - cpu
+
+    wall, cpu = perf_counter(), process_time()
+    for writer in writers:
+        writer.close()
+    encode_wall += perf_counter() - wall
+    encode_cpu += process_time() - cpu
+
+    metrics.finish(items=len(label_ids) * len(MODES), unit="frames", jobs=JOBS)
+    output_mb = sum(os.path.getsize(x) for writer in writers for x in writer.paths) / 2**20
+    metrics.add("encode", encode_wall, encode_cpu, items=output_mb, unit="MB", part_of="render")
+
+    for writer in writers:
+        if len(writer.paths) == 1:
+            print(f"Written {writer.paths[0]}")
+        else:
+            print(f"Written {len(writer.paths)} files {writer.paths[0]} to {writer.paths[-1]}")
+
+###########################################
+# Draw tiles
+###########################################
 
-    for c in tqdm(dat):
-        frames.append(draw_frame(c, brightness=br, blur=BLUR))
+if len(TILES_DIR) > 0:
+    pyramid = TilePyramid(real_cells, filler_cells, phy_cells, WIDTH, HEIGHT, SCALE, real_cell_columns, TILE_LEVELS, blur=BLUR)
+    levels = range(TILE_LEVELS) if TILE_LEVEL is None else [TILE_LEVEL]
+    tiles = [(level, x, y) for level in levels for x, y in pyramid.tiles(level, VIEWPORT)]
 
-    print(f"Writing GIF for mode {mode}...")
-    filename = OUTFILE_PREFIX + "_" + str(mode) + ".gif" if MULTI_OUT else OUTFILE
-    imageio.mimsave(filename, frames, fps=FPS)
-    print(f"Done with mode {mode}")
+    print(f"Generating {len(tiles)} tiles for modes {MODES}...")
+    metrics.start("tiles")
+    tile_paths = [os.path.join(TILES_DIR, str(mode), "{level}", "{x}", "{y}.gif") for mode in MODES]
+    tile_datasets = [(mode_data[mode], mode in BRIGHTNESS_MODES) for mode in MODES]
+    for _ in tqdm(draw_tiles(pyramid, tiles, tile_datasets, tile_paths, Quantizer(frame_palette()), FPS, jobs=JOBS),
+                  total=len(tiles)):
+        pass
+
+    metrics.finish(items=len(tiles) * len(label_ids) * len(MODES), unit="tile-frames", jobs=JOBS)
+    print(f"Written tiles to {TILES_DIR}")
+
+###########################################
+# Report metrics
+###########################################
 
+if PROFILE:
+    print()
+    print(metrics.report())
+
+if CPROFILE_PATH is not None:
+    print(f"Written cProfile stats of stage {CPROFILE_STAGE} to {CPROFILE_PATH}")
+
+if len(METRICS_JSON) > 0:
+    report = metrics.summary()
+    report["config"] = {"gl_netlist": GL_NETLIST, "vcd": VCD_FILE, "gds": GDS_FILE, "modes": MODES, "scale": SCALE,
+                        "downscale": POSTSCALE, "jobs": JOBS, "netlist_reader": NETLIST_READER,
+                        "cycles_per_frame": CYCLES_PER_FRAME, "summary": SUMMARY, "serve": SERVE,
+                        "out_of_core": OUT_OF_CORE, "diff_vcd": DIFF_VCD}
+    report["cells"] = len(real_cells)
+    report["nets"] = len(signals_of_interest)
+    report["cycles"] = len(values)
+    report["frames"] = len(label_ids) if DRAW_FRAMES else len(diff_label_ids) if DIFF else 0
+    with open(METRICS_JSON, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Written metrics to {METRICS_JSON}")
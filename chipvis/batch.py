@@ -0,0 +1,187 @@
+import json
+import multiprocessing
+import os
+from time import perf_counter
+
+import numpy as np
+
+from chipvis.modes import BRIGHTNESS_MODES, TOGGLE_MODES, frame_rows, load_modes
+from chipvis.output import Quantizer, open_writer
+from chipvis.parallel import render_frames
+from chipvis.render import FrameRenderer, fit_text, frame_palette
+from chipvis.vcd import Window, load_trace, open_vcd, read_header
+
+# Fields of each manifest entry, and the value of those which are optional
+MANIFEST_FIELDS = {
+    "name": None,
+    "vcd": None,
+    "prefix": None,
+    "status_var": None,
+    "clk": None,
+    "rst": None,
+    "start_status": "",
+    "end_status": "",
+    "start_cycle": 0,
+    "end_cycle": None,
+}
+
+REQUIRED_FIELDS = ["vcd", "prefix", "status_var", "clk", "rst"]
+
+
+class BatchDesign:
+    """
+    The parts of the design which every trace is drawn on, loaded once for the whole batch
+    """
+    def __init__(self, raster, cell_nets, output_nets):
+        self.raster = raster            # LayoutRaster of the design
+        self.cell_nets = cell_nets      # Output net of each real cell of the raster ("" if it has none)
+        self.output_nets = output_nets  # Set of the nets driven by any real cell
+
+
+def trace_name(vcd):
+    # File name without the directory and extensions (including a compression suffix)
+    name = os.path.basename(vcd)
+    for ext in [".gz", ".zst"]:
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    return os.path.splitext(name)[0]
+
+
+def read_manifest(path, defaults):
+    """
+    Read a manifest of traces in JSON Lines format: one object per line with the fields of
+    MANIFEST_FIELDS (blank lines and lines starting with # are skipped). Fields which are
+    missing from an entry are taken from `defaults`, then from MANIFEST_FIELDS. VCD paths
+    are relative to the manifest, and the name (used for the output files) defaults to
+    the VCD file name.
+    """
+    entries = []
+    with open(path) as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if len(line) == 0 or line.startswith("#"):
+                continue
+
+            entry = json.loads(line)
+            assert isinstance(entry, dict), f"{path}:{lineno}: entries must be JSON objects"
+            unknown = set(entry.keys()) - set(MANIFEST_FIELDS.keys())
+            assert len(unknown) == 0, f"{path}:{lineno}: unknown fields {sorted(unknown)}"
+
+            entry = {**MANIFEST_FIELDS, **{k: v for k, v in defaults.items() if v is not None}, **entry}
+            for x in REQUIRED_FIELDS:
+                assert entry[x] not in [None, ""], f"{path}:{lineno}: no {x} given (in the manifest or on the command line)"
+
+            entry["vcd"] = os.path.join(os.path.dirname(path), entry["vcd"])
+            if entry["name"] is None:
+                entry["name"] = trace_name(entry["vcd"])
+            entries.append(entry)
+
+    names = [x["name"] for x in entries]
+    duplicates = sorted(set(x for x in names if names.count(x) > 1))
+    assert len(duplicates) == 0, f"Traces must have distinct names (give them a name field): {duplicates}"
+
+    return entries
+
+
+# State of each worker process, set up once by _init_worker
+_worker = {}
+
+def _init_worker(design, config):
+    _worker["design"] = design
+    _worker["config"] = config
+    _worker["quantizer"] = Quantizer(frame_palette())
+
+    # Text scale found for each (set of statuses, frame width), as most traces of a test
+    # suite share their statuses
+    _worker["text"] = {}
+
+
+def _draw_trace(entry):
+    design = _worker["design"]
+    config = _worker["config"]
+    prefix = entry["prefix"]
+
+    with open_vcd(entry["vcd"]) as f:
+        header = read_header(f)
+
+    label_signal = [x for x in header.signals if x.startswith(entry["status_var"])]
+    assert len(label_signal) == 1, f"Status variable {entry['status_var']} matches {len(label_signal)} signals"
+
+    signals = {x[len(prefix):].replace("\\", ""): x for x in header.signals if x.startswith(prefix)}
+    nets = sorted(set(signals.keys()).intersection(design.output_nets))
+    assert len(nets) > 0, f"No nets of the design found under prefix {prefix}"
+
+    modes = config["modes"]
+    window = Window(entry["start_status"], entry["start_cycle"], entry["end_cycle"], entry["end_status"])
+    trace, cached = load_trace(entry["vcd"], [signals[x] for x in nets], entry["clk"], config["build_dir"],
+                               rst=entry["rst"], label=label_signal[0], window=window, out_of_core=config["out_of_core"],
+                               count_toggles=any(x in TOGGLE_MODES for x in modes), cache=len(config["build_dir"]) > 0)
+    assert len(trace.values) > 0, "No clock cycles within the selected window"
+
+    values = trace.values
+    label_ids = trace.label_ids
+    label_names = trace.label_names
+    if config["cycles_per_frame"] > 1:
+        label_ids = label_ids[frame_rows(len(values), config["cycles_per_frame"])]
+
+    net_columns = {net: i for i, net in enumerate(nets)}
+    columns = np.array([net_columns.get(x, -1) for x in design.cell_nets], dtype=np.int64)
+    renderer = FrameRenderer(design.raster, columns, blur=config["blur"])
+
+    img_width = renderer.draw(values[0], label_names[label_ids[0]]).shape[1]
+    texts = frozenset([label_names[i] for i in np.unique(label_ids)] + ["------------"])
+    if (texts, img_width) not in _worker["text"]:
+        _worker["text"][(texts, img_width)] = fit_text(texts, img_width - 20, config["font_thickness"])
+    renderer.set_text(*_worker["text"][(texts, img_width)])
+
+    # The mode data takes 8 bytes per net and cycle, so it is only kept in a build directory which was asked for
+    cache_key = trace.key if len(config["build_dir"]) > 0 or config["out_of_core"] else None
+    mode_data, _ = load_modes(values, modes, config["build_dir"], cache_key, cycles_per_frame=config["cycles_per_frame"],
+                              out_of_core=config["out_of_core"], toggles=trace.toggles, **config["mode_params"])
+
+    out = os.path.join(config["out_dir"], entry["name"])
+    filenames = [f"{out}_{mode}{config['ext']}" if len(modes) > 1 else out + config["ext"] for mode in modes]
+    datasets = [(mode_data.pop(mode), mode in BRIGHTNESS_MODES) for mode in modes]
+    writers = [open_writer(filename, _worker["quantizer"], config["fps"]) for filename in filenames]
+
+    for frames in render_frames(renderer, datasets, label_ids, label_names):
+        for writer, frame in zip(writers, frames):
+            writer.add(frame)
+
+    for writer in writers:
+        writer.close()
+
+    return {"nets": len(nets), "cycles": len(values), "frames": len(label_ids), "trace_cached": cached,
+            "files": [x for writer in writers for x in writer.paths]}
+
+
+def draw_trace(entry):
+    """
+    Draw the frames of one manifest entry, in a worker set up by _init_worker. Failures
+    are returned as the "error" of the result, so that one bad trace does not stop the batch.
+    """
+    start = perf_counter()
+    result = {"name": entry["name"], "vcd": entry["vcd"]}
+
+    try:
+        result.update(_draw_trace(entry))
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+
+    result["wall_s"] = perf_counter() - start
+    return result
+
+
+def run_batch(entries, design, config, jobs=1):
+    """
+    Draw every entry of a manifest on `design`, yielding the result of each trace as it
+    finishes (in any order). Each of the `jobs` worker processes holds a single trace at a
+    time, so the memory used is bounded by `jobs` times that of the largest trace.
+    """
+    if jobs <= 1:
+        _init_worker(design, config)
+        yield from map(draw_trace, entries)
+        return
+
+    with multiprocessing.Pool(jobs, initializer=_init_worker, initargs=(design, config)) as pool:
+        yield from pool.imap_unordered(draw_trace, entries, chunksize=1)
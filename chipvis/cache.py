@@ -0,0 +1,153 @@
+import hashlib
+import os
+import pickle
+
+import numpy as np
+
+# Bump this if the format (or the meaning of the contents) of any cached object changes
+CACHE_VERSION = 4
+
+
+def _tmp_path(path):
+    # Named by process, so that concurrent runs sharing a build directory (such as the
+    # workers of a batch) never write to the same temporary file
+    return f"{path}.{os.getpid()}.tmp"
+
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+
+    return h.hexdigest()
+
+
+def cached_file_digest(build_dir, path):
+    """
+    file_digest, remembered in `build_dir` by (path, size, modification time) so that
+    large inputs are only hashed again when they change
+    """
+    index_path = os.path.join(build_dir, "digests.pkl")
+    st = os.stat(path)
+    stamp = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+
+    index = {}
+    if os.path.isfile(index_path):
+        try:
+            with open(index_path, "rb") as f:
+                index = pickle.load(f)
+        except Exception:
+            index = {}
+
+    if stamp in index:
+        return index[stamp]
+
+    digest = file_digest(path)
+    index = {k: v for k, v in index.items() if k[0] != stamp[0]}
+    index[stamp] = digest
+
+    tmp_path = _tmp_path(index_path)
+    with open(tmp_path, "wb") as f:
+        pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, index_path)
+
+    return digest
+
+
+def replace_cached(build_dir, source, key, files):
+    """
+    Remember `key` as the cache entry made from `source` (such as the path of an input
+    file) in `build_dir`, deleting the files (name, extension) in `files` of the entry it
+    replaces, so that only the latest entry is kept for each source
+    """
+    index_path = os.path.join(build_dir, "sources.pkl")
+
+    index = {}
+    if os.path.isfile(index_path):
+        try:
+            with open(index_path, "rb") as f:
+                index = pickle.load(f)
+        except Exception:
+            index = {}
+
+    old_key = index.get(source)
+    if old_key == key:
+        return
+
+    if old_key is not None:
+        for name, ext in files:
+            path = cache_path(build_dir, name, old_key, ext)
+            if os.path.isfile(path):
+                os.remove(path)
+    index[source] = key
+
+    tmp_path = _tmp_path(index_path)
+    with open(tmp_path, "wb") as f:
+        pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, index_path)
+
+
+def make_key(*parts):
+    """
+    Cache key from a list of (picklable) parts, such as file digests, tool
+    versions and options
+    """
+    return hashlib.sha256(pickle.dumps((CACHE_VERSION,) + parts)).hexdigest()
+
+
+def cache_path(build_dir, name, key, ext="pkl"):
+    return os.path.join(build_dir, f"{name}.{key[:20]}.{ext}")
+
+
+def load_cached(build_dir, name, key):
+    # Returns None if there is no cache entry for this key
+    path = cache_path(build_dir, name, key)
+    if not os.path.isfile(path):
+        return None
+
+    try:
+        with open(path, "rb") as f:
+            stored_key, obj = pickle.load(f)
+    except Exception:
+        return None
+
+    return obj if stored_key == key else None
+
+
+def save_cached(build_dir, name, key, obj):
+    path = cache_path(build_dir, name, key)
+    tmp_path = _tmp_path(path)
+
+    with open(tmp_path, "wb") as f:
+        pickle.dump((key, obj), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    os.replace(tmp_path, path)
+
+
+def load_cached_arrays(build_dir, name, key):
+    # Same as load_cached, for a dict of numpy arrays stored as .npz
+    path = cache_path(build_dir, name, key, "npz")
+    if not os.path.isfile(path):
+        return None
+
+    try:
+        with np.load(path, allow_pickle=False) as f:
+            arrays = {k: f[k] for k in f.files}
+    except Exception:
+        return None
+
+    if str(arrays.pop("_key", "")) != key:
+        return None
+
+    return arrays
+
+
+def save_cached_arrays(build_dir, name, key, arrays):
+    path = cache_path(build_dir, name, key, "npz")
+    tmp_path = _tmp_path(path)
+
+    with open(tmp_path, "wb") as f:
+        np.savez(f, _key=np.array(key), **arrays)
+
+    os.replace(tmp_path, path)
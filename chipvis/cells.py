@@ -0,0 +1,130 @@
+import os
+import re
+
+# Output pin names used across the SKY130 standard cell libraries (sky130_fd_sc_*).
+# Every other pin of a cell (data, clock, control and power pins) is an input.
+SKY130_OUTPUT_PINS = {"X", "Y", "Q", "Q_N", "Z", "GCLK", "HI", "LO", "SUM", "COUT", "COUT_N"}
+
+
+def default_pin_direction(cell_type, pin):
+    return "output" if pin in SKY130_OUTPUT_PINS else "input"
+
+
+_VERILOG_MODULE = re.compile(r"^\s*module\s+(\\\S+|\w+)")
+_VERILOG_PORT = re.compile(r"^\s*(input|output|inout)\b(.*)")
+_VERILOG_RANGE = re.compile(r"\[[^\]]*\]")
+
+def _read_verilog_directions(path):
+    directions = {}
+    module = None
+    statement = None
+
+    with open(path) as f:
+        for line in f:
+            line = line.split("//")[0]
+
+            m = _VERILOG_MODULE.match(line)
+            if m:
+                module = m.group(1).lstrip("\\")
+                directions[module] = {}
+                continue
+
+            if module is None:
+                continue
+
+            if line.strip().startswith("endmodule"):
+                module = None
+                continue
+
+            # Port declarations may span several lines
+            if statement is None:
+                m = _VERILOG_PORT.match(line)
+                if not m:
+                    continue
+                statement = line
+            else:
+                statement += " " + line
+
+            if ";" not in statement:
+                continue
+
+            m = _VERILOG_PORT.match(statement.split(";")[0])
+            statement = None
+            if not m:
+                continue
+
+            names = _VERILOG_RANGE.sub(" ", m.group(2)).replace("wire", " ").replace("reg", " ")
+            for name in names.replace(",", " ").split():
+                directions[module][name.lstrip("\\")] = m.group(1)
+
+    return directions
+
+
+_LIBERTY_CELL = re.compile(r"\bcell\s*\(\s*\"?([^\"\s)]+)\"?\s*\)")
+_LIBERTY_PIN = re.compile(r"\bpin\s*\(\s*\"?([^\"\s)]+)\"?\s*\)")
+_LIBERTY_DIRECTION = re.compile(r"\bdirection\s*:\s*\"?(\w+)\"?")
+
+def _read_liberty_directions(path):
+    directions = {}
+    cell = None
+    pin = None
+
+    with open(path) as f:
+        for line in f:
+            m = _LIBERTY_CELL.search(line)
+            if m:
+                cell = m.group(1)
+                directions[cell] = {}
+                pin = None
+                continue
+
+            m = _LIBERTY_PIN.search(line)
+            if m and cell is not None:
+                pin = m.group(1)
+                continue
+
+            m = _LIBERTY_DIRECTION.search(line)
+            if m and cell is not None and pin is not None:
+                directions[cell][pin] = m.group(1)
+                pin = None
+
+    return directions
+
+
+def _read_lef_directions(path):
+    directions = {}
+    macro = None
+    pin = None
+
+    with open(path) as f:
+        for line in f:
+            words = line.split()
+            if len(words) == 0:
+                continue
+
+            if words[0] == "MACRO":
+                macro = words[1]
+                directions[macro] = {}
+            elif words[0] == "PIN" and macro is not None:
+                pin = words[1]
+            elif words[0] == "DIRECTION" and pin is not None:
+                directions[macro][pin] = words[1].lower()
+            elif words[0] == "END" and len(words) > 1 and words[1] == pin:
+                pin = None
+
+    return directions
+
+
+def read_pin_directions(path):
+    """
+    Read the pin directions of each cell from a Verilog cell-model file, a Liberty
+    (.lib) file or a LEF (.lef) file. Only the port declarations are scanned, nothing
+    is elaborated. Returns {cell type: {pin: "input"/"output"/"inout"}}.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".lib":
+        return _read_liberty_directions(path)
+    elif ext == ".lef":
+        return _read_lef_directions(path)
+    else:
+        return _read_verilog_directions(path)
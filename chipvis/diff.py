@@ -0,0 +1,163 @@
+import csv
+from difflib import SequenceMatcher
+
+import numpy as np
+
+# How the cycles of the two traces are paired up: cycle by cycle from the start of the
+# window, or phase by phase of the status variable (see align_cycles)
+DIFF_ALIGN = ["cycle", "status"]
+
+# Status shown for the aligned cycles where a trace has no cycle
+NO_STATUS = "-"
+
+# Number of (aligned cycle, net) elements processed at once by activity_diff_blocks, which
+# bounds the memory used for the temporary arrays of each block of cycles
+DIFF_BLOCK = 1 << 22
+
+
+def status_runs(label_ids):
+    # (start, end) of each run of cycles with one status
+    starts = np.flatnonzero(np.diff(label_ids, prepend=-1))
+    ends = np.append(starts[1:], len(label_ids))
+    return list(zip(starts.tolist(), ends.tolist()))
+
+
+def _pair_runs(runs_a, runs_b):
+    # Indices of the cycles of runs_a and runs_b laid side by side, the shorter padded with -1
+    index_a, index_b = [], []
+    for run_a, run_b in zip(runs_a, runs_b):
+        la = run_a[1] - run_a[0] if run_a is not None else 0
+        lb = run_b[1] - run_b[0] if run_b is not None else 0
+        k = np.arange(max(la, lb))
+        index_a.append(np.where(k < la, k + (run_a[0] if run_a is not None else 0), -1))
+        index_b.append(np.where(k < lb, k + (run_b[0] if run_b is not None else 0), -1))
+
+    if len(index_a) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(index_a), np.concatenate(index_b)
+
+
+def align_cycles(label_ids_a, label_names_a, label_ids_b, label_names_b, align="cycle"):
+    """
+    Pair up the cycles of two traces, returning (index_a, index_b): the cycle of each trace
+    at each aligned cycle, or -1 where that trace has no cycle to pair.
+
+    With "cycle", the n-th cycles of the traces are paired, and the shorter trace is padded
+    at the end. With "status", the runs of each status are matched between the traces (in
+    order, as the longest common sequence of statuses), and the cycles of each pair of runs
+    are paired from the start of the run, so a phase which takes longer in one trace does
+    not shift the phases after it. Runs which only one of the traces has are kept, unpaired.
+    """
+    assert align in DIFF_ALIGN, f"Unknown alignment {align}"
+    if align == "cycle":
+        return _pair_runs([(0, len(label_ids_a))], [(0, len(label_ids_b))])
+
+    runs_a = status_runs(label_ids_a)
+    runs_b = status_runs(label_ids_b)
+    names_a = [label_names_a[label_ids_a[x[0]]] for x in runs_a]
+    names_b = [label_names_b[label_ids_b[x[0]]] for x in runs_b]
+
+    pairs = []
+    for tag, a0, a1, b0, b1 in SequenceMatcher(None, names_a, names_b, autojunk=False).get_opcodes():
+        if tag == "equal":
+            pairs += zip(runs_a[a0:a1], runs_b[b0:b1])
+        else:
+            pairs += [(x, None) for x in runs_a[a0:a1]] + [(None, x) for x in runs_b[b0:b1]]
+
+    return _pair_runs([x[0] for x in pairs], [x[1] for x in pairs])
+
+
+def aligned_labels(index_a, index_b, label_ids_a, label_names_a, label_ids_b, label_names_b):
+    """
+    Status of each aligned cycle, as (label ids, label names): the status of the traces
+    if it is the same, and "<status a> | <status b>" if it differs
+    """
+    ids_a = np.where(index_a >= 0, label_ids_a[np.maximum(index_a, 0)], -1)
+    ids_b = np.where(index_b >= 0, label_ids_b[np.maximum(index_b, 0)], -1)
+
+    pairs, label_ids = np.unique(np.stack([ids_a, ids_b], axis=1), axis=0, return_inverse=True)
+    names = []
+    for a, b in pairs.tolist():
+        name_a = label_names_a[a] if a >= 0 else NO_STATUS
+        name_b = label_names_b[b] if b >= 0 else NO_STATUS
+        names.append(name_a if name_a == name_b else f"{name_a} | {name_b}")
+
+    return label_ids.reshape(-1).astype(np.int32), names
+
+
+def activity_diff_blocks(values_a, values_b, index_a, index_b, window, rows, block=DIFF_BLOCK):
+    """
+    Difference in activity of each net between the traces at each of `rows` (aligned
+    cycles in order, such as the last cycle of each frame): the number of toggles of the
+    net in trace b minus that in trace a over the `window` aligned cycles up to the row,
+    per cycle, in [-1, 1] and positive where b is more active. Computed over blocks of
+    aligned cycles, carrying only the running totals of the last `window` cycles from one
+    block to the next, and yields (first row, (rows of the block x nets) float64) for each
+    block in order.
+    """
+    nets = values_a.shape[1]
+    assert values_b.shape[1] == nets
+    block_cycles = max(block // max(nets, 1), 1)
+    rows = np.asarray(rows)
+
+    # Running total of the toggles of b minus those of a before each aligned cycle, from
+    # aligned cycle `first_total` on
+    totals = np.zeros((1, nets), dtype=np.int32)
+    first_total = 0
+    first_row = 0
+
+    for start in range(0, len(index_a), block_cycles):
+        end = min(start + block_cycles, len(index_a))
+
+        delta = np.zeros((end - start, nets), dtype=np.int8)
+        for values, index, sign in [(values_a, index_a, -1), (values_b, index_b, 1)]:
+            # Unpaired cycles (-1) and the first cycle of a trace never toggle
+            index = index[start:end]
+            changed = np.asarray(values[np.maximum(index, 0)]) != np.asarray(values[np.maximum(index - 1, 0)])
+            changed &= (index > 0)[:, None]
+            delta += sign * changed.view(np.int8)
+
+        totals = np.concatenate((totals, totals[-1] + np.cumsum(delta, axis=0, dtype=np.int32)))
+
+        last_row = np.searchsorted(rows, end)
+        block_rows = rows[first_row:last_row]
+        yield first_row, (totals[block_rows + 1 - first_total] -
+                          totals[np.maximum(block_rows + 1 - window, 0) - first_total]) / window
+        first_row = last_row
+
+        keep = max(end + 1 - window, 0)
+        totals = totals[keep - first_total:].copy()
+        first_total = keep
+
+
+def write_diff_csv(path, summary_a, summary_b, cells, cell_columns, cell_nets):
+    """
+    Write one row per cell (name, type, bbox) of `cells` with the toggles of its output
+    net (column `cell_columns[i]`, -1 if it was not sampled) in the ActivitySummary of
+    each trace, and the change in toggles per cycle from a to b. Rows are sorted by how
+    much the toggle rate changed (either way), most first, then cells without activity.
+    """
+    header = ["instance", "cell_type", "net", "toggles_a", "toggles_b", "toggles_per_cycle_a", "toggles_per_cycle_b",
+              "rate_change", "relative_change"]
+
+    rate_a = summary_a.toggles / max(summary_a.cycles - 1, 1)
+    rate_b = summary_b.toggles / max(summary_b.cycles - 1, 1)
+    change = rate_b - rate_a
+
+    order = sorted(range(len(cells)), key=lambda i: (cell_columns[i] < 0,
+                                                     -abs(change[cell_columns[i]]) if cell_columns[i] >= 0 else 0,
+                                                     cells[i][0]))
+
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for i in order:
+            name, cell_type, _ = cells[i]
+            col = cell_columns[i]
+            if col < 0:
+                writer.writerow([name, cell_type, cell_nets[i]] + [""] * (len(header) - 3))
+                continue
+
+            relative = f"{change[col] / rate_a[col]:.6g}" if rate_a[col] > 0 else ""
+            writer.writerow([name, cell_type, cell_nets[i], int(summary_a.toggles[col]), int(summary_b.toggles[col]),
+                             f"{rate_a[col]:.6g}", f"{rate_b[col]:.6g}", f"{change[col]:.6g}", relative])
@@ -0,0 +1,512 @@
+import mmap
+import struct
+import tempfile
+import zlib
+
+# FST block types
+BL_HDR = 0
+BL_VCDATA = 1
+BL_BLACKOUT = 2
+BL_GEOM = 3
+BL_HIER = 4
+BL_VCDATA_DYN_ALIAS = 5
+BL_HIER_LZ4 = 6
+BL_HIER_LZ4DUO = 7
+BL_VCDATA_DYN_ALIAS2 = 8
+BL_ZWRAPPER = 254
+BL_SKIP = 255
+
+VCDATA_BLOCKS = (BL_VCDATA, BL_VCDATA_DYN_ALIAS, BL_VCDATA_DYN_ALIAS2)
+HIER_BLOCKS = (BL_HIER, BL_HIER_LZ4, BL_HIER_LZ4DUO)
+
+# Hierarchy record tags (anything below ATTRBEGIN is a variable, tagged with its type)
+ST_VCD_SCOPE = 254
+ST_VCD_UPSCOPE = 255
+ST_GEN_ATTRBEGIN = 252
+ST_GEN_ATTREND = 253
+VT_VCD_PORT = 18
+
+# Single-bit values other than 0/1, indexed by bits 1-3 of a value change
+RCV_VALUES = [bytes([x]) for x in b"xzhuwl-?"]
+
+# Geometry length of variable-length (string) signals
+GEOM_VARLEN = 0xFFFFFFFF
+
+# Endianness test value stored in the header
+ENDIAN_TEST = 2.7182818284590452354
+
+
+def _varint(data, pos):
+    val = shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        val |= (b & 0x7F) << shift
+        if b < 0x80:
+            return val, pos
+        shift += 7
+
+
+def _svarint(data, pos):
+    val = shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        val |= (b & 0x7F) << shift
+        shift += 7
+        if b < 0x80:
+            return val - (1 << shift) if b & 0x40 else val, pos
+
+
+def _copy_match(out, dist, length):
+    # LZ77-style copy of `length` bytes starting `dist` bytes back, which may overlap the bytes being written
+    start = len(out) - dist
+    if dist >= length:
+        out += out[start:start+length]
+    else:
+        out += (out[start:] * (length // dist + 1))[:length]
+
+
+def lz4_decompress(src, size):
+    # LZ4 block format, stopping once `size` bytes have been produced
+    out = bytearray()
+    p, n = 0, len(src)
+    while p < n and len(out) < size:
+        token = src[p]
+        p += 1
+
+        length = token >> 4
+        if length == 15:
+            while True:
+                b = src[p]
+                p += 1
+                length += b
+                if b != 255:
+                    break
+        out += src[p:p+length]
+        p += length
+        if p >= n or len(out) >= size:
+            break
+
+        dist = src[p] | (src[p+1] << 8)
+        p += 2
+        length = token & 15
+        if length == 15:
+            while True:
+                b = src[p]
+                p += 1
+                length += b
+                if b != 255:
+                    break
+        _copy_match(out, dist, length + 4)
+
+    assert len(out) >= size, "Truncated LZ4 data in FST file"
+    return bytes(out[:size])
+
+
+def fastlz_decompress(src, size):
+    # FastLZ (level 1 or 2, given by the top bits of the first byte)
+    level = (src[0] >> 5) + 1
+    assert level in (1, 2), "Unknown FastLZ level in FST file"
+
+    out = bytearray()
+    p, n = 1, len(src)
+    ctrl = src[0] & 31
+    while True:
+        if ctrl >= 32:
+            length = (ctrl >> 5) - 1
+            ofs = (ctrl & 31) << 8
+            if length == 6:
+                if level == 1:
+                    length += src[p]
+                    p += 1
+                else:
+                    while True:
+                        b = src[p]
+                        p += 1
+                        length += b
+                        if b != 255:
+                            break
+            code = src[p]
+            p += 1
+            dist = ofs + code + 1
+            if level == 2 and code == 255 and ofs == 31 << 8:
+                dist = (src[p] << 8 | src[p+1]) + 8192
+                p += 2
+            _copy_match(out, dist, length + 3)
+        else:
+            out += src[p:p+ctrl+1]
+            p += ctrl + 1
+
+        if p >= n:
+            break
+        ctrl = src[p]
+        p += 1
+
+    assert len(out) == size, "Corrupted FastLZ data in FST file"
+    return bytes(out)
+
+
+def _zlib_decompress(data, wbits=zlib.MAX_WBITS):
+    # Trailing bytes after the end of the stream are ignored, as in zlib's uncompress
+    return zlib.decompressobj(wbits).decompress(data)
+
+
+class FSTFile:
+    """
+    Reader for GTKWave's FST waveform format. The value changes of each signal are stored
+    in separate (compressed) chains within each block of the file, so only the chains of the
+    requested signals are read and decoded.
+
+    The hierarchy is presented in the same way as a VCD: `variables()` gives the full name,
+    identifier code and width of each variable, and `changes(codes)` produces the value
+    changes of the given identifier codes as lines in VCD syntax, in time order.
+    """
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self.data) > 0 and self.data[0] == BL_ZWRAPPER:
+            # The whole file is gzipped, so it is unpacked to a temporary file first
+            unpacked = tempfile.TemporaryFile()
+            z = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            for pos in range(17, len(self.data), 1 << 20):
+                unpacked.write(z.decompress(self.data[pos:pos + (1 << 20)]))
+            unpacked.write(z.flush())
+            unpacked.flush()
+
+            self.data.close()
+            self.file.close()
+            self.file = unpacked
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.blocks = []    # (type, position of the block's length field) of each block
+        pos = 0
+        while pos + 9 <= len(self.data):
+            kind = self.data[pos]
+            seclen = struct.unpack_from(">Q", self.data, pos + 1)[0]
+            if kind == BL_SKIP or seclen == 0:
+                break
+            self.blocks.append((kind, pos + 1))
+            pos += 1 + seclen
+
+        headers = [pos for kind, pos in self.blocks if kind == BL_HDR]
+        assert len(headers) > 0 and self.blocks[0][0] == BL_HDR, "Not an FST file"
+        pos = headers[0]
+        self.start_time, self.end_time = struct.unpack_from(">QQ", self.data, pos + 8)
+        self.double = "<d" if struct.unpack_from("<d", self.data, pos + 24)[0] == ENDIAN_TEST else ">d"
+        exponent = struct.unpack_from(">b", self.data, pos + 72)[0]
+        self.timescale = f"{10 ** (exponent % 3)}{['s', 'ms', 'us', 'ns', 'ps', 'fs', 'as', 'zs'][-(exponent // 3)]}" \
+            if exponent <= 0 else f"{10 ** exponent}s"
+
+        self.signal_lens = self._read_geometry()
+        self.signal_offsets = [0]
+        for x in self.signal_lens:
+            self.signal_offsets.append(self.signal_offsets[-1] + x)
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        return self.changes()
+
+    def _read_geometry(self):
+        # Length in bytes of each signal's value: the bit width, 8 for reals (marked as 0)
+        # and 0 for variable-length signals
+        geometry = [pos for kind, pos in self.blocks if kind == BL_GEOM]
+        assert len(geometry) > 0, "FST file has no geometry block (was the simulation finished?)"
+
+        pos = geometry[-1]
+        seclen, uclen, maxhandle = struct.unpack_from(">QQQ", self.data, pos)
+        data = self.data[pos+24:pos+seclen]
+        if len(data) != uclen:
+            data = _zlib_decompress(data)
+
+        lens = []
+        self.real = set()
+        p = 0
+        for i in range(maxhandle):
+            val, p = _varint(data, p)
+            if val == 0:
+                lens.append(8)
+                self.real.add(i)
+            else:
+                lens.append(val if val != GEOM_VARLEN else 0)
+        return lens
+
+    def _read_hierarchy(self):
+        hier = [(kind, pos) for kind, pos in self.blocks if kind in HIER_BLOCKS]
+        assert len(hier) > 0, "FST file has no hierarchy block"
+
+        kind, pos = hier[-1]
+        seclen, uclen = struct.unpack_from(">QQ", self.data, pos)
+        data = self.data[pos+16:pos+seclen]
+        if kind == BL_HIER:
+            return _zlib_decompress(data, 32 + zlib.MAX_WBITS)
+        elif kind == BL_HIER_LZ4:
+            return lz4_decompress(data, uclen)
+        else:
+            uclen2, p = _varint(data, 0)
+            return lz4_decompress(lz4_decompress(data[p:], uclen2), uclen)
+
+    def variables(self):
+        """
+        (full name, identifier code, bit width) of each variable, in the order they are
+        declared. As in a VCD, aliases of the same signal share their identifier code,
+        and the bit-range (if any) is part of the name.
+        """
+        data = self._read_hierarchy()
+        hier = []
+        handle = 0
+        p = 0
+        while p < len(data):
+            tag = data[p]
+            p += 1
+            if tag == ST_VCD_SCOPE:
+                end = data.index(b"\0", p + 1)
+                hier.append(data[p+1:end].decode())
+                p = data.index(b"\0", end + 1) + 1
+            elif tag == ST_VCD_UPSCOPE:
+                hier.pop()
+            elif tag == ST_GEN_ATTRBEGIN:
+                p = data.index(b"\0", p + 2) + 1
+                _, p = _varint(data, p)
+            elif tag == ST_GEN_ATTREND:
+                pass
+            else:
+                end = data.index(b"\0", p + 1)
+                name = data[p+1:end].decode().replace(" ", "")
+                size, p = _varint(data, end + 1)
+                if tag == VT_VCD_PORT:
+                    size = (size - 2) // 3
+                alias, p = _varint(data, p)
+                if alias == 0:
+                    handle += 1
+                    alias = handle
+                yield ".".join(hier + [name]), b"%d" % alias, size
+
+    def _value_line(self, idx, code, data):
+        # VCD line for a full (initial) value of signal `idx`
+        if idx in self.real:
+            return b"r%r %s" % (struct.unpack(self.double, data)[0], code)
+        elif self.signal_lens[idx] == 1:
+            return data + code
+        else:
+            return b"b" + data + b" " + code
+
+    def changes(self, codes=None):
+        """
+        Lines (in VCD syntax, without newlines) of the timestamps and value changes of the
+        signals with the given identifier codes (all signals if None). A timestamp line
+        is only produced when one of these signals changes.
+        """
+        if codes is None:
+            handles = range(len(self.signal_lens))
+        else:
+            handles = sorted(int(x) - 1 for x in codes)
+        assert all(0 <= i < len(self.signal_lens) for i in handles), "Unknown identifier code"
+
+        last_time = None
+        first = True
+        for kind, pos in self.blocks:
+            if kind not in VCDATA_BLOCKS:
+                continue
+            for time, lines in self._read_block(kind, pos, handles, first):
+                if time != last_time:
+                    yield b"#%d" % time
+                    last_time = time
+                yield from lines
+            first = False
+
+    def _read_block(self, kind, pos, handles, first):
+        # (time, lines) of each timestamp of a value change block at which one of `handles` changes
+        data = self.data
+        seclen, beg_time = struct.unpack_from(">QQ", data, pos)
+
+        # Table of timestamps, at the end of the block
+        tsec_uclen, tsec_clen, tsec_nitems = struct.unpack_from(">QQQ", data, pos + seclen - 24)
+        tdata = data[pos+seclen-24-tsec_clen:pos+seclen-24]
+        if tsec_clen != tsec_uclen:
+            tdata = _zlib_decompress(tdata)
+        times = []
+        time = 0
+        p = 0
+        for _ in range(tsec_nitems):
+            delta, p = _varint(tdata, p)
+            time += delta
+            times.append(time)
+
+        # Values of all signals at the start of the block, which are only needed for the first
+        # block (the later ones carry on from the changes before them)
+        frame_uclen, p = _varint(data, pos + 32)
+        frame_clen, p = _varint(data, p)
+        frame_maxhandle, p = _varint(data, p)
+        frame_lines = {}
+        if first:
+            frame = data[p:p+frame_clen]
+            if frame_clen != frame_uclen:
+                frame = _zlib_decompress(frame)
+
+            for i in handles:
+                if i < frame_maxhandle and self.signal_lens[i] > 0:
+                    value = frame[self.signal_offsets[i]:self.signal_offsets[i+1]]
+                    frame_lines[i] = self._value_line(i, b"%d" % (i + 1), value)
+        p += frame_clen
+
+        _, vc_start = _varint(data, p)
+        packtype = data[vc_start]
+
+        # Index of the chain of value changes of each signal
+        indx_pntr = pos + seclen - 24 - tsec_clen - 8
+        indx_pos = indx_pntr - struct.unpack_from(">Q", data, indx_pntr)[0]
+        offsets, lengths = self._chain_table(kind, data[indx_pos:indx_pntr], indx_pos - vc_start)
+
+        slots = [[] for _ in times]
+        for i in handles:
+            if i >= len(offsets) or offsets[i] == 0:
+                continue
+
+            chain = vc_start + offsets[i]
+            size, p = _varint(data, chain)
+            raw = data[p:chain+lengths[i]]
+            if size == 0:
+                values = raw
+            elif packtype == ord("4"):
+                values = lz4_decompress(raw, size)
+            elif packtype == ord("F"):
+                values = fastlz_decompress(raw, size)
+            else:
+                values = _zlib_decompress(raw)
+
+            changes_at_start = len(slots[0]) if len(times) > 0 and times[0] == beg_time else None
+            self._decode_chain(i, values, slots)
+            if changes_at_start is not None and len(slots[0]) > changes_at_start:
+                # A change at the start of the block gives the signal its value there instead
+                frame_lines.pop(i, None)
+
+        if len(frame_lines) > 0:
+            if len(times) > 0 and times[0] == beg_time:
+                slots[0][:0] = frame_lines.values()
+            else:
+                yield beg_time, list(frame_lines.values())
+
+        for time, lines in zip(times, slots):
+            if len(lines) > 0:
+                yield time, lines
+
+    def _chain_table(self, kind, index, end):
+        # Offset (relative to the start of the value changes, 0 if there are none) and
+        # length of the chain of each signal
+        offsets = []
+        lengths = []
+        aliases = {}
+        prev = None
+        pval = 0
+        prev_alias = None
+
+        p = 0
+        while p < len(index):
+            if kind == BL_VCDATA_DYN_ALIAS2:
+                if index[p] & 1:
+                    val, p = _svarint(index, p)
+                    val >>= 1
+                    if val > 0:
+                        pval += val
+                        if prev is not None:
+                            lengths[prev] = pval - offsets[prev]
+                        prev = len(offsets)
+                        offsets.append(pval)
+                        lengths.append(0)
+                    else:
+                        if val < 0:
+                            prev_alias = -val - 1
+                        if prev_alias is not None:
+                            aliases[len(offsets)] = prev_alias
+                        offsets.append(0)
+                        lengths.append(0)
+                else:
+                    val, p = _varint(index, p)
+                    offsets.extend([0] * (val >> 1))
+                    lengths.extend([0] * (val >> 1))
+            else:
+                val, p = _varint(index, p)
+                if val == 0:
+                    val, p = _varint(index, p)
+                    aliases[len(offsets)] = val - 1
+                    offsets.append(0)
+                    lengths.append(0)
+                elif val & 1:
+                    pval += val >> 1
+                    if prev is not None:
+                        lengths[prev] = pval - offsets[prev]
+                    prev = len(offsets)
+                    offsets.append(pval)
+                    lengths.append(0)
+                else:
+                    offsets.extend([0] * (val >> 1))
+                    lengths.extend([0] * (val >> 1))
+
+        if prev is not None:
+            lengths[prev] = end - offsets[prev]
+        for i, j in sorted(aliases.items()):
+            if j < i:
+                offsets[i], lengths[i] = offsets[j], lengths[j]
+
+        return offsets, lengths
+
+    def _decode_chain(self, i, values, slots):
+        # Add the lines of each value change of signal `i` to the slot of its timestamp
+        code = b"%d" % (i + 1)
+        length = self.signal_lens[i]
+        real = i in self.real
+        t = 0
+        p = 0
+        n = len(values)
+
+        if length == 1:
+            # Most changes are of single-bit signals and fit in one byte, so this is kept tight
+            zero, one = b"0" + code, b"1" + code
+            while p < n:
+                vli = values[p]
+                p += 1
+                if vli >= 0x80:
+                    vli, p = _varint(values, p - 1)
+                if vli & 1:
+                    t += vli >> 4
+                    slots[t].append(RCV_VALUES[(vli >> 1) & 7] + code)
+                else:
+                    t += vli >> 2
+                    slots[t].append(one if vli & 2 else zero)
+            return
+
+        while p < n:
+            vli, p = _varint(values, p)
+            if length == 0:
+                # Variable-length values (strings) are skipped
+                t += vli >> 1
+                size, p = _varint(values, p)
+                p += size
+            elif real:
+                t += vli >> 1
+                if vli & 1:
+                    slots[t].append(b"r%r %s" % (struct.unpack(self.double, values[p:p+8])[0], code))
+                    p += 8
+                else:
+                    p += 1
+            else:
+                t += vli >> 1
+                if vli & 1:
+                    bits = values[p:p+length]
+                    p += length
+                else:
+                    nbytes = (length + 7) // 8
+                    bits = format(int.from_bytes(values[p:p+nbytes], "big"), f"0{nbytes * 8}b")[:length].encode()
+                    p += nbytes
+                slots[t].append(b"b" + bits + b" " + code)
@@ -0,0 +1,377 @@
+import mmap
+import struct
+
+import numpy as np
+
+from chipvis.cache import cached_file_digest, load_cached_arrays, make_key, save_cached_arrays
+
+# GDSII record types used by the placement extractor
+UNITS = 0x03
+STRNAME = 0x06
+ENDSTR = 0x07
+BOUNDARY = 0x08
+PATH = 0x09
+SREF = 0x0A
+AREF = 0x0B
+WIDTH = 0x0F
+XY = 0x10
+ENDEL = 0x11
+SNAME = 0x12
+STRANS = 0x1A
+MAG = 0x1B
+ANGLE = 0x1C
+PATHTYPE = 0x21
+BGNEXTN = 0x30
+ENDEXTN = 0x31
+PROPATTR = 0x2B
+PROPVALUE = 0x2C
+BOX = 0x2D
+
+# Property holding the instance name of each placed cell (as written by OpenLANE/Magic)
+INSTANCE_NAME_PROPERTY = 98
+
+_MPONE = np.array((-1.0, 1.0))
+
+
+def eight_byte_real(data, offset=0):
+    # GDSII excess-64 base-16 real (the same conversion as gdspy, so values match exactly)
+    short1, short2, long3 = struct.unpack_from(">HHL", data, offset)
+    exponent = (short1 & 0x7F00) // 256 - 64
+    mantissa = (((short1 & 0x00FF) * 65536 + short2) * 4294967296 + long3) / 72057594037927936.0
+    if short1 & 0x8000:
+        return -mantissa * 16.0 ** exponent
+    return mantissa * 16.0 ** exponent
+
+
+def _string(data, offset, length):
+    return data[offset:offset+length].rstrip(b"\0").decode("ascii")
+
+
+class Structure:
+    def __init__(self, name):
+        self.name = name
+        self.shapes = []    # (XY data offset, number of points) of each boundary/box
+        self.paths = []     # (XY data offset, number of points, half-width, pathtype, begin extension, end extension)
+        self.refs = []      # (referenced structure, x_reflection, magnification, angle, x, y, {attr: value})
+
+
+class Placement:
+    """
+    Placed cells of the top cell of a GDS: instance name (property 98), cell type and
+    bounding box (x0, y0, x1, y1) of each, plus the bounding box of the top cell
+    """
+    def __init__(self, top_cell, names, cell_types, bboxes, bbox):
+        self.top_cell = top_cell
+        self.names = names
+        self.cell_types = cell_types
+        self.bboxes = bboxes
+        self.bbox = bbox
+        self.key = None     # Key of the checkpoint this was loaded from / saved to, see load_placement
+
+    def cells(self):
+        return list(zip(self.names.tolist(), self.cell_types.tolist(), self.bboxes.tolist()))
+
+    def arrays(self):
+        return {"top_cell": np.array(self.top_cell), "names": self.names, "cell_types": self.cell_types,
+                "bboxes": self.bboxes, "bbox": self.bbox}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(str(arrays["top_cell"]), arrays["names"], arrays["cell_types"], arrays["bboxes"], arrays["bbox"])
+
+
+# Record types that _scan does anything with, everything else (layers, datatypes, text, ...) is skipped
+_HANDLED = [False] * 256
+for _rec_type in [UNITS, STRNAME, ENDSTR, BOUNDARY, PATH, SREF, AREF, WIDTH, XY, ENDEL, SNAME,
+                  STRANS, MAG, ANGLE, PATHTYPE, BGNEXTN, ENDEXTN, PROPATTR, PROPVALUE, BOX]:
+    _HANDLED[_rec_type] = True
+
+
+def _scan(data):
+    """
+    Single pass over the records of a GDS file. Only the outline coordinates of shapes
+    (by offset, not decoded) and the references of each structure are kept.
+    """
+    structures = {}
+    factor = 1.0
+
+    structure = None
+    element = None
+    xy = None
+    attr = None
+
+    # State of the current reference / path element
+    sname = None
+    reflect = False
+    mag = None
+    angle = None
+    x = y = 0
+    props = None
+    path = None
+
+    handled = _HANDLED
+    unpack_from = struct.unpack_from
+
+    pos = 0
+    end = len(data)
+    while pos + 4 <= end:
+        size = (data[pos] << 8) | data[pos+1]
+        if size < 4:
+            # Zero padding after ENDLIB
+            break
+
+        rec_type = data[pos+2]
+        body = pos + 4
+        pos += size
+
+        if not handled[rec_type]:
+            continue
+
+        if rec_type == XY:
+            xy = (body, (size - 4) // 8)
+        elif rec_type == ENDEL:
+            if element == SREF:
+                x, y = unpack_from(">ll", data, xy[0])
+                structure.refs.append((sname, reflect, mag, angle, factor * x, factor * y, props))
+            elif element == PATH:
+                structure.paths.append(xy + path)
+            elif element is not None and xy is not None:
+                structure.shapes.append(xy)
+            element = None
+            xy = None
+        elif rec_type == BOUNDARY or rec_type == BOX:
+            element = rec_type
+        elif rec_type == SREF:
+            element = rec_type
+            reflect = False
+            mag = None
+            angle = None
+            props = {}
+        elif rec_type == SNAME:
+            sname = _string(data, body, size - 4)
+        elif rec_type == STRANS:
+            reflect = (data[body] & 0x80) > 0
+        elif rec_type == PROPATTR:
+            attr = unpack_from(">h", data, body)[0]
+        elif rec_type == PROPVALUE:
+            if element == SREF:
+                props[attr] = _string(data, body, size - 4)
+        elif rec_type == MAG:
+            mag = eight_byte_real(data, body)
+        elif rec_type == ANGLE:
+            angle = eight_byte_real(data, body)
+        elif rec_type == PATH:
+            element = rec_type
+            path = (0.0, 0, 0.0, 0.0)
+        elif rec_type == WIDTH:
+            if element == PATH:
+                path = (factor * abs(unpack_from(">l", data, body)[0]) / 2,) + path[1:]
+        elif rec_type == PATHTYPE:
+            if element == PATH:
+                path = path[:1] + (unpack_from(">h", data, body)[0],) + path[2:]
+        elif rec_type == BGNEXTN or rec_type == ENDEXTN:
+            if element == PATH:
+                i = 2 if rec_type == BGNEXTN else 3
+                path = path[:i] + (factor * unpack_from(">l", data, body)[0],) + path[i+1:]
+        elif rec_type == AREF:
+            assert False, f"Arrays of cells (AREF) are not supported, found in {structure.name}"
+        elif rec_type == STRNAME:
+            name = _string(data, body, size - 4)
+            assert name not in structures, f"Multiple cells with name {name} in GDS"
+            structure = Structure(name)
+            structures[name] = structure
+        elif rec_type == ENDSTR:
+            structure = None
+        elif rec_type == UNITS:
+            factor = eight_byte_real(data, body)
+
+    return structures, factor
+
+
+def _shapes_bbox(data, shapes, factor):
+    # Bounding box of all shape outlines of a structure, gathered in one go from the raw data
+    if len(shapes) == 0:
+        return None
+
+    offsets = np.array([x[0] for x in shapes], dtype=np.int64)
+    counts = np.array([x[1] for x in shapes], dtype=np.int64)
+
+    nbytes = counts * 8
+    starts = np.repeat(offsets - np.concatenate([[0], np.cumsum(nbytes)[:-1]]), nbytes)
+    raw = np.frombuffer(data, dtype=np.uint8)[starts + np.arange(nbytes.sum())]
+    points = factor * raw.view(">i4").reshape(-1, 2).astype(np.int64)
+
+    return (points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max())
+
+
+def _path_bbox(data, path, factor):
+    """
+    Bounding box of a path's outline: the sides of each segment, mitered joins and the
+    ends (flush, round, extended by half the width, or by the given extensions)
+    """
+    offset, count, half_width, pathtype, bgnextn, endextn = path
+    points = factor * np.frombuffer(data, dtype=">i4", count=2*count, offset=offset).reshape(-1, 2).astype(np.int64)
+
+    if len(points) < 2 or half_width == 0:
+        return (points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max())
+
+    directions = np.diff(points, axis=0)
+    lengths = np.hypot(directions[:, 0], directions[:, 1])
+    directions = directions[lengths > 0] / lengths[lengths > 0, None]
+    if len(directions) == 0:
+        return (points[:, 0].min() - half_width, points[:, 1].min() - half_width,
+                points[:, 0].max() + half_width, points[:, 1].max() + half_width)
+
+    normals = np.stack([-directions[:, 1], directions[:, 0]], axis=1) * half_width
+
+    start, end = points[0].copy(), points[-1].copy()
+    if pathtype == 2:
+        start -= directions[0] * half_width
+        end += directions[-1] * half_width
+    elif pathtype == 4:
+        start -= directions[0] * bgnextn
+        end += directions[-1] * endextn
+
+    outline = [start + normals[0], start - normals[0], end + normals[-1], end - normals[-1]]
+    if pathtype == 1:
+        outline += [start - half_width, start + half_width, end - half_width, end + half_width]
+
+    points = points[np.concatenate([[True], lengths > 0])]
+    for i in range(1, len(points) - 1):
+        n0, n1 = normals[i-1], normals[i]
+        outline += [points[i] + n0, points[i] - n0, points[i] + n1, points[i] - n1]
+
+        # Miter at the join, unless the turn is too sharp (then it is beveled)
+        cos_turn = np.dot(n0, n1) / half_width**2
+        if cos_turn > -0.5:
+            miter = (n0 + n1) / (1 + cos_turn)
+            outline += [points[i] + miter, points[i] - miter]
+
+    outline = np.array(outline)
+    return (outline[:, 0].min(), outline[:, 1].min(), outline[:, 0].max(), outline[:, 1].max())
+
+
+def transform_bboxes(bboxes, reflect, mag, angle, origin):
+    """
+    Bounding boxes of references (N x 4) from the bounding boxes of the referenced cells,
+    transformed in the same way as gdspy (reflection, magnification, rotation, translation)
+    """
+    points = bboxes.reshape(-1, 2, 2).astype(np.float64)
+    reflection = np.ones((len(points), 1, 2))
+    reflection[reflect, 0, 1] = -1.0
+    points = points * reflection
+    points = points * mag[:, None, None]
+
+    cardinal = (angle % 90) == 0
+    if not np.all(cardinal):
+        # Non-cardinal rotations need all 4 corners (gdspy uses the flattened polygons here)
+        corners = np.stack([points[:, 0], points[:, 1], np.stack([points[:, 0, 0], points[:, 1, 1]], axis=1),
+                            np.stack([points[:, 1, 0], points[:, 0, 1]], axis=1)], axis=1)
+    else:
+        corners = points
+
+    # Per-angle sin/cos, computed on scalars so that they match gdspy bit for bit
+    ct = np.empty(len(angle))
+    st = np.empty(len(angle))
+    for a in np.unique(angle):
+        ct[angle == a] = np.cos(a * np.pi / 180.0)
+        st[angle == a] = np.sin(a * np.pi / 180.0)
+
+    corners = corners * ct[:, None, None] + corners[:, :, ::-1] * (st[:, None] * _MPONE[None, :])[:, None, :]
+    corners = corners + origin[:, None, :]
+
+    return np.concatenate([corners.min(axis=1), corners.max(axis=1)], axis=1)
+
+
+def _structure_bbox(data, structures, name, factor, memo):
+    if name in memo:
+        return memo[name]
+
+    structure = structures[name]
+    boxes = []
+
+    shape_bbox = _shapes_bbox(data, structure.shapes, factor)
+    if shape_bbox is not None:
+        boxes.append(np.array([shape_bbox]))
+
+    for path in structure.paths:
+        boxes.append(np.array([_path_bbox(data, path, factor)]))
+
+    if len(structure.refs) > 0:
+        boxes.append(_refs_bboxes(data, structures, structure.refs, factor, memo))
+
+    bbox = None
+    if len(boxes) > 0:
+        boxes = np.concatenate(boxes)
+        bbox = np.array([boxes[:, 0].min(), boxes[:, 1].min(), boxes[:, 2].max(), boxes[:, 3].max()])
+
+    memo[name] = bbox
+    return bbox
+
+
+def _refs_bboxes(data, structures, refs, factor, memo):
+    # Each referenced cell type's bbox is computed once, then transformed for every placement
+    cell_bboxes = {}
+    for sname in set(x[0] for x in refs):
+        assert sname in structures, f"Referenced cell {sname} is not in the GDS"
+        bbox = _structure_bbox(data, structures, sname, factor, memo)
+        assert bbox is not None, f"Referenced cell {sname} is empty"
+        cell_bboxes[sname] = bbox
+
+    bboxes = np.array([cell_bboxes[x[0]] for x in refs])
+    reflect = np.array([x[1] for x in refs], dtype=bool)
+    mag = np.array([1.0 if x[2] is None else x[2] for x in refs])
+    angle = np.array([0.0 if x[3] is None else x[3] for x in refs])
+    origin = np.array([(x[4], x[5]) for x in refs])
+
+    return transform_bboxes(bboxes, reflect, mag, angle, origin)
+
+
+def read_placement(path):
+    """
+    Extract the placement of the top cell of a GDS file, without building the geometry of
+    the library: each referenced cell type's bounding box is computed once from its shape
+    outlines, and transformed for each of its placements
+    """
+    with open(path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        structures, factor = _scan(data)
+
+        referenced = set(x[0] for s in structures.values() for x in s.refs)
+        top_cells = [name for name in structures if name not in referenced]
+        assert len(top_cells) > 0, "No top cell found in GDS"
+        top = structures[top_cells[0]]
+
+        assert set().union(*[x[6].keys() for x in top.refs]) == {INSTANCE_NAME_PROPERTY}
+
+        memo = {}
+        bbox = _structure_bbox(data, structures, top.name, factor, memo)
+        bboxes = _refs_bboxes(data, structures, top.refs, factor, memo)
+
+        names = np.array([x[6][INSTANCE_NAME_PROPERTY] for x in top.refs], dtype=str)
+        cell_types = np.array([x[0] for x in top.refs], dtype=str)
+
+        del memo, structures
+        data.close()
+
+    return Placement(top.name, names, cell_types, bboxes, bbox)
+
+
+def load_placement(path, build_dir):
+    """
+    Placement of the top cell of the GDS, reusing the table stored in `build_dir` by a
+    previous run on the same file. Returns (placement, whether it came from the cache).
+    """
+    key = make_key("placement", cached_file_digest(build_dir, path))
+
+    arrays = load_cached_arrays(build_dir, "placement", key)
+    if arrays is not None:
+        placement = Placement.from_arrays(arrays)
+        placement.key = key
+        return placement, True
+
+    placement = read_placement(path)
+    save_cached_arrays(build_dir, "placement", key, placement.arrays())
+    placement.key = key
+    return placement, False
@@ -0,0 +1,144 @@
+import cProfile
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# How often the resident set size is sampled while a stage runs
+RSS_SAMPLE_INTERVAL = 0.01
+
+
+def current_rss():
+    # Resident set size of this process in bytes, or None where /proc is not available
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def max_rss():
+    # Peak resident set size of this process so far, in bytes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class _RSSSampler(threading.Thread):
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.peak = current_rss() or 0
+        self.done = threading.Event()
+
+    def run(self):
+        while not self.done.wait(RSS_SAMPLE_INTERVAL):
+            self.peak = max(self.peak, current_rss() or 0)
+
+    def stop(self):
+        self.done.set()
+        self.join()
+        self.peak = max(self.peak, current_rss() or 0)
+        return self.peak
+
+
+class Metrics:
+    """
+    Wall time, CPU time and peak memory of each stage of a run. A stage is measured either
+    with `with metrics.stage(name) as m:`, where `m["items"]` (and `m["unit"]`) can be set
+    to also report the stage's throughput, or between `metrics.start(name)` and
+    `metrics.finish(items=..., unit=...)`. Extra fields set on the record are kept in the
+    report. If `profile_stage` is given, that stage is also run under cProfile and its
+    stats are dumped to `profile_path`.
+    """
+    def __init__(self, profile_stage=None, profile_path=None):
+        self.stages = []
+        self.profile_stage = profile_stage
+        self.profile_path = profile_path
+        self.running = None
+
+    def start(self, name):
+        assert self.running is None, f"Stage {self.running[0]['stage']} is still running"
+        record = {"stage": name, "items": None, "unit": None}
+
+        sampler = _RSSSampler() if current_rss() is not None else None
+        if sampler is not None:
+            sampler.start()
+        rss_start = current_rss()
+
+        profiler = None
+        if name == self.profile_stage:
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        self.running = (record, sampler, rss_start, profiler, time.perf_counter(), time.process_time())
+        return record
+
+    def finish(self, items=None, unit=None, **extra):
+        record, sampler, rss_start, profiler, wall, cpu = self.running
+        self.running = None
+
+        record["wall_s"] = time.perf_counter() - wall
+        record["cpu_s"] = time.process_time() - cpu
+
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(self.profile_path)
+
+        # Without /proc only the peak of the whole process so far is known
+        peak = sampler.stop() if sampler is not None else max_rss()
+        record["peak_rss_mb"] = peak / 2**20
+        record["rss_start_mb"] = rss_start / 2**20 if rss_start is not None else None
+
+        if items is not None:
+            record["items"] = items
+        if unit is not None:
+            record["unit"] = unit
+        record.update(extra)
+
+        if record["items"] is not None and record["wall_s"] > 0:
+            record["rate"] = record["items"] / record["wall_s"]
+        else:
+            record["rate"] = None
+
+        self.stages.append(record)
+        return record
+
+    def add(self, name, wall_s, cpu_s, items=None, unit=None, part_of=None, **extra):
+        # Record a stage which was timed separately, e.g. interleaved with (and so `part_of`) another stage
+        record = {"stage": name, "items": items, "unit": unit, "wall_s": wall_s, "cpu_s": cpu_s,
+                  "peak_rss_mb": None, "rss_start_mb": None, "part_of": part_of}
+        record.update(extra)
+        record["rate"] = items / wall_s if items is not None and wall_s > 0 else None
+        self.stages.append(record)
+        return record
+
+    @contextmanager
+    def stage(self, name):
+        record = self.start(name)
+        try:
+            yield record
+        finally:
+            self.finish()
+
+    def summary(self):
+        """Machine-readable report of all stages, along with the peak memory of the run"""
+        children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        children = children if sys.platform == "darwin" else children * 1024
+        top = [x for x in self.stages if x.get("part_of") is None]
+        return {
+            "stages": self.stages,
+            "wall_s": sum(x["wall_s"] for x in top),
+            "cpu_s": sum(x["cpu_s"] for x in top),
+            "peak_rss_mb": max_rss() / 2**20,
+            "children_peak_rss_mb": children / 2**20,
+        }
+
+    def report(self):
+        lines = [f"{'Stage':<20} {'Wall (s)':>10} {'CPU (s)':>10} {'Peak RSS (MB)':>14}  Throughput"]
+        for x in self.stages:
+            rate = f"{x['rate']:.4g} {x['unit'] or 'items'}/s" if x["rate"] is not None else ""
+            peak = f"{x['peak_rss_mb']:>14.1f}" if x["peak_rss_mb"] is not None else f"{'-':>14}"
+            lines.append(f"{x['stage']:<20} {x['wall_s']:>10.3f} {x['cpu_s']:>10.3f} {peak}  {rate}")
+
+        return "\n".join(lines)
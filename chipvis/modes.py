@@ -0,0 +1,462 @@
+import numpy as np
+
+from chipvis.cache import cache_path, load_cached_arrays, make_key, save_cached_arrays
+from chipvis.store import FileArray, open_array
+
+C_MODE_DIRECT = 0
+C_MODE_DIRECT_FILTER = 1
+C_MODE_CHANGED = 2
+C_MODE_EXP_TIME = 3
+C_MODE_EXP_HEATMAP = 4
+C_MODE_LIN_HEATMAP = 5
+C_MODE_TOGGLES = 6
+C_MODE_GLITCHES = 7
+ALL_MODES = [C_MODE_DIRECT, C_MODE_DIRECT_FILTER, C_MODE_CHANGED,
+             C_MODE_EXP_TIME, C_MODE_EXP_HEATMAP, C_MODE_LIN_HEATMAP,
+             C_MODE_TOGGLES, C_MODE_GLITCHES]
+
+# Modes which produce a brightness in [0, 1] rather than an on/off value
+BRIGHTNESS_MODES = [C_MODE_EXP_TIME, C_MODE_EXP_HEATMAP, C_MODE_LIN_HEATMAP, C_MODE_TOGGLES, C_MODE_GLITCHES]
+
+# Modes which need the number of toggles of each net within each cycle (see sample_vcd)
+TOGGLE_MODES = [C_MODE_TOGGLES, C_MODE_GLITCHES]
+
+# Modes which need the nets which changed between consecutive cycles
+CHANGED_MODES = [C_MODE_CHANGED, C_MODE_EXP_TIME, C_MODE_EXP_HEATMAP, C_MODE_LIN_HEATMAP]
+
+# Parameters which the output of each brightness mode depends on
+MODE_PARAMS = {
+    C_MODE_EXP_TIME: ["exp_decay"],
+    C_MODE_EXP_HEATMAP: ["exp_grow", "exp_decay"],
+    C_MODE_LIN_HEATMAP: ["lin_grow", "lin_decay"],
+    C_MODE_TOGGLES: ["max_toggles"],
+    C_MODE_GLITCHES: ["max_toggles"],
+}
+
+# Number of cycles between the stored states of the modes which depend on the history of
+# the nets, for random access to single frames (see ModeKeyframes)
+KEYFRAME_INTERVAL = 256
+
+# Number of (cycle, net) elements of each block when the modes are computed in blocks of
+# cycles (see mode_blocks), which bounds the memory used by each mode
+MODE_BLOCK = 1 << 22
+
+
+def frame_rows(cycles, cycles_per_frame):
+    # Last cycle of each block of `cycles_per_frame` cycles (the final block may be shorter)
+    return np.minimum(np.arange(cycles_per_frame - 1, cycles + cycles_per_frame - 1, cycles_per_frame), cycles - 1)
+
+
+def direct_filter(values):
+    # Nets which are high on every cycle are masked out
+    return values * ~values.all(axis=0)
+
+
+def changed_nets(values):
+    changed = np.zeros(values.shape, dtype=np.uint8)
+    np.not_equal(values[1:], values[:-1], out=changed[1:].view(bool))
+    return changed
+
+
+def any_changed(changed, rows):
+    # Whether each net changed on any cycle of the block ending at each of `rows`
+    starts = np.concatenate(([0], rows[:-1] + 1))
+    return np.logical_or.reduceat(changed.view(bool), starts, axis=0).view(np.uint8)
+
+
+def exp_time(changed, decay, rows=None):
+    # brightness = decay ** (cycles since the last change), or 0 before the first change.
+    # The powers are built with cumprod so they match repeated multiplication exactly.
+    # Only the given `rows` (cycles) are returned, if any.
+    n = len(changed)
+    powers = np.concatenate(([1.0], np.cumprod(np.full(max(n - 1, 0), decay)), [0.0]))
+
+    cycle = np.arange(n, dtype=np.int32)[:, None]
+    last_change = np.where(changed, cycle, -1)
+    np.maximum.accumulate(last_change, axis=0, out=last_change)
+
+    if rows is not None:
+        cycle = cycle[rows]
+        last_change = last_change[rows]
+
+    age = np.where(last_change >= 0, cycle - last_change, -1)
+    return powers[age]
+
+
+def _clamped_step(cur, changed, grow, decay):
+    prev = cur + 0.5
+    return np.where(changed, np.minimum(grow(prev), 1.5), np.maximum(decay(prev), 0.5)) - 0.5
+
+
+def _clamped_recurrence(changed, grow, decay, rows=None):
+    # Shared single pass for modes 4 and 5: each net's brightness (offset by 0.5) grows on
+    # cycles where it changed and decays otherwise, clamped to [0.5, 1.5]. Only the given
+    # `rows` (cycles) are kept, if any.
+    if rows is None:
+        rows = np.arange(len(changed))
+
+    out = np.zeros((len(rows), changed.shape[1]), dtype=np.float64)
+    changed = changed.view(bool)
+
+    cur = np.zeros(changed.shape[1], dtype=np.float64)
+    j = 0
+    for i in range(len(changed)):
+        if i > 0:
+            cur = _clamped_step(cur, changed[i], grow, decay)
+        if j < len(rows) and rows[j] == i:
+            out[j] = cur
+            j += 1
+
+    return out
+
+
+def _heatmap_steps(exp_grow, exp_decay, lin_grow, lin_decay):
+    # (grow, decay) of modes 4 and 5, for _clamped_step
+    return {
+        C_MODE_EXP_HEATMAP: (lambda x: x * exp_grow, lambda x: x * exp_decay),
+        C_MODE_LIN_HEATMAP: (lambda x: x + lin_grow, lambda x: x - lin_decay),
+    }
+
+
+def exp_heatmap(changed, exp_grow, exp_decay, rows=None):
+    return _clamped_recurrence(changed, lambda x: x * exp_grow, lambda x: x * exp_decay, rows)
+
+
+def lin_heatmap(changed, lin_grow, lin_decay, rows=None):
+    return _clamped_recurrence(changed, lambda x: x + lin_grow, lambda x: x - lin_decay, rows)
+
+
+def toggle_counts(toggles, mode, rows=None):
+    # Number of toggles (mode 6) or glitches (toggles after the first, mode 7) of each net
+    # within each cycle, or summed over the cycles of the frame ending at each of `rows`
+    counts = toggles if mode == C_MODE_TOGGLES else np.maximum(toggles, 1) - 1
+    if rows is None:
+        return counts
+
+    starts = np.concatenate(([0], rows[:-1] + 1))
+    return np.add.reduceat(counts, starts, axis=0, dtype=np.int32)
+
+
+def toggle_brightness(counts, max_toggles):
+    # Counts of `max_toggles` or more are shown at full brightness
+    return np.minimum(counts / max_toggles, 1.0)
+
+
+def max_toggle_counts(toggles, mode, rows=None):
+    # Most toggles (or glitches) of any net in any frame, at least 1
+    return max(int(toggle_counts(toggles, mode, rows).max(initial=0)), 1)
+
+
+def compute_modes(values, modes, exp_grow, exp_decay, lin_grow, lin_decay, cycles_per_frame=1, toggles=None,
+                  max_toggles=None):
+    """
+    Compute the per-frame, per-net data for each of the requested visualization
+    modes from the (cycles x nets) sampled values. Modes which are not requested
+    are never computed.
+
+    With `cycles_per_frame` > 1, each frame covers a block of cycles (see frame_rows):
+    modes 0, 1, 3, 4 and 5 show the state at the last cycle of the block, and mode 2
+    shows the nets which changed on any cycle of the block.
+
+    Modes 6 and 7 show the number of toggles (or glitches) of each net within each frame
+    from the (cycles x nets) `toggles` counted by sample_vcd, relative to `max_toggles`
+    (by default the most in any frame).
+    """
+    out = {}
+    changed = None
+    rows = frame_rows(len(values), cycles_per_frame) if cycles_per_frame > 1 else None
+
+    for mode in modes:
+        if mode in CHANGED_MODES and changed is None:
+            changed = changed_nets(values)
+        if mode in TOGGLE_MODES:
+            assert toggles is not None, f"Mode {mode} needs the toggle counts of the trace"
+
+        if mode == C_MODE_DIRECT:
+            out[mode] = values if rows is None else values[rows]
+        elif mode == C_MODE_DIRECT_FILTER:
+            out[mode] = direct_filter(values) if rows is None else values[rows] * ~values.all(axis=0)
+        elif mode == C_MODE_CHANGED:
+            out[mode] = changed if rows is None else any_changed(changed, rows)
+        elif mode == C_MODE_EXP_TIME:
+            out[mode] = exp_time(changed, exp_decay, rows)
+        elif mode == C_MODE_EXP_HEATMAP:
+            out[mode] = exp_heatmap(changed, exp_grow, exp_decay, rows)
+        elif mode == C_MODE_LIN_HEATMAP:
+            out[mode] = lin_heatmap(changed, lin_grow, lin_decay, rows)
+        elif mode in TOGGLE_MODES:
+            counts = toggle_counts(toggles, mode, rows)
+            out[mode] = toggle_brightness(counts, max_toggles or max(int(counts.max(initial=0)), 1))
+        else:
+            assert False, f"Unknown mode {mode}"
+
+    return out
+
+
+def mode_blocks(values, modes, exp_grow, exp_decay, lin_grow, lin_decay, cycles_per_frame=1, toggles=None,
+                max_toggles=None, block=MODE_BLOCK):
+    """
+    compute_modes over blocks of cycles, for values which do not fit in memory (such as a
+    memory-mapped trace), reading them once (twice for mode 1, and the toggles twice for
+    modes 6 and 7 without `max_toggles`). Yields (first frame, data of the frames of the
+    block by mode) for each block in order. The state of each mode is carried from one
+    block to the next, so the data is the same as that of compute_modes.
+    """
+    cycles, nets = values.shape
+    rows = frame_rows(cycles, cycles_per_frame)
+    block_cycles = max(block // max(nets, 1) // cycles_per_frame, 1) * cycles_per_frame
+    steps = _heatmap_steps(exp_grow, exp_decay, lin_grow, lin_decay)
+
+    if C_MODE_DIRECT_FILTER in modes:
+        all_high = np.ones(nets, dtype=bool)
+        for start in range(0, cycles, block_cycles):
+            all_high &= values[start:start+block_cycles].all(axis=0)
+
+    max_counts = {}
+    for mode in modes:
+        if mode in TOGGLE_MODES:
+            assert toggles is not None, f"Mode {mode} needs the toggle counts of the trace"
+            max_counts[mode] = max_toggles
+            if max_toggles is None:
+                max_counts[mode] = 1
+                for start in range(0, cycles, block_cycles):
+                    local = rows[start // cycles_per_frame:(start + block_cycles - 1) // cycles_per_frame + 1] - start
+                    max_counts[mode] = max(max_counts[mode], max_toggle_counts(
+                        np.asarray(toggles[start:start+block_cycles]), mode, local if cycles_per_frame > 1 else None))
+
+    powers = np.concatenate(([1.0], np.cumprod(np.full(max(cycles - 1, 0), exp_decay)), [0.0]))
+    last_change = np.full(nets, -1, dtype=np.int32)
+    heat = {mode: np.zeros(nets, dtype=np.float64) for mode in steps if mode in modes}
+    prev_row = None
+
+    for start in range(0, cycles, block_cycles):
+        block_values = np.asarray(values[start:start+block_cycles])
+        end = start + len(block_values)
+
+        # Frames which end in this block (all of those which start in it, as blocks are
+        # whole numbers of frames), and their last cycle relative to the block
+        first = start // cycles_per_frame
+        local = rows[first:(end - 1) // cycles_per_frame + 1] - start
+
+        changed = np.zeros(block_values.shape, dtype=np.uint8)
+        np.not_equal(block_values[1:], block_values[:-1], out=changed[1:].view(bool))
+        if prev_row is not None:
+            np.not_equal(block_values[0], prev_row, out=changed[0].view(bool))
+        prev_row = block_values[-1].copy()
+
+        out = {}
+        for mode in modes:
+            if mode == C_MODE_DIRECT:
+                out[mode] = block_values if cycles_per_frame == 1 else block_values[local]
+            elif mode == C_MODE_DIRECT_FILTER:
+                out[mode] = (block_values if cycles_per_frame == 1 else block_values[local]) * ~all_high
+            elif mode == C_MODE_CHANGED:
+                out[mode] = changed if cycles_per_frame == 1 else any_changed(changed, local)
+            elif mode == C_MODE_EXP_TIME:
+                cycle = np.arange(start, end, dtype=np.int32)[:, None]
+                block_last = np.where(changed, cycle, -1)
+                np.maximum(block_last[0], last_change, out=block_last[0])
+                np.maximum.accumulate(block_last, axis=0, out=block_last)
+                last_change = block_last[-1].copy()
+
+                age = np.where(block_last[local] >= 0, cycle[local] - block_last[local], -1)
+                out[mode] = powers[age]
+            elif mode in steps:
+                data = np.zeros((len(local), nets), dtype=np.float64)
+                cur = heat[mode]
+                j = 0
+                for i in range(len(block_values)):
+                    if start + i > 0:
+                        cur = _clamped_step(cur, changed[i], *steps[mode])
+                    if j < len(local) and local[j] == i:
+                        data[j] = cur
+                        j += 1
+                heat[mode] = cur
+                out[mode] = data
+            elif mode in TOGGLE_MODES:
+                counts = toggle_counts(np.asarray(toggles[start:end]), mode, local if cycles_per_frame > 1 else None)
+                out[mode] = toggle_brightness(counts, max_counts[mode])
+            else:
+                assert False, f"Unknown mode {mode}"
+
+        yield first, out
+
+
+def _load_modes_out_of_core(values, modes, build_dir, source_key, cycles_per_frame, toggles, params):
+    # Data of each mode as a memory-mapped .npy file in `build_dir`, computed by mode_blocks
+    # if it is not there yet. Mode 0 with one cycle per frame is the values themselves.
+    assert source_key is not None
+    frames = len(frame_rows(len(values), cycles_per_frame))
+
+    out = {}
+    files = {}
+    for mode in modes:
+        if mode == C_MODE_DIRECT and cycles_per_frame == 1:
+            out[mode] = values
+            continue
+
+        key = make_key("mode", source_key, mode, [params[x] for x in MODE_PARAMS.get(mode, [])], cycles_per_frame)
+        path = cache_path(build_dir, f"mode{mode}", key, "npy")
+        data = open_array(path)
+        if data is not None:
+            out[mode] = data
+        else:
+            dtype = np.float64 if mode in BRIGHTNESS_MODES else values.dtype
+            files[mode] = FileArray(path, (frames, values.shape[1]), dtype)
+
+    cached = sorted(x for x in out.keys() if out[x] is not values)
+
+    if len(files) > 0:
+        for first, data in mode_blocks(values, list(files.keys()), cycles_per_frame=cycles_per_frame, toggles=toggles,
+                                       **params):
+            for mode, f in files.items():
+                f.data[first:first+len(data[mode])] = data[mode]
+
+        for mode, f in files.items():
+            out[mode] = f.finish()
+
+    return out, cached
+
+
+def load_modes(values, modes, build_dir, source_key, cycles_per_frame=1, out_of_core=False, toggles=None, **params):
+    """
+    compute_modes, reusing the data of the brightness modes (the expensive ones) stored in
+    `build_dir` by a previous run on the same values (identified by `source_key`) with the
+    same parameters for that mode and `cycles_per_frame`. The other modes are cheap and always recomputed.
+    Returns (data by mode, modes which came from the cache). Without a `source_key`, nothing is
+    cached.
+
+    With `out_of_core`, the modes are computed in blocks of cycles and the data of every
+    mode is stored in `build_dir` as a .npy file, which is used memory-mapped, so that the
+    memory used does not depend on the number of cycles.
+    """
+    if out_of_core:
+        return _load_modes_out_of_core(values, modes, build_dir, source_key, cycles_per_frame, toggles, params)
+
+    out = {}
+    keys = {}
+
+    for mode in modes:
+        if mode in BRIGHTNESS_MODES and source_key is not None:
+            keys[mode] = make_key("mode", source_key, mode, [params[x] for x in MODE_PARAMS[mode]], cycles_per_frame)
+            arrays = load_cached_arrays(build_dir, f"mode{mode}", keys[mode])
+            if arrays is not None:
+                out[mode] = arrays["data"]
+
+    cached = sorted(out.keys())
+    computed = compute_modes(values, [x for x in modes if x not in out], cycles_per_frame=cycles_per_frame,
+                             toggles=toggles, **params)
+
+    for mode, data in computed.items():
+        if mode in keys:
+            save_cached_arrays(build_dir, f"mode{mode}", keys[mode], {"data": data})
+
+    out.update(computed)
+    return out, cached
+
+
+class ModeKeyframes:
+    """
+    Random access to the per-net data of single frames, giving the same data as
+    compute_modes without computing every frame. Modes 0, 1 and 2 only depend on the
+    values around the frame, and modes 6 and 7 on the toggles of its cycles. For modes 3,
+    4 and 5, the state of each net (cycle of its last change, or heatmap brightness) is
+    stored every `interval` cycles in a single pass over the values, and each frame is
+    computed from the closest keyframe before it, so no more than `interval` cycles are
+    ever replayed.
+    """
+    def __init__(self, values, modes, exp_grow, exp_decay, lin_grow, lin_decay, cycles_per_frame=1, toggles=None,
+                 max_toggles=None, interval=KEYFRAME_INTERVAL):
+        assert interval > 0
+        self.values = values
+        self.toggles = toggles
+        self.modes = modes
+        self.interval = interval
+        self.rows = frame_rows(len(values), cycles_per_frame)
+
+        # Toggle count shown at full brightness by modes 6 and 7
+        self.max_counts = {}
+        for mode in modes:
+            if mode in TOGGLE_MODES:
+                assert toggles is not None, f"Mode {mode} needs the toggle counts of the trace"
+                self.max_counts[mode] = max_toggles or max_toggle_counts(toggles, mode,
+                                                                         self.rows if cycles_per_frame > 1 else None)
+
+        cycles, nets = values.shape
+        self.all_high = values.all(axis=0)
+        self.powers = np.concatenate(([1.0], np.cumprod(np.full(max(cycles - 1, 0), exp_decay)), [0.0]))
+        self.steps = _heatmap_steps(exp_grow, exp_decay, lin_grow, lin_decay)
+
+        # (keyframes x nets) state of each mode at cycles 0, interval, 2 * interval, ...
+        self.keyframes = {}
+        state = {}
+        if C_MODE_EXP_TIME in modes:
+            state[C_MODE_EXP_TIME] = np.full(nets, -1, dtype=np.int32)
+        for mode in [C_MODE_EXP_HEATMAP, C_MODE_LIN_HEATMAP]:
+            if mode in modes:
+                state[mode] = np.zeros(nets, dtype=np.float64)
+
+        count = (cycles - 1) // interval + 1
+        for mode, cur in state.items():
+            self.keyframes[mode] = np.empty((count, nets), dtype=cur.dtype)
+            self.keyframes[mode][0] = cur
+
+        if len(state) > 0:
+            for i in range(1, cycles):
+                changed = values[i] != values[i-1]
+                for mode in state:
+                    if mode == C_MODE_EXP_TIME:
+                        state[mode][changed] = i
+                    else:
+                        state[mode] = _clamped_step(state[mode], changed, *self.steps[mode])
+
+                if i % interval == 0:
+                    for mode, cur in state.items():
+                        self.keyframes[mode][i // interval] = cur
+
+    def __len__(self):
+        return len(self.rows)
+
+    def nbytes(self):
+        return sum(x.nbytes for x in self.keyframes.values())
+
+    def frame(self, mode, index):
+        """
+        Data of frame `index` of `mode`, as the row of compute_modes(...)[mode]
+        """
+        assert mode in self.modes, f"Mode {mode} was not computed"
+        values = self.values
+        row = self.rows[index]
+
+        if mode == C_MODE_DIRECT:
+            return values[row]
+        elif mode == C_MODE_DIRECT_FILTER:
+            return values[row] * ~self.all_high
+        elif mode == C_MODE_CHANGED:
+            # Changes on any cycle since the previous frame (the first cycle never counts as a change)
+            start = max(self.rows[index-1] + 1 if index > 0 else 0, 1)
+            if start > row:
+                return np.zeros(values.shape[1], dtype=np.uint8)
+            return (values[start:row+1] != values[start-1:row]).any(axis=0).view(np.uint8)
+        elif mode in TOGGLE_MODES:
+            start = self.rows[index-1] + 1 if index > 0 else 0
+            counts = toggle_counts(self.toggles[start:row+1], mode).sum(axis=0, dtype=np.int32)
+            return toggle_brightness(counts, self.max_counts[mode])
+
+        key = row // self.interval
+        first = key * self.interval
+        block = values[first:row+1]
+
+        if mode == C_MODE_EXP_TIME:
+            cycle = np.arange(first + 1, row + 1, dtype=np.int32)[:, None]
+            last_change = np.maximum(self.keyframes[mode][key],
+                                     np.where(block[1:] != block[:-1], cycle, -1).max(axis=0, initial=-1))
+            age = np.where(last_change >= 0, row - last_change, -1)
+            return self.powers[age]
+        elif mode in self.steps:
+            cur = self.keyframes[mode][key]
+            for i in range(1, len(block)):
+                cur = _clamped_step(cur, block[i] != block[i-1], *self.steps[mode])
+            return cur.copy() if len(block) == 1 else cur
+        else:
+            assert False, f"Unknown mode {mode}"
@@ -0,0 +1,161 @@
+import json
+import os
+import subprocess
+
+from chipvis.cache import cached_file_digest, load_cached, make_key, save_cached
+from chipvis.cells import read_pin_directions
+from chipvis.verilog import read_netlist
+
+NETLIST_READERS = ["native", "yosys"]
+
+
+def startswithany(string, prefixes):
+    return any(string.startswith(x) for x in prefixes)
+
+
+class Netlist:
+    """
+    Connectivity of the top module of the gate-level netlist, as needed for the
+    visualization
+    """
+    def __init__(self):
+        self.creator = ""
+        self.design_name = ""
+        self.top_ports = {}             # Port name -> (direction, bit)
+        self.top_nets = {}              # Net name -> bit
+        self.phy_cells = {}             # Filler/physical cell instance name -> cell type
+        self.real_cells = {}            # Cell instance name -> (cell type, [(pin, bit)] inputs, [(pin, bit)] outputs)
+        self.cell_to_output_nets = {}   # Cell instance name -> names of the nets driven by it
+        self.output_net_to_cell = {}    # Net name -> name of the cell instance driving it
+
+    @property
+    def output_nets(self):
+        return set(self.output_net_to_cell.keys())
+
+
+def yosys_version():
+    try:
+        return subprocess.run(["yosys", "-V"], capture_output=True, text=True).stdout.strip()
+    except FileNotFoundError:
+        return None
+
+
+def run_yosys(cell_models, gl_netlist, build_dir):
+    design_json = os.path.join(build_dir, "design.json")
+    yosys_log = os.path.join(build_dir, "yosys.log")
+    with open(yosys_log, "w") as log:
+        subprocess.run(["yosys", "-f", "verilog -sv", "-b", "json", "-o", design_json, cell_models, gl_netlist],
+                       stdout=log, check=True)
+
+    with open(design_json) as f:
+        return json.load(f)
+
+
+def process_design(design, ignore_ports, filler_prefixes, phy_prefixes):
+    """
+    Extract the top module's ports, nets and cells from a yosys JSON design, and match
+    each net to the cell which drives it
+    """
+    netlist = Netlist()
+    netlist.creator = design["creator"]
+
+    modules = design["modules"]
+    modules_design = {k: v for k, v in modules.items() if not k.startswith("sky130_")}
+
+    assert len(modules_design.keys()) == 1, f"Expected a single design module, found {list(modules_design.keys())}"
+    netlist.design_name = list(modules_design.keys())[0]
+    top = modules_design[netlist.design_name]
+
+    for name, data in top["ports"].items():
+        if name in ignore_ports:
+            continue
+
+        for i, bit in enumerate(data["bits"]):
+            netlist.top_ports[f"{name}"] = (data["direction"], bit)
+
+    for name, data in top["netnames"].items():
+        if name in ignore_ports:
+            continue
+
+        for i, bit in enumerate(data["bits"]):
+            netlist.top_nets[f"{name}"] = bit
+
+    for name, data in top["cells"].items():
+        if startswithany(name, filler_prefixes + phy_prefixes):
+            assert len(data["port_directions"]) == len(data["connections"])
+            netlist.phy_cells[name] = data["type"]
+
+        else:
+            inputs = []
+            outputs = []
+
+            assert set(data["connections"].keys()) == set(data["port_directions"].keys())
+
+            for pin, net in data["connections"].items():
+                if pin in ignore_ports:
+                    continue
+
+                assert len(net) == 1
+                assert data["port_directions"][pin] in ["input", "output"]
+
+                if data["port_directions"][pin] == "input":
+                    inputs.append((pin, net[0]))
+                else:
+                    outputs.append((pin, net[0]))
+
+            netlist.real_cells[name] = (data["type"], inputs, outputs)
+
+    top_nets_inv = {}
+
+    for k, v in netlist.top_nets.items():
+        if v not in top_nets_inv:
+            top_nets_inv[v] = []
+        top_nets_inv[v].append(k)
+
+    for name, (cell_name, inputs, outputs) in netlist.real_cells.items():
+        netlist.cell_to_output_nets[name] = [net for pin, bit in outputs for net in top_nets_inv.get(bit, [])]
+
+    output_nets = set().union(*netlist.cell_to_output_nets.values())
+
+    cell_to_output_nets_inv = {}
+
+    for k, vv in netlist.cell_to_output_nets.items():
+        for v in vv:
+            if v not in cell_to_output_nets_inv:
+                cell_to_output_nets_inv[v] = []
+            cell_to_output_nets_inv[v].append(k)
+
+    assert all(len(cell_to_output_nets_inv[net]) == 1 for net in output_nets)
+    netlist.output_net_to_cell = {net: cell_to_output_nets_inv[net][0] for net in output_nets}
+
+    return netlist
+
+
+def load_netlist(cell_models, gl_netlist, build_dir, ignore_ports, filler_prefixes, phy_prefixes, reader="native"):
+    """
+    Parse the netlist (with the built-in reader, or with yosys) and process it, reusing the
+    processed result from a previous run (stored in `build_dir`) if the cell models, the
+    netlist, the reader and the options are all unchanged. Returns (netlist, whether it
+    came from the cache).
+    """
+    assert reader in NETLIST_READERS, f"Unknown netlist reader {reader}"
+    assert reader != "yosys" or cell_models, "The yosys netlist reader requires the cell models"
+
+    key = make_key("netlist", cached_file_digest(build_dir, cell_models) if cell_models else None,
+                   cached_file_digest(build_dir, gl_netlist),
+                   yosys_version() if reader == "yosys" else reader, ignore_ports, filler_prefixes, phy_prefixes)
+
+    netlist = load_cached(build_dir, "netlist", key)
+    if netlist is not None:
+        return netlist, True
+
+    if reader == "yosys":
+        design = run_yosys(cell_models, gl_netlist, build_dir)
+    else:
+        pin_directions = read_pin_directions(cell_models) if cell_models else None
+        design = read_netlist(gl_netlist, pin_directions)
+
+    netlist = process_design(design, ignore_ports, filler_prefixes, phy_prefixes)
+
+    save_cached(build_dir, "netlist", key, netlist)
+    return netlist, False
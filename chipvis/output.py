@@ -0,0 +1,270 @@
+import os
+import shutil
+import struct
+import subprocess
+
+import numpy as np
+from PIL import Image, GifImagePlugin
+
+from chipvis.store import npy_header
+
+# Palette index reserved for "unchanged since the previous frame" in GIF delta frames
+TRANSPARENT_INDEX = 255
+
+# ffmpeg encoder options for each video format. Both use 4:2:0 chroma subsampling (for
+# compatibility with players), which needs an even width and height, so frames are padded.
+VIDEO_CODECS = {
+    ".mp4": ["-c:v", "libx264", "-preset", "medium", "-crf", "20", "-pix_fmt", "yuv420p", "-movflags", "+faststart"],
+    ".webm": ["-c:v", "libvpx-vp9", "-crf", "32", "-b:v", "0", "-row-mt", "1", "-pix_fmt", "yuv420p"],
+}
+
+# zlib level of PNG frames: indexed frames compress well even at low levels, which are much faster
+PNG_COMPRESS_LEVEL = 3
+
+OUTPUT_FORMATS = [".gif", ".png", ".npy"] + list(VIDEO_CODECS)
+
+
+class Quantizer:
+    """
+    Maps RGB frames onto a fixed palette (nearest color, at the full 8 bits of each
+    channel). Frames are mostly made of a few thousand colors which repeat from one frame
+    to the next, so the nearest color of each RGB value is only searched for the first
+    time it is seen, and kept in a lookup table over all 2^24 values (as index + 1, so
+    that the pages of the table which are never used are never allocated).
+    """
+    BATCH = 1 << 15
+
+    def __init__(self, palette):
+        palette = np.asarray(palette, dtype=np.int32)
+        assert palette.ndim == 2 and palette.shape[1] == 3 and len(palette) < 256
+        self.palette = palette.astype(np.uint8)
+
+        self.palette_f = palette.astype(np.float32)
+        self.norms = (self.palette_f * self.palette_f).sum(axis=1)
+        self.lut = np.zeros(1 << 24, dtype=np.uint8)
+
+    def _add(self, keys):
+        # Nearest color by |c - p|^2 = |c|^2 - 2 c.p + |p|^2, where |c|^2 does not affect the argmin
+        rgb = np.stack([keys >> 16, (keys >> 8) & 0xff, keys & 0xff], axis=1).astype(np.float32)
+        for i in range(0, len(keys), self.BATCH):
+            dist = self.norms[None, :] - 2 * (rgb[i:i + self.BATCH] @ self.palette_f.T)
+            self.lut[keys[i:i + self.BATCH]] = np.argmin(dist, axis=1) + 1
+
+    def __call__(self, img):
+        keys = (img[..., 0].astype(np.int32) << 16) | (img[..., 1].astype(np.int32) << 8) | img[..., 2]
+        index = self.lut[keys]
+
+        missing = index == 0
+        if missing.any():
+            self._add(np.unique(keys[missing]))
+            index = self.lut[keys]
+
+        index -= 1
+        return index
+
+
+class GifWriter:
+    """
+    Writes an animated GIF incrementally, one frame at a time, so that frames never need
+    to be held in memory. All frames share one global palette, and each frame after the
+    first is stored as the rectangle which changed since the previous frame, with pixels
+    which did not change inside that rectangle made transparent (similar to `gifsicle -O3`).
+    """
+    def __init__(self, filename, quantizer, fps):
+        palette = quantizer.palette
+        assert len(palette) < 256, "One palette entry is reserved for transparency"
+
+        self.quantizer = quantizer
+        self.duration = 1000 / fps
+        self.prev = None
+
+        self.palette_bytes = np.zeros((256, 3), dtype=np.uint8)
+        self.palette_bytes[:len(palette)] = palette
+        self.palette_bytes = self.palette_bytes.tobytes()
+
+        self.f = open(filename, "wb")
+        self.paths = [filename]
+
+    def _write_header(self, width, height):
+        self.f.write(b"GIF89a" + struct.pack("<HHBBB", width, height, 0xf7, 0, 0))
+        self.f.write(self.palette_bytes)
+
+        # Loop forever
+        self.f.write(b"!\xff\x0bNETSCAPE2.0\x03\x01" + struct.pack("<H", 0) + b"\x00")
+
+    def _write_image(self, indices, offset, **params):
+        im = Image.frombuffer("P", (indices.shape[1], indices.shape[0]), np.ascontiguousarray(indices), "raw", "P", 0, 1)
+        im.putpalette(self.palette_bytes)
+
+        # Do not dispose, so that the next (delta) frame is drawn on top of this one
+        for chunk in GifImagePlugin.getdata(im, offset=offset, duration=self.duration, disposal=1, **params):
+            self.f.write(chunk)
+
+    def add(self, frame):
+        indices = self.quantizer(frame)
+
+        if self.prev is None:
+            self._write_header(indices.shape[1], indices.shape[0])
+            self._write_image(indices, (0, 0))
+            self.prev = indices
+            return
+
+        assert indices.shape == self.prev.shape, "All frames must be the same size"
+
+        changed = indices != self.prev
+        rows = np.flatnonzero(changed.any(axis=1))
+        cols = np.flatnonzero(changed.any(axis=0))
+
+        if len(rows) == 0:
+            # Nothing changed, but a frame is still needed to keep the timing
+            r0, r1, c0, c1 = 0, 1, 0, 1
+        else:
+            r0, r1, c0, c1 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+
+        delta = np.where(changed[r0:r1, c0:c1], indices[r0:r1, c0:c1], TRANSPARENT_INDEX).astype(np.uint8)
+        self._write_image(delta, (int(c0), int(r0)), transparency=TRANSPARENT_INDEX)
+
+        self.prev = indices
+
+    def close(self):
+        if self.f is None:
+            return
+
+        self.f.write(b";")
+        self.f.close()
+        self.f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class VideoWriter:
+    """
+    Writes an MP4 (H.264) or WebM (VP9) video by piping raw RGB frames into an ffmpeg
+    process, which encodes them while the next frames are being drawn. Unlike GIF, the
+    colors are not limited to a palette.
+    """
+    def __init__(self, filename, fps, ffmpeg="ffmpeg"):
+        self.ext = os.path.splitext(filename)[1].lower()
+        assert self.ext in VIDEO_CODECS, f"Unsupported video format {self.ext}"
+        assert shutil.which(ffmpeg) is not None, f"{ffmpeg} is needed for {self.ext} output, but was not found"
+
+        self.filename = filename
+        self.fps = fps
+        self.ffmpeg = ffmpeg
+        self.shape = None
+        self.proc = None
+        self.paths = [filename]
+
+    def add(self, frame):
+        if self.proc is None:
+            self.shape = frame.shape
+            cmd = [self.ffmpeg, "-y", "-loglevel", "error",
+                   "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{frame.shape[1]}x{frame.shape[0]}",
+                   "-r", str(self.fps), "-i", "-", "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2"]
+            self.proc = subprocess.Popen(cmd + VIDEO_CODECS[self.ext] + [self.filename], stdin=subprocess.PIPE)
+
+        assert frame.shape == self.shape and frame.dtype == np.uint8, "All frames must be the same size"
+        try:
+            self.proc.stdin.write(np.ascontiguousarray(frame).data)
+        except BrokenPipeError:
+            assert False, f"ffmpeg exited while encoding {self.filename} (see its output above)"
+
+    def close(self):
+        if self.proc is None:
+            return
+
+        self.proc.stdin.close()
+        assert self.proc.wait() == 0, f"ffmpeg failed to encode {self.filename}"
+        self.proc = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class PngSequenceWriter:
+    """
+    Writes each frame as a separate indexed PNG, mapped onto the same palette as GIFs,
+    named <filename without extension>_<frame number>.png (counting from 0)
+    """
+    def __init__(self, filename, quantizer):
+        self.quantizer = quantizer
+        self.pattern = os.path.splitext(filename)[0] + "_{:06d}.png"
+        self.palette_bytes = quantizer.palette.tobytes()
+        self.paths = []
+
+    def add(self, frame):
+        indices = self.quantizer(frame)
+        im = Image.frombuffer("P", (indices.shape[1], indices.shape[0]), np.ascontiguousarray(indices), "raw", "P", 0, 1)
+        im.putpalette(self.palette_bytes)
+
+        path = self.pattern.format(len(self.paths))
+        im.save(path, compress_level=PNG_COMPRESS_LEVEL)
+        self.paths.append(path)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class NpyWriter:
+    """
+    Writes the RGB frames into a single (frames, height, width, 3) uint8 .npy file, which
+    can be opened without loading it with np.load(filename, mmap_mode="r"). Frames are
+    appended as they are drawn, and the header is completed when the writer is closed.
+    """
+    def __init__(self, filename):
+        self.f = open(filename, "wb")
+        self.shape = None
+        self.frames = 0
+        self.paths = [filename]
+
+    def add(self, frame):
+        if self.shape is None:
+            self.shape = frame.shape
+            self.f.write(npy_header((self.frames,) + tuple(self.shape), np.uint8))
+
+        assert frame.shape == self.shape and frame.dtype == np.uint8, "All frames must be the same size"
+        self.f.write(np.ascontiguousarray(frame).data)
+        self.frames += 1
+
+    def close(self):
+        if self.f is None:
+            return
+
+        if self.shape is not None:
+            self.f.seek(0)
+            self.f.write(npy_header((self.frames,) + tuple(self.shape), np.uint8))
+        self.f.close()
+        self.f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_writer(filename, quantizer, fps):
+    """Frame writer for `filename`, chosen by its extension (one of OUTPUT_FORMATS)"""
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == ".gif":
+        return GifWriter(filename, quantizer, fps)
+    elif ext in VIDEO_CODECS:
+        return VideoWriter(filename, fps)
+    elif ext == ".png":
+        return PngSequenceWriter(filename, quantizer)
+    elif ext == ".npy":
+        return NpyWriter(filename)
+    assert False, f"Unsupported output format {ext} (must be one of {', '.join(OUTPUT_FORMATS)})"
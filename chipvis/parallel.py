@@ -0,0 +1,173 @@
+import mmap
+import multiprocessing
+import os
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from chipvis.output import GifWriter
+from chipvis.render import FrameRenderer, LayoutRaster
+
+
+class SharedArrays:
+    """
+    Copies a set of named arrays into shared memory once, so that worker processes can
+    attach to them by name instead of having them pickled for every task. Memory-mapped
+    arrays (such as out-of-core mode data) are not copied, the workers map the same file.
+    """
+    def __init__(self, arrays):
+        self.blocks = []
+        self.descriptors = {}
+
+        for name, arr in arrays.items():
+            # Only whole memory-mapped arrays (not views of them) have a valid offset and shape
+            if isinstance(arr, np.memmap) and isinstance(arr.base, mmap.mmap):
+                self.descriptors[name] = ("file", arr.filename, arr.offset, arr.shape, arr.dtype.str)
+                continue
+
+            arr = np.ascontiguousarray(arr)
+            shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+            np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+
+            self.blocks.append(shm)
+            self.descriptors[name] = ("shm", shm.name, arr.shape, arr.dtype.str)
+
+    def close(self):
+        for shm in self.blocks:
+            shm.close()
+            shm.unlink()
+
+        self.blocks = []
+
+
+def attach_arrays(descriptors):
+    # Returns the attached blocks as well, they must be kept alive while the arrays are in use
+    blocks = []
+    arrays = {}
+
+    for name, (kind, *desc) in descriptors.items():
+        if kind == "file":
+            path, offset, shape, dtype = desc
+            arrays[name] = np.memmap(path, dtype=np.dtype(dtype), mode="r", offset=offset, shape=shape)
+            continue
+
+        shm_name, shape, dtype = desc
+        shm = shared_memory.SharedMemory(name=shm_name)
+        blocks.append(shm)
+        arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+    return blocks, arrays
+
+
+# State of each worker process, set up once by _init_worker (or _init_tile_worker)
+_worker = {}
+
+def _init_worker(descriptors, renderer_params, label_names, brightness):
+    blocks, arrays = attach_arrays(descriptors)
+
+    _worker["blocks"] = blocks
+    _worker["arrays"] = arrays
+    raster = LayoutRaster.from_arrays({x[len("layout_"):]: arrays[x] for x in arrays if x.startswith("layout_")})
+    _worker["renderer"] = FrameRenderer(raster, arrays["cell_columns"], **renderer_params)
+    _worker["label_names"] = label_names
+    _worker["brightness"] = brightness
+
+
+def _render_frames(i):
+    arrays = _worker["arrays"]
+    label = _worker["label_names"][arrays["label_ids"][i]]
+    datasets = [(arrays[f"data_{j}"][i], br) for j, br in enumerate(_worker["brightness"])]
+    return _worker["renderer"].draw_modes(datasets, label)
+
+
+def render_frames(renderer, datasets, label_ids, label_names, jobs=1):
+    """
+    Walks the cycles once, yielding for each cycle the list of rendered frames for every
+    (data, brightness) in `datasets`, where each data array is (cycles x nets). With
+    jobs > 1, frames are drawn by a pool of worker processes which share the layout and
+    the per-cycle data through shared memory. Frames are always yielded in order.
+    """
+    n = len(label_ids)
+    assert all(len(data) == n for data, _ in datasets)
+
+    if jobs <= 1:
+        for i in range(n):
+            yield renderer.draw_modes([(data[i], br) for data, br in datasets], label_names[label_ids[i]])
+        return
+
+    arrays = {"cell_columns": renderer.cell_columns, "label_ids": label_ids}
+    for name, arr in renderer.raster.arrays().items():
+        arrays[f"layout_{name}"] = arr
+    for j, (data, _) in enumerate(datasets):
+        arrays[f"data_{j}"] = data
+
+    shared = SharedArrays(arrays)
+
+    try:
+        initargs = (shared.descriptors, renderer.params(), label_names, [br for _, br in datasets])
+        with multiprocessing.Pool(jobs, initializer=_init_worker, initargs=initargs) as pool:
+            chunksize = max(1, min(16, n // (4 * jobs)))
+            yield from pool.imap(_render_frames, range(n), chunksize=chunksize)
+    finally:
+        shared.close()
+
+
+def _write_tile(pyramid, tile, datasets, n, paths, quantizer, fps):
+    # Draw all `n` frames of one tile of the pyramid and write them to one GIF per dataset
+    level, x, y = tile
+    renderer, crop = pyramid.renderer(level, x, y)
+
+    writers = []
+    for path in paths:
+        path = path.format(level=level, x=x, y=y)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        writers.append(GifWriter(path, quantizer, fps=fps))
+
+    for i in range(n):
+        for writer, (data, brightness) in zip(writers, datasets):
+            writer.add(renderer.draw_layout(data[i], brightness)[crop])
+
+    for writer in writers:
+        writer.close()
+
+    return tile
+
+
+def _init_tile_worker(descriptors, pyramid, brightness, paths, quantizer, fps):
+    blocks, arrays = attach_arrays(descriptors)
+
+    _worker["blocks"] = blocks
+    _worker["datasets"] = [(arrays[f"data_{j}"], br) for j, br in enumerate(brightness)]
+    _worker["tile_args"] = (pyramid, paths, quantizer, fps)
+
+
+def _draw_tile(tile):
+    pyramid, paths, quantizer, fps = _worker["tile_args"]
+    datasets = _worker["datasets"]
+    return _write_tile(pyramid, tile, datasets, len(datasets[0][0]), paths, quantizer, fps)
+
+
+def draw_tiles(pyramid, tiles, datasets, paths, quantizer, fps, jobs=1):
+    """
+    Draw every frame of each (level, x, y) of `tiles` of a TilePyramid for every (data,
+    brightness) in `datasets`, writing the frames of each dataset to one GIF at
+    `paths[j].format(level=level, x=x, y=y)`. With jobs > 1, each tile is drawn by one of
+    a pool of worker processes, which share the per-cycle data through shared memory.
+    Yields each tile once it has been written, in any order.
+    """
+    n = len(datasets[0][0])
+    assert all(len(data) == n for data, _ in datasets)
+
+    if jobs <= 1:
+        for tile in tiles:
+            yield _write_tile(pyramid, tile, datasets, n, paths, quantizer, fps)
+        return
+
+    shared = SharedArrays({f"data_{j}": data for j, (data, _) in enumerate(datasets)})
+
+    try:
+        initargs = (shared.descriptors, pyramid, [br for _, br in datasets], paths, quantizer, fps)
+        with multiprocessing.Pool(jobs, initializer=_init_tile_worker, initargs=initargs) as pool:
+            yield from pool.imap_unordered(_draw_tile, tiles)
+    finally:
+        shared.close()
@@ -0,0 +1,497 @@
+import cv2
+import numpy as np
+
+from chipvis.cache import load_cached_arrays, make_key, save_cached_arrays
+
+# Fixed ids in the cell-id raster. Real cells are numbered from FIRST_CELL_ID upwards,
+# in the order they were passed to rasterize_layout
+ID_BACKGROUND = 0
+ID_CORE = 1
+ID_FILLER = 2
+ID_PHY = 3
+FIRST_CELL_ID = 4
+
+BACKGROUND_COLOR = (0, 0, 0)
+CORE_COLOR = (0xd, 0x14, 0x18)
+ON_COLOR = (0xed, 0x55, 0x3b)
+OFF_COLOR = (0x40, 0x40, 0x40)
+LESS_COLOR = (0x3b, 0x9d, 0xed)
+TEXT_COLOR = (255, 255, 255)
+
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+
+# Value of `brightness` (see make_palette) for signed data, such as activity differences
+SIGNED = "signed"
+
+
+# Most steps of the text scale search in fit_text before it falls back to bisection, and
+# the number of bisection steps
+FIT_TEXT_STEPS = 200
+FIT_TEXT_BISECT_STEPS = 40
+
+# Coverage within this of 0 or 1 is treated as exactly 0 or 1
+COVERAGE_EPS = 1e-6
+
+# Maximum number of (cell, pixel) coverage entries computed at once while rasterizing
+COVERAGE_BATCH = 2**22
+
+
+def cell_pixel_bbox(bbox, scale, img_height):
+    # Cell bbox (in GDS units, y-up) to (row0, row1, col0, col1) in the image (y-down)
+    x0, y0, x1, y1 = int(scale * bbox[0]), int(scale * bbox[1]), int(scale * bbox[2]), int(scale * bbox[3])
+    return (img_height-y1-1), (img_height-y0-1), x0, x1
+
+
+def layout_shape(width, height, scale, postscale=1.0):
+    # (rows, cols) of the whole layout drawn at `scale` and then resized by `postscale`
+    rows, cols = int(scale * height + 1), int(scale * width + 1)
+    return int(np.rint(rows * postscale)), int(np.rint(cols * postscale))
+
+
+def viewport_pixels(viewport, width, height, scale, postscale=1.0):
+    """
+    (x0, y0, x1, y1) region of the layout in GDS units to the (row0, row1, col0, col1)
+    pixels it covers in the whole layout drawn at `scale` and resized by `postscale`
+    (before upscaling, see rasterize_layout)
+    """
+    postscale = min(postscale, 1.0)
+    x0, y0, x1, y1 = viewport
+    rows, cols = layout_shape(width, height, scale, postscale)
+    r0, r1, c0, c1 = cell_pixel_bbox((min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)), scale, int(scale * height + 1))
+    r0, r1, c0, c1 = [int(np.rint(x * postscale)) for x in (r0, r1, c0, c1)]
+    return max(r0, 0), min(r1, rows), max(c0, 0), min(c1, cols)
+
+
+def _axis_coverage(lo, hi, factor, origin, size):
+    a = np.clip(lo * factor - origin, 0, size)
+    b = np.clip(hi * factor - origin, 0, size)
+    first = np.floor(a).astype(np.int64)
+    count = np.where(b > a, np.ceil(b).astype(np.int64) - first, 0)
+    return a, b, first, count
+
+
+def _coverage(rects, factor, origin, shape, batch=COVERAGE_BATCH):
+    """
+    Fraction of each pixel covered by each of the (row0, row1, col0, col1) rectangles,
+    which are scaled by `factor` and offset by -`origin` into an image of `shape`.
+    Yields (rectangle index, flat pixel index, coverage) for every pixel touched, in
+    batches of about `batch` entries.
+    """
+    rects = np.asarray(rects, dtype=np.float64).reshape(-1, 4)
+    ay, by, fy, ny = _axis_coverage(rects[:, 0], rects[:, 1], factor, origin[0], shape[0])
+    ax, bx, fx, nx = _axis_coverage(rects[:, 2], rects[:, 3], factor, origin[1], shape[1])
+
+    n = ny * nx
+    ends = np.cumsum(n)
+    splits = np.searchsorted(ends, np.arange(batch, ends[-1] if len(ends) > 0 else 0, batch), side="right")
+
+    for lo, hi in zip(np.concatenate(([0], splits)), np.concatenate((splits, [len(rects)]))):
+        starts = ends[lo:hi] - n[lo:hi]
+        index = np.repeat(np.arange(lo, hi), n[lo:hi])
+        k = np.arange(len(index)) - np.repeat(starts - starts[:1], n[lo:hi])
+
+        iy = fy[index] + k // nx[index]
+        ix = fx[index] + k % nx[index]
+        wy = np.minimum(by[index], iy + 1) - np.maximum(ay[index], iy)
+        wx = np.minimum(bx[index], ix + 1) - np.maximum(ax[index], ix)
+        yield index, iy * shape[1] + ix, wy * wx
+
+
+def _rect_coverage(rect, factor, origin, shape):
+    # Dense version of _coverage for a single rectangle
+    cover = []
+    for lo, hi, offset, size in [(rect[0], rect[1], origin[0], shape[0]), (rect[2], rect[3], origin[1], shape[1])]:
+        i = np.arange(size)
+        a, b = np.clip(lo * factor - offset, 0, size), np.clip(hi * factor - offset, 0, size)
+        cover.append(np.clip(np.minimum(b, i + 1) - np.maximum(a, i), 0, 1))
+    return np.outer(cover[0], cover[1]).reshape(-1)
+
+
+class LayoutRaster:
+    """
+    The layout drawn at the output resolution, holding the id (see ID_*) of what is drawn
+    at each pixel, so that each frame is a single palette lookup. Real cells are numbered
+    from FIRST_CELL_ID upwards in the order of `cells` (their indices in the list passed
+    to rasterize_layout), which only holds the cells within the raster.
+
+    When drawing at a fraction of the scale, a pixel may be covered by several cells:
+    such pixels are ID_BACKGROUND in `ids` and are instead mixed from the (pixel, id,
+    coverage) entries in `mixed_*`. Likewise, only pixels entirely outside of the layout
+    are in `background_mask`, and pixels partly outside of it are dimmed by `edge_keep`.
+    Frames are resized by `upscale` after drawing them at `postscale`.
+    """
+    def __init__(self, postscale=1.0, upscale=1.0):
+        self.postscale = postscale
+        self.upscale = upscale
+        self.ids = None             # (rows, cols) int32
+        self.cells = None           # (cells,) int64 - index of each real cell drawn
+        self.background_mask = None # (rows, cols) bool
+        self.mixed_pixels = None    # (mixed,) int64 - flat index of each mixed pixel
+        self.mixed_index = None     # (entries,) int64 - index into mixed_pixels of each entry
+        self.mixed_ids = None       # (entries,) int32
+        self.mixed_weights = None   # (entries,) float64
+        self.edge_pixels = None     # (edges,) int64 - flat index of each pixel partly outside the layout
+        self.edge_keep = None       # (edges,) float64
+
+    ARRAYS = ["ids", "cells", "background_mask", "mixed_pixels", "mixed_index", "mixed_ids", "mixed_weights",
+              "edge_pixels", "edge_keep"]
+
+    def arrays(self):
+        out = {x: getattr(self, x) for x in self.ARRAYS}
+        out["postscale"] = np.array(self.postscale)
+        out["upscale"] = np.array(self.upscale)
+        return out
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        raster = cls(arrays["postscale"].item(), arrays["upscale"].item())
+        for x in cls.ARRAYS:
+            setattr(raster, x, arrays[x])
+        return raster
+
+
+def rasterize_layout(real_cells, filler_cells, phy_cells, width, height, scale, postscale=1.0, viewport=None):
+    """
+    Rasterize the layout once (see LayoutRaster) as it would look drawn at `scale` and then
+    resized by `postscale`, but without ever drawing it at `scale`: each pixel is covered
+    by the area of the cells within it. If given, only the (row0, row1, col0, col1)
+    `viewport` of the resulting image is drawn (see viewport_pixels).
+
+    Upscaling (`postscale` > 1) would only draw more pixels than the layout has at
+    `scale`, so in that case the layout is drawn at `scale` and each frame is resized.
+
+    Filler and physical cells are drawn in the same color as the core area, so they only
+    count towards the extent of the core.
+    """
+    upscale = max(postscale, 1.0)
+    postscale = min(postscale, 1.0)
+
+    height_scaled = int(scale * height + 1)
+    rows, cols = layout_shape(width, height, scale, postscale)
+    if viewport is None:
+        viewport = (0, rows, 0, cols)
+
+    r0, r1, c0, c1 = viewport
+    assert 0 <= r0 < r1 <= rows and 0 <= c0 < c1 <= cols
+    shape = (r1 - r0, c1 - c0)
+    origin = (r0, c0)
+    npixels = shape[0] * shape[1]
+
+    all_cells = real_cells + filler_cells + phy_cells
+    top_x0 = min(x0 for name, cell_type, (x0, y0, x1, y1) in all_cells)
+    top_x1 = max(x1 for name, cell_type, (x0, y0, x1, y1) in all_cells)
+    top_y0 = min(y0 for name, cell_type, (x0, y0, x1, y1) in all_cells)
+    top_y1 = max(y1 for name, cell_type, (x0, y0, x1, y1) in all_cells)
+    core = np.array([int(scale * top_y0), int(scale * top_y1), int(scale * top_x0), int(scale * top_x1)])
+
+    assert len(real_cells) + FIRST_CELL_ID < 2**31
+    width_scaled = int(scale * width + 1)
+    rects = np.array([cell_pixel_bbox(bbox, scale, height_scaled) for name, cell_type, bbox in real_cells],
+                     dtype=np.int64).reshape(-1, 4)
+    assert (rects[:, 2] >= 0).all() and (rects[:, 3] < width_scaled).all()
+    assert (rects[:, 0] >= 0).all() and (rects[:, 1] < height_scaled).all()
+
+    # Real cells are drawn over everything else, so the core (and the background) only
+    # covers what is left of each pixel after the real cells
+    core_cover = _rect_coverage(core, postscale, origin, shape)
+    in_core = np.stack([np.maximum(rects[:, 0], core[0]), np.minimum(rects[:, 1], core[1]),
+                        np.maximum(rects[:, 2], core[2]), np.minimum(rects[:, 3], core[3])], axis=1)
+    for _, pix, weight in _coverage(in_core, postscale, origin, shape):
+        core_cover -= np.bincount(pix, weight, minlength=npixels)
+
+    # Pixels entirely covered by one cell are drawn from `ids`, only the entries of cells
+    # partly covering a pixel are kept for mixing
+    ids = np.full(npixels, ID_BACKGROUND, dtype=np.int32)
+    cell_cover = np.zeros(npixels, dtype=np.float64)
+    drawn = np.zeros(len(rects), dtype=bool)
+    partial = []
+
+    full_core = np.flatnonzero(np.clip(core_cover, 0, 1) >= 1 - COVERAGE_EPS)
+    for cell, pix, weight in _coverage(rects, postscale, origin, shape):
+        cell_cover += np.bincount(pix, weight, minlength=npixels)
+        drawn[cell] = True
+
+        full = weight >= 1 - COVERAGE_EPS
+        ids[pix[full]] = FIRST_CELL_ID + cell[full]
+        partial.append((cell[~full], pix[~full], weight[~full]))
+
+    # Cells are numbered by their position in `cells`, which only holds the cells drawn
+    raster = LayoutRaster(postscale, upscale)
+    raster.cells = np.flatnonzero(drawn)
+    local = np.full(len(rects) + FIRST_CELL_ID, -1, dtype=np.int32)
+    local[:FIRST_CELL_ID] = np.arange(FIRST_CELL_ID)
+    local[FIRST_CELL_ID + raster.cells] = FIRST_CELL_ID + np.arange(len(raster.cells))
+    ids = local[ids]
+
+    core_cover = np.clip(core_cover, 0, 1)
+    background = np.clip(1 - core_cover - cell_cover, 0, 1)
+    ids[full_core[ids[full_core] == ID_BACKGROUND]] = ID_CORE
+
+    # Pixels which are not entirely one thing are mixed from everything covering them
+    mixed = (background < 1 - COVERAGE_EPS)
+    mixed[ids != ID_BACKGROUND] = False
+    raster.mixed_pixels = np.flatnonzero(mixed)
+    mixed_index = np.full(npixels, -1, dtype=np.int64)
+    mixed_index[raster.mixed_pixels] = np.arange(len(raster.mixed_pixels))
+
+    entries = []
+    for cell, pix, weight in partial:
+        keep = mixed_index[pix] >= 0
+        entries.append((pix[keep], local[FIRST_CELL_ID + cell[keep]], weight[keep]))
+
+    for cover, cell_id in [(core_cover, ID_CORE), (background, ID_BACKGROUND)]:
+        where = raster.mixed_pixels[cover[raster.mixed_pixels] > COVERAGE_EPS]
+        entries.append((where, np.full(len(where), cell_id, dtype=np.int32), cover[where]))
+
+    pix, local, weight = [np.concatenate(x) for x in zip(*entries)]
+    keep = (mixed_index[pix] >= 0) & (weight > COVERAGE_EPS)
+    raster.mixed_index = mixed_index[pix[keep]]
+    raster.mixed_ids = local[keep]
+    raster.mixed_weights = weight[keep]
+
+    raster.ids = ids.reshape(shape)
+    raster.background_mask = (background >= 1 - COVERAGE_EPS).reshape(shape)
+    raster.edge_pixels = np.flatnonzero((background > COVERAGE_EPS) & (background < 1 - COVERAGE_EPS))
+    raster.edge_keep = 1 - background[raster.edge_pixels]
+    return raster
+
+
+def load_layout(real_cells, filler_cells, phy_cells, width, height, scale, build_dir, source_key,
+                postscale=1.0, viewport=None):
+    """
+    rasterize_layout, reusing the raster stored in `build_dir` by a previous run on the same
+    placement (identified by `source_key`, which must cover how the cells were split into
+    real/filler/physical cells) at the same scale and viewport. Returns (raster, whether
+    it came from the cache).
+    """
+    key = make_key("layout", source_key, width, height, scale, postscale, viewport)
+
+    arrays = load_cached_arrays(build_dir, "layout", key)
+    if arrays is not None:
+        return LayoutRaster.from_arrays(arrays), True
+
+    raster = rasterize_layout(real_cells, filler_cells, phy_cells, width, height, scale, postscale, viewport)
+    save_cached_arrays(build_dir, "layout", key, raster.arrays())
+    return raster, False
+
+
+def blur_kernel(blur, postscale=1.0):
+    """
+    (kernel size, sigma) for cv2.GaussianBlur which blurs an image drawn at `postscale`
+    the same as blurring by `blur` before resizing it by `postscale`
+    """
+    if postscale == 1.0:
+        return blur, 0
+
+    sigma = (0.3 * ((blur - 1) * 0.5 - 1) + 0.8) * postscale
+    return max(int(round(blur * postscale)) | 1, 3), sigma
+
+
+def make_palette(cell_values, brightness=False):
+    """
+    Color table for one frame, indexed by cell-id. `cell_values` holds the value of each
+    real cell's output for this frame (0/1, or a brightness in [0, 1] if `brightness`).
+    With `brightness` = SIGNED, values in [-1, 0) go from OFF_COLOR towards LESS_COLOR and
+    values in (0, 1] towards ON_COLOR.
+    """
+    palette = np.empty((FIRST_CELL_ID + len(cell_values), 3), dtype=np.uint8)
+    palette[ID_BACKGROUND] = BACKGROUND_COLOR
+    palette[ID_CORE] = CORE_COLOR
+    palette[ID_FILLER] = CORE_COLOR
+    palette[ID_PHY] = CORE_COLOR
+
+    on_color = np.array(ON_COLOR, dtype=np.float64)
+    off_color = np.array(OFF_COLOR, dtype=np.float64)
+
+    if brightness == SIGNED:
+        cell_values = np.asarray(cell_values, dtype=np.float64)[:, None]
+        less_color = np.array(LESS_COLOR, dtype=np.float64)
+        palette[FIRST_CELL_ID:] = off_color + np.where(cell_values < 0, off_color - less_color,
+                                                       on_color - off_color) * cell_values
+    elif brightness:
+        palette[FIRST_CELL_ID:] = off_color + (on_color - off_color) * np.asarray(cell_values, dtype=np.float64)[:, None]
+    else:
+        palette[FIRST_CELL_ID:] = np.where(np.asarray(cell_values)[:, None] != 0, on_color, off_color)
+
+    return palette
+
+
+def frame_palette(size=255, signed=False):
+    """
+    Fixed palette covering the colors which appear in rendered frames: the blurred and
+    antialiased mixes of the background, core, cell and text colors. The off -> on ramp
+    (used by the brightness modes) gets a larger share of the entries. With `signed`, the
+    off -> less ramp (see make_palette) is also included and shares those entries.
+    """
+    anchors = [BACKGROUND_COLOR, CORE_COLOR, OFF_COLOR, ON_COLOR, TEXT_COLOR] + ([LESS_COLOR] if signed else [])
+    segments = [(a, b) for i, a in enumerate(anchors) for b in anchors[i+1:]]
+    ramps = [(OFF_COLOR, ON_COLOR), (OFF_COLOR, LESS_COLOR)] if signed else [(OFF_COLOR, ON_COLOR)]
+
+    ramp_steps = size // 4 // len(ramps)
+    steps = (size - len(anchors) - ramp_steps * len(ramps)) // len(segments)
+
+    colors = [np.array(x, dtype=np.float64) for x in anchors]
+    for a, b in segments:
+        n = steps + (ramp_steps if (a, b) in ramps else 0)
+        for t in np.arange(1, n + 1) / (n + 1):
+            colors.append(np.array(a) + (np.array(b) - np.array(a)) * t)
+
+    colors = np.unique(np.round(colors).astype(np.uint8), axis=0)
+    assert len(colors) <= size
+    return colors
+
+
+def fit_text(texts, width, font_thickness_factor, textscale=1.0, font_thickness=4):
+    """
+    Search for the text scale at which the widest of `texts` is just narrower than `width`
+    pixels. Returns (textscale, textheight, font_thickness) for FrameRenderer.set_text.
+
+    The font thickness grows with the scale in whole steps, which can make the width jump
+    over the last few pixels, so if the search has not settled after FIT_TEXT_STEPS steps,
+    the largest scale at which the text fits is found by bisection instead.
+    """
+    def text_width(textscale, font_thickness):
+        return max(cv2.getTextSize(x, FONT, textscale, font_thickness)[0][0] for x in texts)
+
+    # Largest scale seen at which the text fits, and smallest at which it does not
+    lo, hi = 0.0, None
+
+    tw = text_width(textscale, font_thickness)
+    for _ in range(FIT_TEXT_STEPS):
+        if tw <= width and (width - tw) <= 8:
+            break
+        if tw <= width:
+            lo = max(lo, textscale)
+        else:
+            hi = textscale if hi is None else min(hi, textscale)
+
+        textscale -= 0.0001 * (tw - width)
+        font_thickness = int(font_thickness_factor * textscale)
+        tw = text_width(textscale, font_thickness)
+    else:
+        if hi is not None:
+            for _ in range(FIT_TEXT_BISECT_STEPS):
+                mid = (lo + hi) / 2
+                if text_width(mid, int(font_thickness_factor * mid)) <= width:
+                    lo = mid
+                else:
+                    hi = mid
+            textscale = lo
+            font_thickness = int(font_thickness_factor * textscale)
+
+    textheight = max(h+b for (w, h), b in [cv2.getTextSize(x, FONT, textscale, font_thickness) for x in texts])
+
+    return textscale, textheight, font_thickness
+
+
+class FrameRenderer:
+    """
+    Draws frames from the per-net data of a single cycle, given the rasterized layout
+    (see rasterize_layout) and the sampled-value column of each real cell's output net
+    (-1 for cells whose output is not in the VCD). Frames are drawn at the resolution of
+    the raster, so the cost of each frame only depends on the number of pixels drawn.
+
+    Several modes can be drawn for the same cycle at once with draw_modes, in which case
+    the rendered status-text strip is shared between them (strips are cached per label).
+    """
+    def __init__(self, raster, cell_columns, blur=7, textscale=1.0, textheight=50, font_thickness=4):
+        self.raster = raster
+        self.cell_columns = cell_columns
+        self.raster_columns = cell_columns[raster.cells]
+
+        self.blur = blur
+        self.kernel = blur_kernel(blur, raster.postscale)
+        self.set_text(textscale, textheight, font_thickness)
+
+    def set_text(self, textscale, textheight, font_thickness):
+        self.textscale = textscale
+        self.textheight = textheight
+        self.font_thickness = font_thickness
+
+        # Position of the text strip, found from the first frame drawn with these settings
+        self.text_top = None
+        self.pad_color = None
+        self.strips = {}
+
+    def params(self):
+        return dict(blur=self.blur, textscale=self.textscale, textheight=self.textheight,
+                    font_thickness=self.font_thickness)
+
+    def draw_layout(self, frame_data, brightness=False):
+        raster = self.raster
+
+        # Index -1 (cells whose output is not in the VCD) picks up the appended zero
+        cell_values = np.append(frame_data, 0)[self.raster_columns]
+        palette = make_palette(cell_values, brightness=brightness)
+        img = palette[raster.ids]
+
+        if len(raster.mixed_pixels) > 0:
+            colors = palette[raster.mixed_ids] * raster.mixed_weights[:, None]
+            mixed = [np.bincount(raster.mixed_index, colors[:, c], minlength=len(raster.mixed_pixels)) for c in range(3)]
+            img.reshape(-1, 3)[raster.mixed_pixels] = np.clip(np.rint(np.stack(mixed, axis=1)), 0, 255)
+
+        img = cv2.GaussianBlur(img, (self.kernel[0], self.kernel[0]), self.kernel[1])
+        img[raster.background_mask] = 0
+
+        if len(raster.edge_pixels) > 0:
+            flat = img.reshape(-1, 3)
+            flat[raster.edge_pixels] = np.rint(flat[raster.edge_pixels] * raster.edge_keep[:, None])
+
+        if raster.upscale != 1.0:
+            img = cv2.resize(img, None, fx=raster.upscale, fy=raster.upscale)
+
+        return img
+
+    def _locate_text(self, img):
+        self.pad_color = img[-1, -1, :].copy()
+
+        img_padded = np.zeros((img.shape[0] + int(1.3*self.textheight), img.shape[1], img.shape[2]), dtype=img.dtype)
+        img_padded[:img.shape[0], :, :] = img
+        img_padded[img.shape[0]:, :, :] = self.pad_color
+
+        # The text goes just below the bottom edge of the layout. Background pixels are
+        # always black, so this only depends on the layout and can be computed once.
+        tmp = np.mean(img_padded, axis=2)
+        first_nonzero = tmp.any(1).argmax() + 4
+        self.text_top = (~tmp[first_nonzero:].any(1)).argmax() + first_nonzero
+
+    def text_strip(self, label, img_shape):
+        if label not in self.strips:
+            height = img_shape[0] + int(1.3*self.textheight) - self.text_top
+            strip = np.zeros((height, img_shape[1], img_shape[2]), dtype=np.uint8)
+            strip[max(img_shape[0] - self.text_top, 0):, :, :] = self.pad_color
+
+            lab = label
+            if len(lab) < 2:
+                lab = lab + " "
+            cv2.putText(strip, lab, (10, self.textheight), FONT,
+                        self.textscale, TEXT_COLOR, self.font_thickness, cv2.LINE_AA)
+
+            self.strips[label] = strip
+
+        return self.strips[label]
+
+    def draw_modes(self, datasets, label):
+        """
+        Draw one frame for each (frame_data, brightness) in `datasets`, all sharing the
+        same status label
+        """
+        imgs = [self.draw_layout(frame_data, brightness) for frame_data, brightness in datasets]
+
+        if self.text_top is None:
+            self._locate_text(imgs[0])
+
+        strip = self.text_strip(label, imgs[0].shape)
+
+        frames = []
+        for img in imgs:
+            frame = np.empty((self.text_top + strip.shape[0], img.shape[1], img.shape[2]), dtype=np.uint8)
+            frame[:self.text_top] = img[:self.text_top]
+            frame[img.shape[0]:self.text_top] = self.pad_color
+            frame[self.text_top:] = strip
+            frames.append(frame)
+
+        return frames
+
+    def draw(self, frame_data, label, brightness=False):
+        return self.draw_modes([(frame_data, brightness)], label)[0]
@@ -0,0 +1,188 @@
+import json
+import re
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+
+from chipvis.modes import BRIGHTNESS_MODES
+from chipvis.output import PNG_COMPRESS_LEVEL
+
+# Default total size of the encoded frames kept in memory
+FRAME_CACHE_MB = 256
+
+FRAME_PATH = re.compile(r"^/frame/(\d+)/(\d+)\.png$")
+
+INDEX_HTML = """<!DOCTYPE html>
+<html>
+<head><title>chip-vis</title></head>
+<body style="background: #000; color: #fff; font-family: sans-serif">
+<p>
+  Mode <select id="mode"></select>
+  Cycle <input id="cycle" type="number" min="0" value="0" style="width: 8em">
+  <button id="prev">&lt;</button> <button id="next">&gt;</button>
+  <span id="status"></span>
+</p>
+<p><input id="slider" type="range" min="0" value="0" style="width: 100%"></p>
+<img id="frame">
+<script>
+const el = (id) => document.getElementById(id);
+fetch("/info").then((r) => r.json()).then((info) => {
+  for (const mode of info.modes) {
+    el("mode").add(new Option(mode, mode));
+  }
+  el("cycle").max = el("slider").max = info.cycles - 1;
+  el("slider").step = info.cycles_per_frame;
+
+  const show = (cycle) => {
+    cycle = Math.max(0, Math.min(info.cycles - 1, cycle));
+    el("cycle").value = el("slider").value = cycle;
+    el("frame").src = `/frame/${el("mode").value}/${cycle}.png`;
+    el("status").textContent = `(cycle ${info.first_cycle + cycle} after reset)`;
+  };
+  const cycle = () => parseInt(el("cycle").value) || 0;
+
+  el("mode").onchange = () => show(cycle());
+  el("cycle").onchange = () => show(cycle());
+  el("slider").oninput = () => show(parseInt(el("slider").value));
+  el("prev").onclick = () => show(cycle() - info.cycles_per_frame);
+  el("next").onclick = () => show(cycle() + info.cycles_per_frame);
+  show(0);
+});
+</script>
+</body>
+</html>
+"""
+
+
+class FrameCache:
+    """
+    Least-recently-used cache of encoded frames, bounded by their total size in bytes
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.frames = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+    def get(self, key):
+        frame = self.frames.get(key)
+        if frame is None:
+            self.misses += 1
+            return None
+
+        self.frames.move_to_end(key)
+        self.hits += 1
+        return frame
+
+    def put(self, key, frame):
+        if key in self.frames:
+            self.nbytes -= len(self.frames.pop(key))
+
+        # Frames larger than the whole cache are never kept
+        if len(frame) > self.max_bytes:
+            return
+
+        self.frames[key] = frame
+        self.nbytes += len(frame)
+        while self.nbytes > self.max_bytes:
+            _, old = self.frames.popitem(last=False)
+            self.nbytes -= len(old)
+
+
+class FrameServer:
+    """
+    Draws single frames on demand by (mode, cycle), for looking at a few cycles of a long
+    simulation without drawing all of them. The per-net data of each frame comes from
+    a ModeKeyframes, and the frames are kept as PNGs in a FrameCache. Cycles are counted
+    from the first visualized cycle, and with `cycles_per_frame` > 1 the frame which
+    covers the cycle is drawn.
+    """
+    def __init__(self, renderer, keyframes, label_ids, label_names, cycles_per_frame=1, first_cycle=0,
+                 cache_bytes=FRAME_CACHE_MB * 2**20):
+        assert len(label_ids) == len(keyframes)
+        self.renderer = renderer
+        self.keyframes = keyframes
+        self.label_ids = label_ids
+        self.label_names = label_names
+        self.cycles_per_frame = cycles_per_frame
+        self.first_cycle = first_cycle
+        self.cycles = len(keyframes.values)
+        self.cache = FrameCache(cache_bytes)
+
+        # Drawing is not thread-safe (the renderer caches its text strips), so requests are
+        # only handled concurrently while waiting on the network
+        self.lock = threading.Lock()
+
+    def info(self):
+        # Status runs are given as (first cycle, status) instead of the status of every cycle
+        rows = self.keyframes.rows
+        starts = np.flatnonzero(np.diff(self.label_ids, prepend=-1))
+        statuses = [[int(rows[i - 1] + 1 if i > 0 else 0), self.label_names[self.label_ids[i]]] for i in starts]
+
+        return {"modes": self.keyframes.modes, "cycles": self.cycles, "frames": len(self.keyframes),
+                "cycles_per_frame": self.cycles_per_frame, "first_cycle": self.first_cycle, "statuses": statuses,
+                "cache": {"frames": len(self.cache), "mb": self.cache.nbytes / 2**20,
+                          "hits": self.cache.hits, "misses": self.cache.misses}}
+
+    def frame_png(self, mode, cycle):
+        assert 0 <= cycle < self.cycles, f"Cycle {cycle} is outside of the visualized cycles"
+        index = cycle // self.cycles_per_frame
+        key = (mode, index)
+
+        with self.lock:
+            png = self.cache.get(key)
+            if png is None:
+                frame = self.renderer.draw(self.keyframes.frame(mode, index), self.label_names[self.label_ids[index]],
+                                           brightness=mode in BRIGHTNESS_MODES)
+                ok, buf = cv2.imencode(".png", cv2.cvtColor(frame, cv2.COLOR_RGB2BGR),
+                                       [cv2.IMWRITE_PNG_COMPRESSION, PNG_COMPRESS_LEVEL])
+                assert ok
+                png = buf.tobytes()
+                self.cache.put(key, png)
+
+        return png
+
+    def serve(self, port, host="127.0.0.1"):
+        """
+        Serve frames over HTTP until interrupted, at /frame/<mode>/<cycle>.png, along with
+        /info (JSON description of the modes, cycles and statuses) and a simple viewer at /
+        """
+        frames = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def send(self, status, content_type, body):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                path = self.path.split("?")[0]
+                match = FRAME_PATH.match(path)
+
+                if path in ["/", "/index.html"]:
+                    self.send(200, "text/html; charset=utf-8", INDEX_HTML.encode())
+                elif path == "/info":
+                    self.send(200, "application/json", json.dumps(frames.info()).encode())
+                elif match is not None:
+                    mode, cycle = int(match.group(1)), int(match.group(2))
+                    if mode not in frames.keyframes.modes or cycle >= frames.cycles:
+                        self.send(404, "text/plain", b"No such mode or cycle\n")
+                    else:
+                        self.send(200, "image/png", frames.frame_png(mode, cycle))
+                else:
+                    self.send(404, "text/plain", b"Not found\n")
+
+            def log_message(self, format, *args):
+                pass
+
+        with ThreadingHTTPServer((host, port), Handler) as httpd:
+            httpd.serve_forever()
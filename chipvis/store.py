@@ -0,0 +1,112 @@
+import os
+import tempfile
+
+import numpy as np
+
+# Size of the header written at the start of each .npy file, which leaves room for the
+# final shape to be filled in once the number of rows is known
+NPY_HEADER_SIZE = 128
+
+# Number of bytes of rows collected in memory before they are written to the file
+STORE_BLOCK = 1 << 24
+
+
+def npy_header(shape, dtype):
+    header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (np.lib.format.dtype_to_descr(np.dtype(dtype)), tuple(shape))
+    header = header.ljust(NPY_HEADER_SIZE - 10 - 1) + "\n"
+    assert len(header) == NPY_HEADER_SIZE - 10
+    return b"\x93NUMPY\x01\x00" + len(header).to_bytes(2, "little") + header.encode("latin1")
+
+
+def open_array(path, mmap=True):
+    """
+    Load a .npy file written by FileRowBuffer or write_array, memory-mapped (read-only)
+    unless `mmap` is False. Returns None if it does not exist or cannot be read.
+    """
+    if not os.path.isfile(path):
+        return None
+
+    try:
+        return np.load(path, mmap_mode="r" if mmap else None, allow_pickle=False)
+    except Exception:
+        return None
+
+
+def temp_array_path(name):
+    # Path of a new, empty .npy file in the temporary directory of the system, which the caller removes
+    fd, path = tempfile.mkstemp(prefix=f"{name}.", suffix=".npy")
+    os.close(fd)
+    return path
+
+
+def save_array(path, arr):
+    # np.save, through a temporary file so that an incomplete file is never at `path`
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, arr)
+    os.replace(tmp_path, path)
+
+
+class FileRowBuffer:
+    """
+    Same as RowBuffer, but the rows are written to a .npy file in blocks as they are
+    appended, so the memory used does not depend on the number of rows. The file is only
+    moved to `path` once finished, and finish returns it memory-mapped.
+    """
+    def __init__(self, path, width, dtype=np.uint8, block=STORE_BLOCK):
+        self.path = path
+        self.tmp_path = f"{path}.{os.getpid()}.tmp"
+        self.width = width
+        self.dtype = np.dtype(dtype)
+
+        self.block = np.empty((max(block // max(width * self.dtype.itemsize, 1), 1), width), dtype=self.dtype)
+        self.pending = 0
+        self.n = 0
+
+        self.f = open(self.tmp_path, "wb")
+        self.f.write(npy_header((0, width), self.dtype))
+
+    def _write_block(self):
+        self.f.write(self.block[:self.pending].data)
+        self.pending = 0
+
+    def append(self, row):
+        if self.pending == len(self.block):
+            self._write_block()
+
+        self.block[self.pending] = row
+        self.pending += 1
+        self.n += 1
+
+    def clear(self):
+        self.pending = 0
+        self.n = 0
+        self.f.seek(NPY_HEADER_SIZE)
+        self.f.truncate()
+
+    def finish(self):
+        self._write_block()
+        self.f.seek(0)
+        self.f.write(npy_header((self.n, self.width), self.dtype))
+        self.f.close()
+
+        os.replace(self.tmp_path, self.path)
+        return open_array(self.path)
+
+
+class FileArray:
+    """
+    Array of a known shape which is filled in through `data` (memory-mapped for writing)
+    instead of in memory, and moved to `path` as a .npy file by finish, which returns it
+    memory-mapped for reading
+    """
+    def __init__(self, path, shape, dtype):
+        self.path = path
+        self.tmp_path = f"{path}.{os.getpid()}.tmp"
+        self.data = np.lib.format.open_memmap(self.tmp_path, mode="w+", dtype=dtype, shape=tuple(shape))
+
+    def finish(self):
+        self.data.flush()
+        self.data = None
+        os.replace(self.tmp_path, self.path)
+        return open_array(self.path)
@@ -0,0 +1,92 @@
+import csv
+
+import numpy as np
+
+# Number of (cycle, net) elements processed at once, which bounds the memory used for the
+# temporary arrays of each block of cycles
+SUMMARY_BLOCK = 1 << 22
+
+
+class ActivitySummary:
+    """
+    Activity of each net (column of the sampled values) over all cycles of a trace: number
+    of toggles (changes between consecutive cycles), duty cycle (fraction of cycles high),
+    longest idle run (most consecutive cycles without a toggle) and number of toggles in
+    each status phase (a toggle counts towards the status of the cycle it leads into).
+    """
+    def __init__(self, cycles, toggles, duty, longest_idle, phase_toggles):
+        self.cycles = cycles                # Number of cycles summarized
+        self.toggles = toggles              # (nets,) int64
+        self.duty = duty                    # (nets,) float64 - fraction of cycles where the net is high
+        self.longest_idle = longest_idle    # (nets,) int64 - in cycles
+        self.phase_toggles = phase_toggles  # (statuses, nets) int64 - toggles per entry of the label names
+
+
+def activity_summary(values, label_ids, num_labels, block=SUMMARY_BLOCK):
+    """
+    Summarize (cycles x nets) sampled values with the status label of each cycle (indices
+    into a list of `num_labels` names), in a single pass over blocks of cycles
+    """
+    cycles, nets = values.shape
+    rows = max(block // max(nets, 1), 1)
+
+    toggles = np.zeros(nets, dtype=np.int64)
+    longest_idle = np.zeros(nets, dtype=np.int64)
+    phase_toggles = np.zeros((num_labels, nets), dtype=np.int64)
+
+    # Cycle at which the current run without toggles started, for each net
+    run_start = np.zeros(nets, dtype=np.int32)
+
+    for start in range(1, cycles, rows):
+        end = min(start + rows, cycles)
+        changed = values[start:end] != values[start-1:end-1]
+        toggles += changed.sum(axis=0)
+
+        # A toggle at cycle c ends the run which started at the previous toggle (or cycle 0)
+        cycle = np.arange(start, end, dtype=np.int32)[:, None]
+        last = np.where(changed, cycle, 0)
+        np.maximum.accumulate(last, axis=0, out=last)
+        np.maximum(last, run_start, out=last)
+        prev = np.concatenate((run_start[None], last[:-1]))
+        np.maximum(longest_idle, np.where(changed, cycle - prev, 0).max(axis=0), out=longest_idle)
+        run_start = last[-1]
+
+        # Statuses usually last for many cycles, so the toggles are summed over each run of one status first
+        labels = label_ids[start:end]
+        runs = np.flatnonzero(np.diff(labels, prepend=-1))
+        np.add.at(phase_toggles, labels[runs], np.add.reduceat(changed, runs, axis=0, dtype=np.int64))
+
+    np.maximum(longest_idle, cycles - run_start, out=longest_idle)
+    duty = values.sum(axis=0, dtype=np.int64) / max(cycles, 1)
+
+    return ActivitySummary(cycles, toggles, duty, longest_idle, phase_toggles)
+
+
+def write_summary_csv(path, summary, cells, cell_columns, cell_nets, label_names):
+    """
+    Write one row per cell (name, type, bbox) of `cells` with the activity of its output net
+    (column `cell_columns[i]` of the summary, -1 if it was not sampled, in which case the
+    activity is left empty). `cell_nets` is the output net name of each cell. Rows are
+    sorted by the number of toggles, most active first.
+    """
+    header = ["instance", "cell_type", "net", "toggles", "toggles_per_cycle", "duty_cycle", "longest_idle"]
+    header += [f"toggles[{x}]" for x in label_names]
+
+    order = sorted(range(len(cells)), key=lambda i: (cell_columns[i] < 0,
+                                                     -summary.toggles[cell_columns[i]] if cell_columns[i] >= 0 else 0,
+                                                     cells[i][0]))
+    per_cycle = summary.toggles / max(summary.cycles - 1, 1)
+
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for i in order:
+            name, cell_type, _ = cells[i]
+            col = cell_columns[i]
+            if col < 0:
+                writer.writerow([name, cell_type, cell_nets[i]] + [""] * (len(header) - 3))
+                continue
+
+            writer.writerow([name, cell_type, cell_nets[i], int(summary.toggles[col]), f"{per_cycle[col]:.6g}",
+                             f"{summary.duty[col]:.6g}", int(summary.longest_idle[col])]
+                            + summary.phase_toggles[:, col].tolist())
@@ -0,0 +1,302 @@
+import math
+import struct
+
+import numpy as np
+
+# Generator for synthetic designs in the same form as the OpenLANE/SKY130 build products
+# used by chip-vis.py: a flat powered gate-level netlist, a GDS with the placed cells
+# (instance names in property 98) and a VCD of a simulation. No PDK or simulator needed.
+
+SITE_WIDTH = 460    # Placement site / row height of sky130_fd_sc_hd, in GDS database units (nm)
+ROW_HEIGHT = 2720
+CORE_MARGIN = 10 * SITE_WIDTH
+
+# (cell type, input pins, output pin, width in sites)
+LOGIC_CELLS = [
+    ("sky130_fd_sc_hd__inv_1", ["A"], "Y", 3),
+    ("sky130_fd_sc_hd__buf_1", ["A"], "X", 3),
+    ("sky130_fd_sc_hd__nand2_1", ["A", "B"], "Y", 3),
+    ("sky130_fd_sc_hd__nor2_1", ["A", "B"], "Y", 3),
+    ("sky130_fd_sc_hd__xor2_1", ["A", "B"], "X", 7),
+    ("sky130_fd_sc_hd__a21oi_1", ["A1", "A2", "B1"], "Y", 4),
+    ("sky130_fd_sc_hd__o21ai_1", ["A1", "A2", "B1"], "Y", 4),
+]
+FLOP_CELL = ("sky130_fd_sc_hd__dfxtp_1", ["CLK", "D"], "Q", 17)
+FILL_CELLS = [("sky130_fd_sc_hd__fill_8", 8), ("sky130_fd_sc_hd__fill_4", 4),
+              ("sky130_fd_sc_hd__fill_2", 2), ("sky130_fd_sc_hd__fill_1", 1)]
+TAP_CELL = ("sky130_fd_sc_hd__tapvpwrvgnd_1", 1)
+
+POWER_PINS = [("VGND", "VGND"), ("VNB", "VGND"), ("VPB", "VPWR"), ("VPWR", "VPWR")]
+
+STATUS_WIDTH = 8 * 32
+
+
+class SyntheticDesign:
+    """
+    A random flat design: `cells` real cells, each driving its own net, with inputs
+    connected to random other nets. A fraction `flop_ratio` of the cells are flip-flops
+    (clocked directly by clk), and their outputs use escaped names like OpenLANE's
+    register bits. Placement is in rows at the given utilization, with filler cells in
+    the gaps and a tap cell at the start of each row.
+    """
+    def __init__(self, cells, extra_nets=0, flop_ratio=0.1, utilization=0.6, seed=0, name="synth"):
+        rng = np.random.default_rng(seed)
+        self.name = name
+
+        kinds = rng.integers(0, len(LOGIC_CELLS), cells)
+        flops = rng.random(cells) < flop_ratio
+        self.instances = []     # (instance name, cell type, {pin: net}, output net, width in sites)
+        self.nets = []          # Net driven by each real cell, in order
+
+        nflop = 0
+        for i in range(cells):
+            if flops[i]:
+                net = f"\\q[{nflop}]"
+                nflop += 1
+                cell = FLOP_CELL
+            else:
+                net = f"_{i:05d}_"
+                cell = LOGIC_CELLS[kinds[i]]
+            self.nets.append(net)
+            self.instances.append([f"_{i + cells:05d}_", cell[0], cell[1], cell[2], net, cell[3]])
+
+        # Inputs come from random nets (flop clocks from clk)
+        sources = rng.integers(0, cells, (cells, 3))
+        for i, inst in enumerate(self.instances):
+            pins = {}
+            for j, pin in enumerate(inst[2]):
+                pins[pin] = "clk" if pin == "CLK" else self.nets[sources[i, j]]
+            pins[inst[3]] = inst[4]
+            inst[2] = pins
+
+        self.extra_nets = [f"_unused_{i}_" for i in range(extra_nets)]
+        self.placement = self._place(rng, utilization)
+
+    def _place(self, rng, utilization):
+        # Rows of a roughly square core, cells in random order with random gaps
+        total_sites = sum(x[5] for x in self.instances) / utilization
+        row_sites = max(int(math.sqrt(total_sites * ROW_HEIGHT / SITE_WIDTH)), max(x[5] for x in self.instances) + 2)
+
+        order = rng.permutation(len(self.instances))
+        gaps = rng.geometric(utilization, len(order)) - 1
+
+        placed = []     # (instance name, cell type, x, row)
+        row = 0
+        site = 0
+        fill = 0
+
+        def add_fill(row, site, n):
+            nonlocal fill
+            while n > 0:
+                cell_type, width = next(x for x in FILL_CELLS if x[1] <= n)
+                placed.append((f"FILLER_{row}_{fill}", cell_type, site, row))
+                fill += 1
+                site += width
+                n -= width
+
+        def new_row(row):
+            placed.append((f"PHY_{row}", TAP_CELL[0], 0, row))
+            return TAP_CELL[1]
+
+        site = new_row(row)
+        for i, gap in zip(order, gaps):
+            inst = self.instances[i]
+            if site + gap + inst[5] > row_sites:
+                add_fill(row, site, row_sites - site)
+                row += 1
+                site = new_row(row)
+                gap = 0
+
+            add_fill(row, site, gap)
+            site += gap
+            placed.append((inst[0], inst[1], site, row))
+            site += inst[5]
+
+        add_fill(row, site, row_sites - site)
+
+        self.rows = row + 1
+        self.row_sites = row_sites
+        return placed
+
+    @property
+    def die_size(self):
+        return (2 * CORE_MARGIN + self.row_sites * SITE_WIDTH, 2 * CORE_MARGIN + self.rows * ROW_HEIGHT)
+
+    def write_netlist(self, path):
+        with open(path, "w") as f:
+            w = f.write
+            w(f"module {self.name} (VGND, VPWR, clk, rst);\n")
+            w(" inout VGND;\n inout VPWR;\n input clk;\n input rst;\n\n")
+
+            for net in self.nets + self.extra_nets:
+                w(f" wire {_net_ref(net)};\n")
+            w("\n")
+
+            for name, cell_type, _, _ in self._physical():
+                conns = [f"  .{pin}({net})" for pin, net in POWER_PINS]
+                w(f" {cell_type} {name} (\n" + ",\n".join(conns) + ");\n")
+
+            for name, cell_type, pins, _, _, _ in self.instances:
+                conns = [f"  .{pin}({net})" for pin, net in POWER_PINS]
+                conns += [f"  .{pin}({_net_ref(net)})" for pin, net in sorted(pins.items())]
+                w(f" {cell_type} {name} (\n" + ",\n".join(conns) + ");\n")
+
+            w("endmodule\n")
+
+    def _physical(self):
+        return [x for x in self.placement if x[0].startswith("FILLER_") or x[0].startswith("PHY_")]
+
+    def write_cell_models(self, path):
+        # Port declarations only, enough for chip-vis.py to find the pin directions
+        with open(path, "w") as f:
+            cells = [(x[0], x[1], x[2]) for x in LOGIC_CELLS + [FLOP_CELL]]
+            cells += [(x[0], [], None) for x in FILL_CELLS + [TAP_CELL]]
+            for cell_type, inputs, output in cells:
+                pins = ([output] if output else []) + inputs + [x[0] for x in POWER_PINS]
+                f.write(f"module {cell_type} ({', '.join(pins)});\n")
+                if output:
+                    f.write(f"  output {output};\n")
+                for pin in inputs:
+                    f.write(f"  input {pin};\n")
+                for pin, _ in POWER_PINS:
+                    f.write(f"  input {pin};\n")
+                f.write("endmodule\n\n")
+
+    def write_gds(self, path):
+        widths = {x[0]: x[3] for x in LOGIC_CELLS + [FLOP_CELL]}
+        widths.update({x[0]: x[1] for x in FILL_CELLS + [TAP_CELL]})
+
+        with open(path, "wb") as f:
+            w = f.write
+            w(_record(0x00, 0x02, struct.pack(">h", 600)))
+            w(_record(0x01, 0x02, struct.pack(">12h", *([0] * 12))))
+            w(_record(0x02, 0x06, _gds_string(self.name)))
+            w(_record(0x03, 0x05, _gds_real(1e-3) + _gds_real(1e-9)))
+
+            # One structure per cell type, with its outline on the prBoundary layer
+            for cell_type, width in sorted(widths.items()):
+                _write_structure(w, cell_type, [_boundary(235, 4, 0, 0, width * SITE_WIDTH, ROW_HEIGHT)])
+
+            die_w, die_h = self.die_size
+            elements = [_boundary(235, 4, 0, 0, die_w, die_h)]
+            for name, cell_type, site, row in self.placement:
+                x = CORE_MARGIN + site * SITE_WIDTH
+                y = CORE_MARGIN + row * ROW_HEIGHT
+                # Odd rows are flipped (mirrored about the x-axis), as in real placements
+                flip = row % 2 == 1
+                elements.append(_sref(cell_type, x, y + ROW_HEIGHT if flip else y, flip, name))
+
+            _write_structure(w, self.name, elements)
+            w(_record(0x04, 0x00, b""))
+
+    def write_vcd(self, path, cycles, toggle_rate=0.1, reset_cycles=2, phases=4, seed=0, tb="tb", uut="uut"):
+        """
+        Simulation trace: clk with a period of 10 time units, rst for the first
+        `reset_cycles` cycles, then each net toggles with probability `toggle_rate` per
+        cycle (changing just after the rising edge). The status variable cycles through
+        "Reset", then "Phase 1" ... "Phase <phases>".
+        """
+        rng = np.random.default_rng(seed)
+        nets = self.nets + self.extra_nets
+
+        ids = [_vcd_id(i + 3) for i in range(len(nets))]
+        state = rng.integers(0, 2, len(nets), dtype=np.uint8)
+        phase_len = max((cycles - reset_cycles) // phases, 1)
+
+        def status(text):
+            bits = bin(int.from_bytes(text.encode(), "big"))[2:]
+            return f"b{bits} {_vcd_id(0)}\n"
+
+        with open(path, "w") as f:
+            w = f.write
+            w("$date\n synthetic\n$end\n$version\n chipvis.synthetic\n$end\n$timescale\n 1ns\n$end\n")
+            w(f"$scope module {tb} $end\n")
+            w(f"$var reg {STATUS_WIDTH} {_vcd_id(0)} status [{STATUS_WIDTH - 1}:0] $end\n")
+            w(f"$scope module {uut} $end\n")
+            w(f"$var wire 1 {_vcd_id(1)} clk $end\n$var wire 1 {_vcd_id(2)} rst $end\n")
+            for net, code in zip(nets, ids):
+                w(f"$var wire 1 {code} {net} $end\n")
+            w("$upscope $end\n$upscope $end\n$enddefinitions $end\n")
+
+            w("#0\n$dumpvars\n" + status("Reset") + f"0{_vcd_id(1)}\n1{_vcd_id(2)}\n")
+            w("".join(f"{v}{code}\n" for v, code in zip(state.tolist(), ids)))
+            w("$end\n")
+
+            for cycle in range(cycles):
+                t = 10 * cycle
+                w(f"#{t + 5}\n1{_vcd_id(1)}\n")
+
+                changes = []
+                if cycle == reset_cycles:
+                    changes.append(f"0{_vcd_id(2)}\n")
+                if cycle >= reset_cycles and (cycle - reset_cycles) % phase_len == 0:
+                    changes.append(status(f"Phase {min((cycle - reset_cycles) // phase_len, phases - 1) + 1}"))
+
+                toggled = np.flatnonzero(rng.random(len(nets)) < toggle_rate)
+                state[toggled] ^= 1
+                changes.extend(f"{v}{ids[i]}\n" for i, v in zip(toggled.tolist(), state[toggled].tolist()))
+
+                if len(changes) > 0:
+                    w(f"#{t + 6}\n" + "".join(changes))
+                w(f"#{t + 10}\n0{_vcd_id(1)}\n")
+
+
+def _net_ref(net):
+    # Escaped identifiers must be terminated by whitespace
+    return net + " " if net.startswith("\\") else net
+
+
+def _vcd_id(i):
+    # Short identifier codes made of the printable characters, as written by simulators
+    s = ""
+    i += 1
+    while i:
+        i, r = divmod(i - 1, 94)
+        s += chr(33 + r)
+    return s
+
+
+def _record(rec_type, data_type, payload):
+    return struct.pack(">HBB", 4 + len(payload), rec_type, data_type) + payload
+
+
+def _gds_string(s):
+    b = s.encode("ascii")
+    return b + b"\0" if len(b) % 2 else b
+
+
+def _gds_real(value):
+    # GDSII excess-64 base-16 real
+    if value == 0:
+        return b"\0" * 8
+    sign = 0x80 if value < 0 else 0
+    value = abs(value)
+    exponent = 64
+    while value >= 1:
+        value /= 16
+        exponent += 1
+    while value < 1 / 16:
+        value *= 16
+        exponent -= 1
+    mantissa = int(round(value * 2**56))
+    return bytes([sign | exponent]) + mantissa.to_bytes(7, "big")
+
+
+def _boundary(layer, datatype, x0, y0, x1, y1):
+    xy = struct.pack(">10l", x0, y0, x1, y0, x1, y1, x0, y1, x0, y0)
+    return (_record(0x08, 0x00, b"") + _record(0x0D, 0x02, struct.pack(">h", layer)) +
+            _record(0x0E, 0x02, struct.pack(">h", datatype)) + _record(0x10, 0x03, xy) + _record(0x11, 0x00, b""))
+
+
+def _sref(cell_type, x, y, flip, name):
+    return (_record(0x0A, 0x00, b"") + _record(0x12, 0x06, _gds_string(cell_type)) +
+            _record(0x1A, 0x01, struct.pack(">H", 0x8000 if flip else 0)) + _record(0x10, 0x03, struct.pack(">2l", x, y)) +
+            _record(0x2B, 0x02, struct.pack(">h", 98)) + _record(0x2C, 0x06, _gds_string(name)) + _record(0x11, 0x00, b""))
+
+
+def _write_structure(w, name, elements):
+    w(_record(0x05, 0x02, struct.pack(">12h", *([0] * 12))))
+    w(_record(0x06, 0x06, _gds_string(name)))
+    for x in elements:
+        w(x)
+    w(_record(0x07, 0x00, b""))
@@ -0,0 +1,82 @@
+import math
+
+from chipvis.render import FrameRenderer, blur_kernel, layout_shape, rasterize_layout, viewport_pixels
+
+# Width and height of each tile, in pixels
+TILE_SIZE = 256
+
+
+class TilePyramid:
+    """
+    The layout split into square tiles at several zoom levels, so that only the tiles
+    which are looked at need to be drawn. Level `levels - 1` is drawn at the full scale
+    and each level below it at half the resolution of the one above. Tiles are numbered
+    (x, y) from the top-left corner of the layout.
+    """
+    def __init__(self, real_cells, filler_cells, phy_cells, width, height, scale, cell_columns, levels,
+                 blur=7, tile_size=TILE_SIZE):
+        self.real_cells = real_cells
+        self.filler_cells = filler_cells
+        self.phy_cells = phy_cells
+        self.width = width
+        self.height = height
+        self.scale = scale
+        self.cell_columns = cell_columns
+        self.levels = levels
+        self.blur = blur
+        self.tile_size = tile_size
+
+        all_cells = real_cells + filler_cells + phy_cells
+        self.extent = (min(x[2][0] for x in all_cells), min(x[2][1] for x in all_cells),
+                       max(x[2][2] for x in all_cells), max(x[2][3] for x in all_cells))
+
+    def postscale(self, level):
+        assert 0 <= level < self.levels
+        return 2.0 ** (level - (self.levels - 1))
+
+    def grid(self, level):
+        # Number of (columns, rows) of tiles at `level`
+        rows, cols = layout_shape(self.width, self.height, self.scale, self.postscale(level))
+        return math.ceil(cols / self.tile_size), math.ceil(rows / self.tile_size)
+
+    def tiles(self, level, viewport=None):
+        """
+        (x, y) of the tiles of `level` which overlap the cells, and the (x0, y0, x1, y1)
+        `viewport` in GDS units if given. The others would only ever show the background
+        (or are not looked at), so they are not drawn.
+        """
+        x0, y0, x1, y1 = self.extent
+        if viewport is not None:
+            x0, y0 = max(x0, min(viewport[0], viewport[2])), max(y0, min(viewport[1], viewport[3]))
+            x1, y1 = min(x1, max(viewport[0], viewport[2])), min(y1, max(viewport[1], viewport[3]))
+            if x0 >= x1 or y0 >= y1:
+                return []
+
+        r0, r1, c0, c1 = viewport_pixels((x0, y0, x1, y1), self.width, self.height, self.scale, self.postscale(level))
+        if r0 >= r1 or c0 >= c1:
+            return []
+
+        x0, x1 = c0 // self.tile_size, (c1 - 1) // self.tile_size
+        y0, y1 = r0 // self.tile_size, (r1 - 1) // self.tile_size
+        return [(x, y) for y in range(y0, y1 + 1) for x in range(x0, x1 + 1)]
+
+    def renderer(self, level, x, y):
+        """
+        FrameRenderer for tile (x, y) of `level`, along with the (row, column) slices of
+        its drawn layout which are the tile. Tiles are drawn with a margin around them, so
+        that the blur is continuous across their edges.
+        """
+        postscale = self.postscale(level)
+        rows, cols = layout_shape(self.width, self.height, self.scale, postscale)
+        margin = blur_kernel(self.blur, postscale)[0] // 2
+
+        r0, c0 = y * self.tile_size, x * self.tile_size
+        r1, c1 = min(r0 + self.tile_size, rows), min(c0 + self.tile_size, cols)
+        assert r0 < r1 and c0 < c1, f"Tile {x}, {y} is outside of level {level}"
+
+        viewport = (max(r0 - margin, 0), min(r1 + margin, rows), max(c0 - margin, 0), min(c1 + margin, cols))
+        raster = rasterize_layout(self.real_cells, self.filler_cells, self.phy_cells, self.width, self.height,
+                                  self.scale, postscale, viewport)
+
+        crop = (slice(r0 - viewport[0], r1 - viewport[0]), slice(c0 - viewport[2], c1 - viewport[2]))
+        return FrameRenderer(raster, self.cell_columns, blur=self.blur), crop
@@ -0,0 +1,473 @@
+import gzip
+import io
+import os
+import string
+import weakref
+from array import array
+from collections import Counter
+
+import numpy as np
+
+from chipvis.cache import (cache_path, cached_file_digest, file_digest, load_cached_arrays, make_key, replace_cached,
+                           save_cached_arrays)
+from chipvis.fst import FSTFile
+from chipvis.store import FileRowBuffer, open_array, save_array, temp_array_path
+
+# Single-bit VCD values, mapped the same way as the old vcdvcd-based int4()
+BIT_VALUES = {b"0": 0, b"1": 1, b"x": 0, b"z": 0, b"X": 0, b"Z": 0}
+
+# Toggle counts of a signal within one cycle saturate at this value, so they fit in a uint8
+TOGGLE_MAX = 255
+
+# Buffer size for reading compressed VCDs, which are much slower to read line-by-line without one
+DECOMPRESS_BUFFER = 1 << 20
+
+
+class VCDHeader:
+    def __init__(self):
+        self.signals = []   # Full signal names, in the order they are declared
+        self.ids = {}       # Full signal name -> identifier code
+        self.sizes = {}     # Full signal name -> bit width
+        self.timescale = ""
+
+
+def open_vcd(path):
+    """
+    Open a trace for reading: a VCD, decompressed as it is read if it ends in .gz or .zst,
+    or an FST file (which is read through FSTFile, see read_header and sample_vcd).
+    """
+    if path.endswith(".fst"):
+        return FSTFile(path)
+    elif path.endswith(".gz"):
+        return io.BufferedReader(gzip.open(path, "rb"), DECOMPRESS_BUFFER)
+    elif path.endswith(".zst"):
+        try:
+            import zstandard
+        except ImportError:
+            assert False, "Reading .zst files requires the zstandard package (pip install zstandard)"
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), read_across_frames=True),
+                                 DECOMPRESS_BUFFER)
+    else:
+        return open(path, "rb")
+
+
+def read_header(f):
+    """
+    Parse the $scope/$var declarations of a VCD file (opened in binary mode),
+    leaving the file positioned just after $enddefinitions. For an FST file, the
+    same information is read from its hierarchy.
+    """
+    header = VCDHeader()
+    hier = []
+
+    if isinstance(f, FSTFile):
+        for name, code, size in f.variables():
+            header.signals.append(name)
+            header.ids[name] = code
+            header.sizes[name] = size
+        header.timescale = f.timescale
+        return header
+
+    tokens = []
+    for line in f:
+        tokens.extend(line.split())
+
+        while b"$end" in tokens:
+            end = tokens.index(b"$end")
+            cmd, body = tokens[0], tokens[1:end]
+            tokens = tokens[end+1:]
+
+            if cmd == b"$enddefinitions":
+                return header
+            elif cmd == b"$scope":
+                hier.append(body[1].decode())
+            elif cmd == b"$upscope":
+                hier.pop()
+            elif cmd == b"$var":
+                # Same naming convention as vcdvcd: the bit-range (if any) is appended to the reference
+                name = "".join(x.decode() for x in body[3:])
+                name = ".".join(hier + [name])
+                header.signals.append(name)
+                header.ids[name] = body[2]
+                header.sizes[name] = int(body[1])
+            elif cmd == b"$timescale":
+                header.timescale = b" ".join(body).decode()
+
+    assert False, "VCD file ended before $enddefinitions"
+
+
+def count_changes(f):
+    """
+    Count the value changes of each identifier code in the rest of a VCD file (opened
+    in binary mode and positioned after the header by read_header), without decoding
+    any values. Initial values from $dumpvars are counted as changes. For an FST file,
+    the changes of all of its signals are decoded instead.
+    Returns (Counter of identifier code -> number of changes, number of timestamps).
+    """
+    counts = Counter()
+    timestamps = 0
+
+    for line in f:
+        c = line[:1]
+        if c in BIT_VALUES:
+            counts[line[1:].rstrip()] += 1
+        elif c == b"b" or c == b"B" or c == b"r" or c == b"R":
+            counts[line.split()[1]] += 1
+        elif c == b"#":
+            timestamps += 1
+
+    return counts, timestamps
+
+
+def decode_status(bits):
+    bits = bits.replace("x", "0").replace("z", "0").replace("X", "0").replace("Z", "0")
+    x = hex(int(bits, 2))[2:]
+    if len(x) % 2 == 1:
+        x = "0" + x
+
+    return "".join(a if a in string.printable else " " for a in bytes.fromhex(x).decode(errors="replace"))
+
+
+class SampledTrace:
+    def __init__(self, signals):
+        self.signals = signals  # Signal names, one per column of `values`
+        self.start_time = 0     # Time at which reset was released
+        self.first_cycle = 0    # Index (counting from reset) of the first cycle in the trace
+        self.reset_cycles = 0   # Number of cycles after reset, including those outside of the window
+        self.start_cycle = -1   # Cycle (counting from reset) at which the start status was first seen, -1 if never
+        self.tick_times = None  # (cycles,) int64 - time of the rising clock edge which ends each cycle
+        self.values = None      # (cycles, signals) uint8 - sampled value (0 or 1) of each signal
+        self.toggles = None     # (cycles, signals) uint8 - number of changes of each signal during each cycle, if counted
+        self.label_ids = None   # (cycles,) int32 - index into `label_names` for each cycle
+        self.label_names = []   # Distinct decoded status strings of the stored cycles, in order of first appearance
+        self.key = None         # Key of the checkpoint this was loaded from / saved to, see load_trace
+
+    @property
+    def labels(self):
+        return [self.label_names[i] for i in self.label_ids]
+
+    def arrays(self):
+        return {"signals": np.array(self.signals, dtype=str), "start_time": np.array(self.start_time),
+                "first_cycle": np.array(self.first_cycle), "reset_cycles": np.array(self.reset_cycles),
+                "start_cycle": np.array(self.start_cycle),
+                "tick_times": self.tick_times, "values": self.values, "label_ids": self.label_ids,
+                "label_names": np.array(self.label_names, dtype=str),
+                **({"toggles": self.toggles} if self.toggles is not None else {})}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        trace = cls(arrays["signals"].tolist())
+        trace.start_time = int(arrays["start_time"])
+        trace.first_cycle = int(arrays["first_cycle"])
+        trace.reset_cycles = int(arrays["reset_cycles"])
+        trace.start_cycle = int(arrays["start_cycle"])
+        trace.tick_times = arrays["tick_times"]
+        trace.values = arrays["values"]
+        trace.label_ids = arrays["label_ids"]
+        trace.label_names = arrays["label_names"].tolist()
+        trace.toggles = arrays.get("toggles")
+        return trace
+
+
+class RowBuffer:
+    """
+    Growable (rows, width) array, used to collect samples without knowing the
+    number of cycles up front
+    """
+    def __init__(self, width, dtype=np.uint8):
+        self.data = np.empty((1024, width), dtype=dtype)
+        self.n = 0
+
+    def append(self, row):
+        if self.n == self.data.shape[0]:
+            self.data.resize((2 * self.data.shape[0], self.data.shape[1]), refcheck=False)
+
+        self.data[self.n] = row
+        self.n += 1
+
+    def clear(self):
+        self.n = 0
+
+    def finish(self):
+        self.data.resize((self.n, self.data.shape[1]), refcheck=False)
+        return self.data
+
+
+class Window:
+    """
+    Range of cycles to keep while sampling a VCD: cycles are counted from the first cycle
+    whose status contains `start_label` (any status if empty), the first `start_cycle` of
+    them are skipped and sampling stops at `end_cycle` (if given) or at the first kept
+    cycle whose status contains `end_label` (if given), whichever comes first.
+    """
+    def __init__(self, start_label="", start_cycle=0, end_cycle=None, end_label=""):
+        assert start_cycle >= 0
+        assert end_cycle is None or end_cycle > start_cycle
+        self.start_label = start_label
+        self.start_cycle = start_cycle
+        self.end_cycle = end_cycle
+        self.end_label = end_label
+
+    def params(self):
+        return [self.start_label, self.start_cycle, self.end_cycle, self.end_label]
+
+
+def sample_vcd(path, signals, clk, rst="", label="", window=None, values_path=None, count_toggles=False,
+               toggles_path=None):
+    """
+    Make a single pass over a VCD file, recording the value of each of `signals` (full
+    names, single-bit) just before each rising edge of `clk`. Only the requested signals,
+    the clock, the reset and the status variable are tracked, so memory use scales with
+    the number of signals and the number of sampled cycles, not with the number of value
+    changes in the file. Compressed VCDs are decompressed as they are read, and for an FST
+    file only the value changes of the tracked signals are read at all.
+
+    As with the original vcdvcd-based implementation, cycles are only recorded after the
+    final change of `rst` (which must leave it deasserted), and the first rising edge after
+    reset only starts the first cycle.
+
+    Only the cycles within `window` (see Window) are stored, so the memory used does not
+    depend on the length of the simulation outside of it. The rest of the file is still
+    read, as reset may be asserted again later (which restarts the trace).
+
+    With `values_path`, the sampled values are written to that .npy file as they are
+    sampled instead of being kept in memory, and are returned memory-mapped.
+
+    With `count_toggles`, every change of each signal is also counted (not only the value
+    at the clock edge), giving the number of toggles within each cycle, including glitches.
+    A change at the time of a clock edge counts towards the cycle which the edge starts.
+    These are stored in `trace.toggles` (written to `toggles_path` if given, as the values).
+    """
+    trace = SampledTrace(signals)
+    window = window if window is not None else Window()
+
+    with open_vcd(path) as f:
+        header = read_header(f)
+
+        missing = [x for x in list(signals) + [clk] if x not in header.ids]
+        assert len(missing) == 0, f"Signals not found in VCD: {missing[:10]}"
+
+        columns = {}
+        for i, sig in enumerate(signals):
+            assert header.sizes[sig] == 1
+            columns.setdefault(header.ids[sig], []).append(i)
+
+        clk_id = header.ids[clk]
+        rst_id = header.ids[rst] if len(rst) > 0 else None
+        label_id = header.ids[label] if len(label) > 0 else None
+        assert rst_id is None or header.sizes[rst] == 1
+
+        state = bytearray(len(signals))
+        state_row = np.frombuffer(state, dtype=np.uint8)
+        clk_val = None
+        rst_val = None
+        label_val = "0"
+        label_pending = None
+
+        values = RowBuffer(len(signals)) if values_path is None else FileRowBuffer(values_path, len(signals))
+
+        # Changes of each signal since the last clock edge
+        toggles = None
+        if count_toggles:
+            toggles = RowBuffer(len(signals)) if toggles_path is None else FileRowBuffer(toggles_path, len(signals))
+            counts = bytearray(len(signals))
+            counts_row = np.frombuffer(counts, dtype=np.uint8)
+        tick_times = array("q")
+        label_ids = array("i")
+
+        # Statuses are decoded once per distinct value, but only get a label id once a
+        # cycle is recorded with them
+        label_cache = {}
+        label_index = {}
+        def status(bits):
+            if bits not in label_cache:
+                label_cache[bits] = decode_status(bits)
+            return label_cache[bits]
+
+        def status_id(text):
+            if text not in label_index:
+                label_index[text] = len(trace.label_names)
+                trace.label_names.append(text)
+            return label_index[text]
+
+        last_rise = -1
+        time = 0
+
+        # Cycle since reset, cycle at which the start status was first seen, and whether
+        # the end of the window was reached
+        cycle = 0
+        start = None
+        ended = False
+
+        # Changes are buffered per-timestamp so that the state (and status) can be sampled as
+        # it was just before the clock edge (equivalent to sampling at `edge time - 1`)
+        pending = []
+        clk_rose = False
+        rst_changed = False
+
+        def flush():
+            nonlocal last_rise, clk_rose, rst_changed, cycle, start, ended, label_val, label_pending
+
+            if rst_changed:
+                trace.start_time = time
+                del tick_times[:]
+                del label_ids[:]
+                del trace.label_names[:]
+                label_index.clear()
+                values.clear()
+                if toggles is not None:
+                    toggles.clear()
+                last_rise = -1
+                cycle = 0
+                start = None
+                ended = False
+
+            if clk_rose:
+                if last_rise != -1:
+                    text = status(label_val)
+                    if start is None and window.start_label in text:
+                        start = cycle
+
+                    offset = cycle - start if start is not None else -1
+                    if offset >= window.start_cycle and not ended:
+                        if (window.end_cycle is not None and offset >= window.end_cycle) or \
+                                (len(window.end_label) > 0 and window.end_label in text):
+                            ended = True
+                        else:
+                            if len(tick_times) == 0:
+                                trace.first_cycle = cycle
+                            tick_times.append(time)
+                            label_ids.append(status_id(text))
+                            values.append(state_row)
+                            if toggles is not None:
+                                toggles.append(counts_row)
+
+                    cycle += 1
+                last_rise = time
+                if toggles is not None:
+                    counts_row[:] = 0
+
+            if toggles is None:
+                for cols, val in pending:
+                    for col in cols:
+                        state[col] = val
+            else:
+                for cols, val in pending:
+                    for col in cols:
+                        if state[col] != val:
+                            state[col] = val
+                            if counts[col] < TOGGLE_MAX:
+                                counts[col] += 1
+
+            pending.clear()
+            if label_pending is not None:
+                label_val = label_pending
+                label_pending = None
+            clk_rose = False
+            rst_changed = False
+
+        lines = f
+        if isinstance(f, FSTFile):
+            lines = f.changes(set(columns) | {x for x in [clk_id, rst_id, label_id] if x is not None})
+
+        for line in lines:
+            c = line[:1]
+            if c in BIT_VALUES:
+                code = line[1:].rstrip()
+                val = c
+            elif c == b"b" or c == b"B":
+                val, code = line[1:].split()
+            elif c == b"#":
+                flush()
+                time = int(line[1:])
+                continue
+            else:
+                # $dumpvars/$dumpall/$end/$comment lines and real-valued changes are ignored
+                continue
+
+            cols = columns.get(code)
+            if cols is not None:
+                pending.append((cols, BIT_VALUES[val]))
+
+            if code == clk_id:
+                if val == b"1" and clk_val != b"1":
+                    clk_rose = True
+                clk_val = val
+
+            if code == rst_id:
+                rst_changed = True
+                rst_val = val
+
+            if code == label_id:
+                label_pending = val.decode()
+
+        flush()
+
+    trace.values = values.finish()
+    if toggles is not None:
+        trace.toggles = toggles.finish()
+    trace.tick_times = np.array(tick_times, dtype=np.int64)
+    trace.label_ids = np.array(label_ids, dtype=np.int32)
+    trace.reset_cycles = cycle
+    trace.start_cycle = start if start is not None else -1
+
+    assert rst_id is None or rst_val == b"0", "Reset is still asserted at the end of the VCD"
+    return trace
+
+
+def load_trace(path, signals, clk, build_dir, rst="", label="", window=None, out_of_core=False, count_toggles=False,
+               cache=True):
+    """
+    sample_vcd, reusing the sampled trace stored in `build_dir` by a previous run with the
+    same VCD contents, signals, clock, reset, status variable, window and `count_toggles`.
+    Returns (trace, whether it came from the cache).
+
+    The sampled values (and toggle counts) are stored as .npy files of their own. With
+    `out_of_core`, they are sampled directly into them and used memory-mapped (both when
+    sampled and when loaded from the cache), so they never have to fit in memory. Only
+    the latest trace sampled from each VCD file is kept.
+
+    Without `cache`, nothing is stored in `build_dir` and the VCD is always sampled. With
+    `out_of_core`, the trace then goes to temporary files, which are removed once it is no
+    longer used.
+    """
+    window = window if window is not None else Window()
+    params = [list(signals), clk, rst, label, window.params(), count_toggles]
+    names = ["values", "toggles"] if count_toggles else ["values"]
+
+    if not cache:
+        paths = {name: temp_array_path(f"trace_{name}") for name in names} if out_of_core else {}
+        trace = sample_vcd(path, signals, clk, rst=rst, label=label, window=window, count_toggles=count_toggles,
+                           values_path=paths.get("values"), toggles_path=paths.get("toggles"))
+        for name, x in paths.items():
+            weakref.finalize(getattr(trace, name), os.remove, x)
+
+        # The key is only needed to find the out of core mode data of this trace
+        trace.key = make_key("trace", file_digest(path), *params) if out_of_core else None
+        return trace, False
+
+    key = make_key("trace", cached_file_digest(build_dir, path), *params)
+    paths = {name: cache_path(build_dir, f"trace_{name}", key, "npy") for name in names}
+
+    arrays = load_cached_arrays(build_dir, "trace", key)
+    if arrays is not None:
+        stored = {name: open_array(x, mmap=out_of_core) for name, x in paths.items()}
+        if all(x is not None for x in stored.values()):
+            trace = SampledTrace.from_arrays({**arrays, **stored})
+            trace.key = key
+            return trace, True
+
+    trace = sample_vcd(path, signals, clk, rst=rst, label=label, window=window, count_toggles=count_toggles,
+                       values_path=paths["values"] if out_of_core else None,
+                       toggles_path=paths.get("toggles") if out_of_core else None)
+
+    arrays = trace.arrays()
+    for name, x in paths.items():
+        if not out_of_core:
+            save_array(x, arrays[name])
+        del arrays[name]
+    save_cached_arrays(build_dir, "trace", key, arrays)
+    replace_cached(build_dir, os.path.abspath(path), key, [("trace", "npz"), ("trace_values", "npy"),
+                                                          ("trace_toggles", "npy")])
+    trace.key = key
+    return trace, False
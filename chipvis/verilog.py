@@ -0,0 +1,421 @@
+import re
+
+from chipvis.cells import default_pin_direction
+
+# Reader for the flat, structural subset of Verilog written by OpenLANE/yosys for
+# gate-level netlists (module/port/wire declarations, assigns and cell instances with
+# named connections). It produces the same structure as yosys' write_json, so that
+# the rest of the flow does not depend on which reader was used.
+
+_ATTRIBUTE = re.compile(r"\(\*.*?\*\)", re.S)
+_IDENT = r"(?:\\\S+(?=\s|$)|[A-Za-z_][\w$]*)"
+_RANGE = re.compile(r"^\[\s*(-?\d+)\s*:\s*(-?\d+)\s*\]")
+_MODULE = re.compile(r"^module\s+(" + _IDENT + r")\s*(?:#\s*\(.*?\)\s*)?(?:\((.*)\))?\s*$", re.S)
+_INSTANCE = re.compile(r"^(" + _IDENT + r")\s*(?:#\s*\(.*?\)\s*)?(" + _IDENT + r")\s*\((.*)\)\s*$", re.S)
+_NAMED_PIN = re.compile(r"\.\s*(" + _IDENT + r")\s*\(\s*((?:\\\S+\s|[^()\\])*?)\s*\)")
+_CONSTANT = re.compile(r"^(\d*)\s*'\s*[sS]?([bBoOdDhH])\s*([0-9a-fA-FxXzZ_?]+)$")
+_SELECT = re.compile(r"^(" + _IDENT + r")\s*(?:\[\s*(-?\d+)\s*(?::\s*(-?\d+)\s*)?\])?$")
+
+_DECLARATIONS = {"input", "output", "inout", "wire", "reg", "tri", "wand", "wor", "supply0", "supply1"}
+_SKIPPED = {"parameter", "localparam", "defparam", "genvar", "integer", "timeunit", "timeprecision"}
+
+
+def _name(ident):
+    # Escaped identifiers are stored without the leading backslash, as yosys does
+    return ident.strip().lstrip("\\")
+
+
+def _statements(f):
+    """
+    Yields the ';'-terminated statements of a Verilog file (comments removed, whitespace
+    normalized), with `endmodule` (which has no ';') split out as its own statement
+    """
+    buf = []
+    in_comment = False
+
+    for line in f:
+        if in_comment:
+            end = line.find("*/")
+            if end < 0:
+                continue
+            line = line[end+2:]
+            in_comment = False
+
+        while True:
+            start = line.find("/*")
+            end_line = line.find("//")
+            if end_line >= 0 and (start < 0 or end_line < start):
+                line = line[:end_line]
+                break
+            if start < 0:
+                break
+            end = line.find("*/", start + 2)
+            if end < 0:
+                line = line[:start]
+                in_comment = True
+                break
+            line = line[:start] + " " + line[end+2:]
+
+        if line.lstrip().startswith("`"):
+            continue
+
+        parts = line.split(";")
+        for part in parts[:-1]:
+            buf.append(part)
+            yield from _split_endmodule(" ".join(buf))
+            buf = []
+        buf.append(parts[-1])
+
+    yield from _split_endmodule(" ".join(buf))
+
+
+def _split_endmodule(statement):
+    statement = statement.strip()
+    while statement.startswith("endmodule"):
+        yield "endmodule"
+        statement = statement[len("endmodule"):].strip()
+
+    if statement.endswith("endmodule"):
+        # Only possible for the final (unterminated) piece of the file
+        yield from _split_endmodule(statement[:-len("endmodule")])
+        yield "endmodule"
+    elif statement:
+        yield statement
+
+
+def _split_top_level(s, sep=","):
+    # Split on `sep`, ignoring separators inside brackets/braces/parens or escaped identifiers
+    parts = []
+    depth = 0
+    cur = []
+    i = 0
+    while i < len(s):
+        c = s[i]
+        if c == "\\":
+            j = i
+            while j < len(s) and not s[j].isspace():
+                j += 1
+            cur.append(s[i:j])
+            i = j
+            continue
+        if c in "([{":
+            depth += 1
+        elif c in ")]}":
+            depth -= 1
+        if c == sep and depth == 0:
+            parts.append("".join(cur))
+            cur = []
+        else:
+            cur.append(c)
+        i += 1
+
+    parts.append("".join(cur))
+    return [x.strip() for x in parts]
+
+
+class _Module:
+    def __init__(self, reader, name, port_order):
+        self.reader = reader
+        self.name = name
+        self.port_order = port_order
+        self.nets = {}      # Net name -> (bits, lsb, msb)
+        self.ports = {}     # Port name -> direction
+        self.cells = {}
+        self.assigns = []
+
+    def declare(self, name, direction, msb=0, lsb=0):
+        if name not in self.nets:
+            width = abs(msb - lsb) + 1
+            self.nets[name] = ([self.reader.new_bit() for _ in range(width)], lsb, msb)
+
+        if direction in ["input", "output", "inout"]:
+            self.ports[name] = direction
+
+    def net_bits(self, name, index=None, index_lsb=None):
+        if name not in self.nets:
+            # Implicitly-declared single-bit wire
+            self.declare(name, "wire")
+
+        bits, lsb, msb = self.nets[name]
+        if index is None:
+            return list(bits)
+
+        def position(i):
+            return (i - lsb) if msb >= lsb else (lsb - i)
+
+        if index_lsb is None:
+            return [bits[position(index)]]
+
+        lo, hi = sorted([position(index), position(index_lsb)])
+        return bits[lo:hi+1]
+
+    def expression_bits(self, expr):
+        """Bits (LSB first) of a connection/assign expression"""
+        expr = expr.strip()
+        if expr == "":
+            return []
+
+        if expr.startswith("{") and expr.endswith("}"):
+            inner = expr[1:-1].strip()
+
+            # Replication, e.g. {4{1'b0}}
+            m = re.match(r"^(\d+)\s*(\{.*\})$", inner, re.S)
+            if m:
+                return self.expression_bits(m.group(2)) * int(m.group(1))
+
+            bits = []
+            for part in reversed(_split_top_level(inner)):
+                bits.extend(self.expression_bits(part))
+            return bits
+
+        m = _CONSTANT.match(expr)
+        if m:
+            return _constant_bits(*m.groups())
+
+        if expr.isdigit():
+            return _constant_bits("32", "d", expr)
+
+        m = _SELECT.match(expr)
+        assert m, f"Unsupported expression in netlist: {expr}"
+        name = _name(m.group(1))
+        index = int(m.group(2)) if m.group(2) is not None else None
+        index_lsb = int(m.group(3)) if m.group(3) is not None else None
+        return self.net_bits(name, index, index_lsb)
+
+
+def _constant_bits(width, base, digits):
+    digits = digits.replace("_", "").lower().replace("?", "z")
+    base = base.lower()
+
+    if base == "d":
+        bits = bin(int(digits))[2:][::-1] if digits.isdigit() else digits[0]
+    else:
+        per_digit = {"b": 1, "o": 3, "h": 4}[base]
+        bits = ""
+        for d in reversed(digits):
+            if d in "xz":
+                bits += d * per_digit
+            else:
+                bits += bin(int(d, 16))[2:].zfill(per_digit)[::-1]
+
+    width = int(width) if width else max(len(bits), 1)
+    fill = bits[-1] if bits and bits[-1] in "xz" else "0"
+    bits = (bits + fill * width)[:width]
+    return [x for x in bits]
+
+
+class NetlistReader:
+    def __init__(self, pin_directions=None):
+        self.pin_directions = pin_directions or {}
+        self.modules = {}
+        self.next_bit = 2
+        self.parent = {}    # Union-find over bits joined by assigns
+        self.constant = {}  # Bits driven by a constant (by assign)
+
+    def new_bit(self):
+        bit = self.next_bit
+        self.next_bit += 1
+        return bit
+
+    def find(self, bit):
+        root = bit
+        while root in self.parent:
+            root = self.parent[root]
+
+        while bit in self.parent and self.parent[bit] != root:
+            self.parent[bit], bit = root, self.parent[bit]
+
+        return root
+
+    def resolve(self, bit):
+        if isinstance(bit, str):
+            return bit
+
+        root = self.find(bit)
+        return self.constant.get(root, root)
+
+    def join(self, a, b):
+        if isinstance(b, str):
+            if not isinstance(a, str):
+                self.constant[self.find(a)] = b
+            return
+        if isinstance(a, str):
+            self.constant[self.find(b)] = a
+            return
+
+        ra, rb = self.find(a), self.find(b)
+        if ra == rb:
+            return
+
+        # Keep the lower-numbered bit as the representative (the first-declared net)
+        if rb < ra:
+            ra, rb = rb, ra
+        self.parent[rb] = ra
+        if rb in self.constant:
+            self.constant[ra] = self.constant.pop(rb)
+
+    def read(self, path):
+        module = None
+
+        with open(path) as f:
+            for statement in _statements(f):
+                statement = _ATTRIBUTE.sub(" ", statement).strip()
+                if not statement:
+                    continue
+
+                keyword = statement.split(None, 1)[0]
+
+                if keyword == "module":
+                    m = _MODULE.match(statement)
+                    assert m, f"Could not parse module header: {statement[:200]}"
+                    module = self._start_module(_name(m.group(1)), m.group(2) or "")
+
+                elif keyword == "endmodule":
+                    module = None
+
+                elif module is None:
+                    continue
+
+                elif keyword in _DECLARATIONS:
+                    self._declare(module, statement)
+
+                elif keyword == "assign":
+                    for part in _split_top_level(statement[len("assign"):]):
+                        lhs, rhs = part.split("=", 1)
+                        module.assigns.append((lhs, rhs))
+
+                elif keyword in _SKIPPED:
+                    continue
+
+                else:
+                    self._instance(module, statement)
+
+    def _start_module(self, name, ports):
+        module = _Module(self, name, [])
+        self.modules[name] = module
+
+        direction = None
+        for part in _split_top_level(ports):
+            if not part:
+                continue
+
+            words = part.split()
+            if words[0] in ["input", "output", "inout"]:
+                # ANSI-style port declaration
+                direction = words[0]
+                self._declare(module, part)
+                name = _name(_RANGE.sub("", part.split(None, 1)[1].replace("wire", "").replace("reg", "").strip()).strip())
+            elif direction is not None:
+                self._declare(module, direction + " " + part)
+                name = _name(part)
+            else:
+                name = _name(part)
+
+            module.port_order.append(name)
+
+        return module
+
+    def _declare(self, module, statement):
+        words = statement.split(None, 1)
+        direction = words[0]
+        rest = words[1] if len(words) > 1 else ""
+
+        # Strip net types/signedness, e.g. "input wire signed [3:0] a"
+        while True:
+            parts = rest.split(None, 1)
+            if parts and parts[0] in ["wire", "reg", "tri", "signed", "unsigned", "logic"]:
+                rest = parts[1] if len(parts) > 1 else ""
+            else:
+                break
+
+        msb, lsb = 0, 0
+        m = _RANGE.match(rest)
+        if m:
+            msb, lsb = int(m.group(1)), int(m.group(2))
+            rest = rest[m.end():]
+
+        for name in _split_top_level(rest):
+            if not name:
+                continue
+
+            # Net declaration assignment, e.g. "wire a = b"
+            value = None
+            if "=" in name and not name.startswith("\\"):
+                name, value = name.split("=", 1)
+
+            name = _name(name)
+            module.declare(name, direction, msb, lsb)
+            if direction in ["supply0", "supply1"]:
+                for bit in module.net_bits(name):
+                    self.join(bit, "0" if direction == "supply0" else "1")
+
+            if value is not None:
+                module.assigns.append((name, value))
+
+    def _instance(self, module, statement):
+        m = _INSTANCE.match(statement)
+        assert m, f"Could not parse statement in netlist: {statement[:200]}"
+
+        cell_type, name, connections = _name(m.group(1)), _name(m.group(2)), m.group(3)
+        pins = _NAMED_PIN.findall(connections)
+        assert len(pins) > 0 or connections.strip() == "", \
+            f"Only named port connections are supported (instance {name} of {cell_type})"
+
+        directions = self.pin_directions.get(cell_type)
+        if directions is None and cell_type in self.modules:
+            directions = self.modules[cell_type].ports
+
+        port_directions = {}
+        cell_connections = {}
+        for pin, expr in pins:
+            pin = _name(pin)
+            if directions is not None and pin in directions:
+                port_directions[pin] = directions[pin]
+            else:
+                port_directions[pin] = default_pin_direction(cell_type, pin)
+
+            cell_connections[pin] = module.expression_bits(expr)
+
+        module.cells[name] = {"type": cell_type, "port_directions": port_directions, "connections": cell_connections}
+
+    def design(self):
+        """The parsed netlist in the same form as yosys' write_json output"""
+        for module in self.modules.values():
+            for lhs, rhs in module.assigns:
+                lhs_bits = module.expression_bits(lhs)
+                rhs_bits = module.expression_bits(rhs)
+                rhs_bits = (rhs_bits + ["0"] * len(lhs_bits))[:len(lhs_bits)]
+
+                for a, b in zip(lhs_bits, rhs_bits):
+                    self.join(a, b)
+
+        modules = {}
+        for module in self.modules.values():
+            resolve = lambda bits: [self.resolve(x) for x in bits]
+
+            ports = {}
+            for name in module.port_order:
+                if name in module.ports:
+                    ports[name] = {"direction": module.ports[name], "bits": resolve(module.nets[name][0])}
+
+            netnames = {name: {"bits": resolve(bits)} for name, (bits, lsb, msb) in module.nets.items()}
+
+            cells = {}
+            for name, cell in module.cells.items():
+                cells[name] = {"type": cell["type"], "port_directions": cell["port_directions"],
+                               "connections": {pin: resolve(bits) for pin, bits in cell["connections"].items()}}
+
+            modules[module.name] = {"ports": ports, "netnames": netnames, "cells": cells}
+
+        return {"creator": "chip-vis native netlist reader", "modules": modules}
+
+
+def read_netlist(path, pin_directions=None):
+    """
+    Parse a flat structural gate-level netlist without yosys. Pin directions come from
+    `pin_directions` ({cell type: {pin: direction}}, see chipvis.cells) where available,
+    otherwise from the SKY130 pin-naming convention.
+    """
+    reader = NetlistReader(pin_directions)
+    reader.read(path)
+    return reader.design()
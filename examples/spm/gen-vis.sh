@@ -13,11 +13,6 @@ if [ ! -f "$CELLS" ]; then
     exit 1
 fi
 
-# Hack to fix cells to work with yosys verilog parser
-mkdir -p build
-cp $CELLS build/tmp_${PDK}_cells_fixed.v
-sed -i 's/wire 1/wire __1/g' build/tmp_${PDK}_cells_fixed.v
-
 if [ ! -f "$GL" ]; then
     echo "Gate-level netlist not found."
     exit 1
@@ -33,9 +28,9 @@ if [ ! -f "$VCD" ]; then
     exit 1
 fi
 
-mkdir -p out
+mkdir -p build out
 python3 ../../chip-vis.py \
-                    --cell_models build/tmp_${PDK}_cells_fixed.v \
+                    --cell_models $CELLS \
                     --gl_netlist $GL \
                     --vcd $VCD \
                     --gds $GDS \
@@ -1,12 +1,122 @@
 #!/usr/bin/env python3
-from vcdvcd import VCDVCD
-import os
+import argparse
+import fnmatch
+import re
 import sys
 
+from chipvis.vcd import count_changes, open_vcd, read_header
+
+parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
+                                 description="List the signals in a VCD or FST file (only the header is read unless --counts is given),\n"
+                                             "and suggest values for the --prefix, --status_var, --clk and --rst options of chip-vis.py")
+
+parser.add_argument("vcd", help="Path to VCD file (optionally .gz/.zst compressed) or FST file")
+
+parser.add_argument("--glob", help="Only list signals whose full name matches this glob pattern (e.g. \"*.uut.*\")",
+                    action="store", default="")
+
+parser.add_argument("--regex", help="Only list signals whose full name matches (re.search) this regular expression",
+                    action="store", default="")
+
+parser.add_argument("--counts", help="Also show the number of value changes of each signal (requires a scan of the whole file,\n"
+                                     "which is much faster than loading it, as no values are decoded)",
+                    action="store_true")
+
+parser.add_argument("--no_candidates", help="Only list the signals, without the suggested chip-vis.py options",
+                    action="store_true")
+
 if len(sys.argv) < 2:
-    print(f"Usage: {sys.argv[1]} <path to vcd file>")
+    parser.print_help()
     sys.exit(1)
 
-vcd = VCDVCD(sys.argv[1])
-for x in vcd.signals:
-    print(x)
+args = parser.parse_args()
+
+NUM_CANDIDATES = 5
+
+###########################################
+# Read signals
+###########################################
+
+with open_vcd(args.vcd) as f:
+    header = read_header(f)
+
+    counts = None
+    if args.counts:
+        id_counts, timestamps = count_changes(f)
+        counts = {x: id_counts.get(header.ids[x], 0) for x in header.signals}
+
+signals = header.signals
+if len(args.glob) > 0:
+    signals = [x for x in signals if fnmatch.fnmatchcase(x, args.glob)]
+if len(args.regex) > 0:
+    regex = re.compile(args.regex)
+    signals = [x for x in signals if regex.search(x)]
+
+for x in signals:
+    if counts is not None:
+        print(f"{counts[x]:>12}  {x}")
+    else:
+        print(x)
+
+if args.no_candidates:
+    sys.exit(0)
+
+###########################################
+# Suggest chip-vis.py options
+###########################################
+
+def scope(name):
+    return name.rsplit(".", 1)[0] + "." if "." in name else ""
+
+def leaf(name):
+    return re.sub(r"\[.*$", "", name.rsplit(".", 1)[-1])
+
+def ranked(names, key):
+    # Most changes first if counts are available, otherwise by `key`
+    if counts is not None:
+        return sorted(names, key=lambda x: (-counts[x], key(x)))
+    return sorted(names, key=key)
+
+def show(option, names, note=None):
+    print(f"{option}:")
+    if len(names) == 0:
+        print("    (none found)")
+    for x in names[:NUM_CANDIDATES]:
+        extra = f"  ({note(x)})" if note is not None else ""
+        print(f"    {x}{extra}")
+    print()
+
+bits = [x for x in header.signals if header.sizes[x] == 1]
+
+# The design under test is the scope directly holding the most single-bit signals (the
+# nets of the gate-level netlist)
+scope_sizes = {}
+for x in bits:
+    scope_sizes[scope(x)] = scope_sizes.get(scope(x), 0) + 1
+prefixes = sorted(scope_sizes.keys(), key=lambda x: (-scope_sizes[x], x))
+prefix = prefixes[0] if len(prefixes) > 0 else ""
+
+# Prefer signals within the design (the clock/reset seen by the netlist), then those closest to it
+def closeness(x):
+    return (not x.startswith(prefix), x.count("."), x)
+
+clks = ranked([x for x in bits if re.search(r"clk|clock", leaf(x), re.I)], closeness)
+rsts = ranked([x for x in bits if re.search(r"rst|reset", leaf(x), re.I)], closeness)
+
+# Status variables are wide (string) registers outside of the design, ideally named "status"
+statuses = [x for x in header.signals if header.sizes[x] >= 16 and header.sizes[x] % 8 == 0 and not x.startswith(prefix)]
+statuses = sorted(statuses, key=lambda x: (not re.search(r"status|state|phase|label", leaf(x), re.I), x.count("."), x))
+
+# chip-vis.py matches the status variable by prefix, so the bit-range is not needed
+status_names = {re.sub(r"\[[^\]]*\]$", "", x): x for x in statuses}
+
+print()
+print("Candidate options for chip-vis.py:")
+print()
+show("--prefix", prefixes, lambda x: f"{scope_sizes[x]} single-bit signals")
+show("--status_var", list(status_names.keys()), lambda x: f"{header.sizes[status_names[x]]} bits")
+show("--clk", clks, (lambda x: f"{counts[x]} changes") if counts is not None else None)
+show("--rst", rsts, (lambda x: f"{counts[x]} changes") if counts is not None else None)
+
+if counts is not None:
+    print(f"Timestamps: {timestamps}")